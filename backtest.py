@@ -1,14 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from binance.client import Client
+from binance_trade_bot.config import Config
 from binance_trade_bot.logger import Logger
 from binance_trade_bot import backtest
-from sqlitedict import SqliteDict
+from binance_trade_bot.backtest import fork_backtest
+from binance_trade_bot.backtest_results import BacktestResults
+from binance_trade_bot.kline_prefetch import KlinePrefetcher, backtest_symbols
+from binance_trade_bot.kline_store import KlineStore, to_minute
 from sortedcontainers import SortedDict
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
+import argparse
 import itertools
 import numpy as np
 import sys
+import time
 
-cache = SqliteDict("data/backtest_cache.db")
+cache = KlineStore(legacy_path="data/backtest_cache.db")
 
 logger = Logger("backtesting", enable_notifications=True)
 
@@ -42,8 +50,14 @@ class SummaryTestStats:
     btc_val: float
     btc_diff: float
     multiplier: float
-    trades: SortedDict
+    trades: [str]
     coin_list: [str]
+    worst_profit: float = sys.maxsize
+    worst_trade: str = None
+    best_profit: float = -sys.maxsize
+    best_trade: str = None
+    average_profit: float = 0
+    max_drawdown: float = 0
 
 
 def gen_test_data(comb_sizes=None):
@@ -60,7 +74,7 @@ def gen_test_data(comb_sizes=None):
 
 def print_trade_stats(test_name, stats):
         msg = f"{test_name} SUMMARY trade stats:\n"
-        for s in stats.values():
+        for s in stats:
             msg += f"\t{str(s)}\n"
         logger.warning(msg)
 
@@ -79,99 +93,249 @@ def print_stats(stats, list_num, list_size):
         i -= 1
 
 
-def main():
+def summarize(i, data, manager, trader, start_values):
+    """
+    Value the final state of a case against its start
+
+    :return: The case SummaryTestStats, with trades rendered to strings in order of profit so they can cross
+    process boundaries
+    """
+    test_name = f"Test{i}.{data['coins']}x{data['multiplier']}"
+    btc_value = manager.collate_coins("BTC")
+    bridge_value = manager.collate_coins(manager.config.BRIDGE.symbol)
+    btc_diff = round((btc_value - start_values[0]) / start_values[0] * 100, 3)
+    bridge_diff = round((bridge_value - start_values[1]) / start_values[1] * 100, 3)
+
+    # Forked cases share the trades made before they diverged, label them with this case's multiplier
+    multiplier = round(data["multiplier"], 2)
+
+    def render(trade):
+        return str(trade if trade is None else trade.relabel(multiplier))
+
+    ledger = trader.ledger
+    summary = SummaryTestStats(
+        test_name, bridge_value, bridge_diff, btc_value, btc_diff, data["multiplier"],
+        [render(trade) for trade in ledger.by_profit()], data["coins"],
+        ledger.worst_profit, render(ledger.worst_trade), ledger.best_profit, render(ledger.best_trade),
+        ledger.average_profit, round(ledger.max_drawdown, 3)
+    )
+    logger.info(f"\n{i} test summary stats:\n"
+                f"trader.worst_profit: {summary.worst_profit}\n"
+                f"trader.worst_trade: {summary.worst_trade}\n"
+                f"trader.best_profit: {summary.best_profit}\n"
+                f"trader.best_trade: {summary.best_trade}\n"
+                f"trader.average_profit: {summary.average_profit}\n"
+                f"trader.max_drawdown: {summary.max_drawdown}\n")
+    return summary
+
+
+def run_case(i, data, fast=False, verbose=True):
+    """
+    Back-test a single case of the sweep
+    """
+    logger.info(f"\n    >>>--->>> Start back-testing on data [{i + 1}]: {data}")
     history = []
+    manager = trader = None
+    for manager, trader in backtest(data["DT1"], data["DT2"], yield_interval=1600,
+                                    start_balances={"USDT": data["usdt"]},
+                                    supported_coins=data["coins"], logger=logger,
+                                    scout_multiplier=data["multiplier"],
+                                    cache=cache, fast=fast):
+        btc_value = manager.collate_coins("BTC")
+        bridge_value = manager.collate_coins(manager.config.BRIDGE.symbol)
+        history.append((btc_value, bridge_value))
+        btc_diff = round((btc_value - history[0][0]) / history[0][0] * 100, 3)
+        bridge_diff = round((bridge_value - history[0][1]) / history[0][1] * 100, 3)
+
+        if verbose:
+            print("------")
+            print("TIME:", manager.datetime)
+            print("BALANCES:", manager.balances)
+            print("BTC VALUE:", btc_value, f"({btc_diff}%)")
+            print(f"{manager.config.BRIDGE.symbol} VALUE:", bridge_value, f"({bridge_diff}%)")
+            print("------")
 
-    stats = SortedDict()
+    if manager is None:
+        return []
+    return [(i, summarize(i, data, manager, trader, history[0]))]
+
+
+def run_group(cases, verbose=True):
+    """
+    Back-test cases that only differ by their multiplier in one forking simulation (default strategy only)
+    """
+    data = cases[0][1]
+    logger.info(f"\n    >>>--->>> Start back-testing {len(cases)} multipliers on data: {data}")
+    engine = fork_backtest([d["multiplier"] for _, d in cases], data["DT1"], data["DT2"],
+                           start_balances={"USDT": data["usdt"]},
+                           supported_coins=data["coins"], logger=logger, cache=cache)
+    start_values = (engine.manager.collate_coins("BTC"), engine.manager.collate_coins(engine.config.BRIDGE.symbol))
+    variants = engine.run(data["DT2"])
+    if verbose:
+        logger.info(f"{len(cases)} multipliers ran in {len(set(map(id, variants.values())))} forks")
+    return [(i, summarize(i, d, variants[d["multiplier"]].manager, variants[d["multiplier"]].trader, start_values))
+            for i, d in cases]
+
+
+def init_worker():
+    """
+    Process pool initializer: workers share the prefetched prices read-only
+    """
+    global cache
+    cache = KlineStore(readonly=True, legacy_path="data/backtest_cache.db")
+
+
+class SweepStats:
+    def __init__(self):
+        self.stats = SortedDict()
+        self.worst_profit = sys.maxsize
+        self.worst_trade = None
+        self.best_profit = -sys.maxsize
+        self.best_trade = None
+        self.average_profit = 0
+        self.count = 0
+
+    def add(self, summary: SummaryTestStats):
+        key = summary.usdt_val
+        while self.stats.__contains__(key):
+            key += 1e-12
+        self.stats[key] = summary
+
+        if self.worst_profit > summary.worst_profit:
+            self.worst_profit = summary.worst_profit
+            self.worst_trade = summary.worst_trade
+        if self.best_profit < summary.best_profit:
+            self.best_profit = summary.best_profit
+            self.best_trade = summary.best_trade
+
+        self.average_profit *= self.count
+        self.average_profit += summary.average_profit
+        self.average_profit /= (self.count + 1)
+        self.average_profit = round(self.average_profit, 3)
+        self.count += 1
+
+        logger.warning(f"\n{self.count - 1} GLOBAL TEST SUMMARY STATS:\n"
+                       f"--------->>> worst_profit: {self.worst_profit}\n"
+                       f"--------->>> worst_trade: {self.worst_trade}\n"
+                       f"--------->>> best_profit: {self.best_profit}\n"
+                       f"--------->>> best_trade: {self.best_trade}\n"
+                       f"--------->>> average_profit: {self.average_profit}\n")
+
+
+def prefetch(test_data):
+    """
+    Download the prices of every case up front so that workers only ever read the kline store
+    """
+    config = Config()
+    coins = sorted({coin for data in test_data for coin in data["coins"]})
+    client = Client(config.BINANCE_API_KEY, config.BINANCE_API_SECRET_KEY, tld=config.BINANCE_TLD)
+    KlinePrefetcher(client, cache, logger).run(
+        backtest_symbols(coins, config.BRIDGE.symbol),
+        min(to_minute(data["DT1"]) for data in test_data),
+        max(to_minute(data["DT2"]) for data in test_data),
+    )
+
+
+def case_params(data, config):
+    """
+    Everything that determines the outcome of a case, used to key the results store
+    """
+    return {
+        "coins": list(data["coins"]),
+        "multiplier": round(float(data["multiplier"]), 6),
+        "start": data["DT1"],
+        "end": data["DT2"],
+        "usdt": data["usdt"],
+        "bridge": config.BRIDGE.symbol,
+        "strategy": config.STRATEGY,
+        "use_margin": config.USE_MARGIN,
+        "scout_margin": config.SCOUT_MARGIN,
+    }
+
+
+def main(workers=1, fast=False, results_path="data/backtest_results.db", fork=False):
     # test_data = gen_test_data([4, 6, 8])
     # test_data = gen_test_data([2, 3, 4, 5, 6])
     # test_data = gen_test_data([2, 3])
     # test_data = gen_test_data([len(all_coins)])
     test_data = gen_test_data([2, 3])
     size = len(test_data)
-    worst_profit = sys.maxsize
-    worst_trade = None
-    best_profit = -sys.maxsize
-    best_trade = None
-    average_profit = 0
+    sweep = SweepStats()
+    config = Config()
+    results = BacktestResults(results_path)
 
     logger.info(f"\n======================== Starting back-test on {size} coins combinations: ========================")
     for d in test_data:
         logger.info(f"coins: {d['coins']}, multiplier: {round(d['multiplier'], 2)}")
 
-    i = 0
-    for data in test_data:
-        test_name = f"Test{i}.{data['coins']}x{data['multiplier']}"
-        logger.info(f"\n    >>>--->>> Start back-testing on data [{i + 1}/{size}]: {data}")
-        summary_stats = []
-        trd = None
-        for manager, trader in backtest(data["DT1"], data["DT2"], yield_interval=1600,
-                                        start_balances={"USDT": data["usdt"]},
-                                        supported_coins=data["coins"], logger=logger,
-                                        scout_multiplier=data["multiplier"],
-                                        cache=cache):
-            btc_value = manager.collate_coins("BTC")
-            bridge_value = manager.collate_coins(manager.config.BRIDGE.symbol)
-            history.append((btc_value, bridge_value))
-            btc_diff = round((btc_value - history[0][0]) / history[0][0] * 100, 3)
-            bridge_diff = round((bridge_value - history[0][1]) / history[0][1] * 100, 3)
-
-            summary_stats = [test_name, bridge_value, bridge_diff, btc_value, btc_diff, data["multiplier"], trader.stats]
-            trd = trader
-
-            print("------")
-            print("TIME:", manager.datetime)
-            print("BALANCES:", manager.balances)
-            print("BTC VALUE:", btc_value, f"({btc_diff}%)")
-            print(f"{manager.config.BRIDGE.symbol} VALUE:", bridge_value, f"({bridge_diff}%)")
-            print("------")
-
-        if trd:
-            logger.info(f"\n{i} test summary stats:\n"
-                        f"trader.worst_profit: {trd.worst_profit}\n"
-                        f"trader.worst_trade: {trd.worst_trade}\n"
-                        f"trader.best_profit: {trd.best_profit}\n"
-                        f"trader.best_trade: {trd.best_trade}\n"
-                        f"trader.average_profit: {trd.average_profit}\n")
-
-        if summary_stats:
-            key = summary_stats[1]
-            while stats.__contains__(key):
-                key += 1e-12
-            stats[key] = SummaryTestStats(*summary_stats, data["coins"])
-
-            if worst_profit > trd.worst_profit:
-                worst_profit = trd.worst_profit
-                worst_trade = trd.worst_trade
-            if best_profit < trd.best_profit:
-                best_profit = trd.best_profit
-                best_trade = trd.best_trade
-
-            average_profit *= i
-            average_profit += trd.average_profit
-            average_profit /= (i + 1)
-            average_profit = round(average_profit, 3)
-
-            logger.warning(f"\n{i} GLOBAL TEST SUMMARY STATS:\n"
-                           f"--------->>> worst_profit: {worst_profit}\n"
-                           f"--------->>> worst_trade: {worst_trade}\n"
-                           f"--------->>> best_profit: {best_profit}\n"
-                           f"--------->>> best_trade: {best_trade}\n"
-                           f"--------->>> average_profit: {average_profit}\n")
-
-            # if trd.stats:
-            #     logger.error(f"\n\tAll trades for {data['coins']} x{data['multiplier']}:\n")
-            #     for s in trd.stats.values():
-            #         logger.error(f"\t\t{s}")
-
-        print_stats(stats, i, size)
-        cache.commit()
-        i += 1
-
-    print_stats(stats, size, size)
+    pending = []
+    for i, data in enumerate(test_data):
+        result = results.get(case_params(data, config))
+        if result is None:
+            pending.append((i, data))
+            continue
+        result["test_name"] = f"Test{i}.{data['coins']}x{data['multiplier']}"
+        if isinstance(result["trades"], dict):
+            # Stored before trades were kept as a list in order of profit
+            result["trades"] = list(result["trades"].values())
+        sweep.add(SummaryTestStats(**result))
+    if len(pending) < size:
+        logger.info(f"\n--->>> Skipping {size - len(pending)} cases already stored in {results_path}")
+
+    def finish(summaries):
+        for i, summary in summaries:
+            data = test_data[i]
+            results.put(case_params(data, config), asdict(summary))
+            sweep.add(summary)
+
+    if fork and config.STRATEGY != "default":
+        logger.warning(f"Forking doesn't support the {config.STRATEGY} strategy, back-testing every case on its own")
+        fork = False
+
+    if fork:
+        groups = {}
+        for i, data in pending:
+            groups.setdefault((data["coins"], data["DT1"], data["DT2"], data["usdt"]), []).append((i, data))
+        jobs = [(run_group, (cases,), len(cases)) for cases in groups.values()]
+    else:
+        jobs = [(run_case, (i, data, fast), 1) for i, data in pending]
+
+    try:
+        if workers <= 1:
+            for job, args, _ in jobs:
+                finish(job(*args))
+                print_stats(sweep.stats, sweep.count, size)
+                cache.commit()
+        elif jobs:
+            prefetch([data for _, data in pending])
+            started = time.monotonic()
+            done = 0
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                futures = {executor.submit(job, *args, verbose=False): count for job, args, count in jobs}
+                for future in as_completed(futures):
+                    summaries = future.result()
+                    finish(summaries)
+                    done += futures[future]
+                    elapsed = time.monotonic() - started
+                    eta = round(elapsed / done * (len(pending) - done))
+                    logger.info(f"\n--->>> [{done}/{len(pending)}] done in {round(elapsed)}s, ETA {eta}s"
+                                + "".join(f"\n{s.test_name} --> {round(s.usdt_val, 2)}$ ({s.usdt_diff}%)"
+                                          for _, s in summaries))
+    finally:
+        results.close()
+
+    print_stats(sweep.stats, size, size)
 
     cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes running back-tests")
+    parser.add_argument("--fast", action="store_true", help="Use the vectorized engine (default strategy only)")
+    parser.add_argument("--fork", action="store_true",
+                        help="Simulate all multipliers of a coin combination together, forking where they diverge "
+                             "(default strategy only)")
+    parser.add_argument("--results", default="data/backtest_results.db", help="Store of finished cases to resume from")
+    args = parser.parse_args()
+    main(args.workers, args.fast, args.results, args.fork)
@@ -0,0 +1,264 @@
+"""
+Offline throughput benchmarks of the backtesting engine.
+
+Every case runs in a fresh process against synthetic klines, so no API keys or network are needed
+and the peak RSS of a case isn't polluted by the ones before it. Results are written as JSON and,
+given a previous result file, compared to it to flag regressions:
+
+    python benchmark.py --output data/benchmarks/new.json --compare data/benchmarks/old.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Config reads these eagerly, neither the synthetic client nor backtests use them
+os.environ.setdefault("API_KEY", "benchmark")
+os.environ.setdefault("API_SECRET_KEY", "benchmark")
+os.environ.setdefault("CURRENT_COIN_SYMBOL", "C00")
+
+from binance_trade_bot.backtest import backtest  # pylint: disable=wrong-import-position
+from binance_trade_bot.config import Config  # pylint: disable=wrong-import-position
+from binance_trade_bot.kline_prefetch import KlinePrefetcher  # pylint: disable=wrong-import-position
+from binance_trade_bot.kline_store import KlineStore, to_minute  # pylint: disable=wrong-import-position
+from binance_trade_bot.logger import Logger  # pylint: disable=wrong-import-position
+
+START_DATE = datetime(2021, 11, 1)
+STRATEGIES = ["default", "multiple_coins", "test_bb"]
+COIN_COUNTS = [3, 10, 50]
+# Throughput may drop / peak RSS may grow by this fraction before a case counts as a regression
+DEFAULT_TOLERANCE = 0.1
+
+
+class SyntheticClient:
+    """
+    Offline stand-in for the parts of the python-binance Client a backtest uses.
+
+    Prices are a deterministic random walk per symbol, with the occasional missing candle,
+    so every run of the benchmark simulates exactly the same market.
+    """
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str=None, limit=1000):
+        start_minute = int(start_str) // 60000
+        end_minute = (int(end_str) if end_str is not None else start_str + limit * 60000) // 60000 + 1
+        seed = zlib.crc32(symbol.encode())
+        day = 1440
+        klines = []
+        # Walks are generated per day so any window of a symbol sees the same prices
+        for day_start in range(start_minute - start_minute % day, end_minute, day):
+            rng = np.random.default_rng([seed, day_start])
+            base = 1 + seed % 1000 + 5 * math.sin(day_start / day)
+            prices = base * np.exp(np.cumsum(rng.normal(0, 0.002, day)))
+            gaps = rng.random(day) < 0.001
+            for offset in range(day):
+                minute = day_start + offset
+                if start_minute <= minute < end_minute and not gaps[offset]:
+                    klines.append([minute * 60000, repr(float(prices[offset]))])
+        return klines
+
+    def get_symbol_info(self, symbol):
+        return {
+            "symbol": symbol,
+            "filters": [
+                {"filterType": "LOT_SIZE", "stepSize": "0.00100000"},
+                {"filterType": "MIN_NOTIONAL", "minNotional": "0.00010000"},
+            ],
+        }
+
+
+def coin_names(count):
+    return [f"C{i:02d}" for i in range(count)]
+
+
+def quiet_logger():
+    logger = Logger("benchmark", enable_notifications=False)
+    for handler in logger.Logger.handlers:
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.ERROR)
+    return logger
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def bench_backtest(store_path, strategy, coins, minutes, fast=False):
+    """
+    Simulated minutes per second of a backtest over prefetched synthetic prices
+    """
+    config = Config()
+    config.STRATEGY = strategy
+    logger = quiet_logger()
+    end_date = START_DATE + timedelta(minutes=minutes)
+    cache = KlineStore(store_path)
+    runner = backtest(
+        START_DATE,
+        end_date,
+        yield_interval=minutes,
+        start_balances={config.BRIDGE.symbol: 100},
+        supported_coins=coin_names(coins),
+        logger=logger,
+        cache=cache,
+        config=config,
+        fast=fast,
+        client=SyntheticClient(),
+    )
+    # The first yield is after the prefetch and the initial purchase
+    manager, trader = next(runner)
+    started = time.perf_counter()
+    for manager, trader in runner:
+        pass
+    elapsed = time.perf_counter() - started
+    cache.close()
+    return {
+        "minutes_per_sec": minutes / elapsed,
+        "seconds": elapsed,
+        "trades": len(trader.ledger),
+        "final_minute": manager.minute,
+    }
+
+
+def bench_lookups(store_path, coins, minutes, lookups=200000):
+    """
+    Random price lookups per second, straight from the kline store
+    """
+    cache = KlineStore(store_path)
+    symbols = [coin + "USDT" for coin in coin_names(coins)]
+    start = to_minute(START_DATE)
+    KlinePrefetcher(SyntheticClient(), cache, quiet_logger()).run(symbols, start, start + minutes)
+    rng = random.Random(0)
+    keys = [(rng.choice(symbols), start + rng.randrange(minutes)) for _ in range(lookups)]
+    for symbol in symbols:
+        cache.series(symbol)
+    started = time.perf_counter()
+    for symbol, minute in keys:
+        cache.get(symbol, minute)
+    elapsed = time.perf_counter() - started
+    cache.close()
+    return {"lookups_per_sec": lookups / elapsed, "seconds": elapsed}
+
+
+def run_case(kind, args, store_path):
+    """
+    Process pool entry point: run one case and measure the peak RSS of its process.
+    Console output of the strategies is discarded, it would mostly measure the terminal.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if kind == "lookups":
+            result = bench_lookups(store_path, *args)
+        else:
+            result = bench_backtest(store_path, *args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def cases(strategies, coin_counts, minutes, fast):
+    for coins in coin_counts:
+        for strategy in strategies:
+            yield f"{strategy}/{coins}", "backtest", (strategy, coins, minutes)
+        if fast and "default" in strategies:
+            yield f"default-fast/{coins}", "backtest", ("default", coins, minutes, True)
+        yield f"lookups/{coins}", "lookups", (coins, minutes)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: Descriptions of the cases that got slower or bigger than the baseline allows
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or "error" in result or "error" in old:
+            continue
+        for metric in ("minutes_per_sec", "lookups_per_sec"):
+            if metric in result and metric in old and result[metric] < old[metric] * (1 - tolerance):
+                regressions.append(f"{name}: {metric} {old[metric]:.1f} -> {result[metric]:.1f}")
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak_rss_mb {old['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=int, default=1440, help="Simulated minutes per backtest case")
+    parser.add_argument("--coins", type=int, nargs="+", default=COIN_COUNTS, help="Coin counts to benchmark")
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES, help="Strategies to benchmark")
+    parser.add_argument("--fast", action="store_true", help="Also benchmark the vectorized default engine")
+    parser.add_argument("--output", help="Result file. Default: data/benchmarks/<timestamp>.json")
+    parser.add_argument("--compare", help="Previous result file to flag regressions against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    store_path = tempfile.mkdtemp(prefix="benchmark-klines-")
+    results = {}
+    try:
+        for name, kind, case_args in cases(args.strategies, args.coins, args.minutes, args.fast):
+            # A process per case: a clean peak RSS, and a crash doesn't take the suite down
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                try:
+                    results[name] = pool.apply(run_case, (kind, case_args, store_path))
+                except Exception as e:  # pylint: disable=broad-except
+                    results[name] = {"error": f"{type(e).__name__}: {e}"}
+            result = results[name]
+            if "error" in result:
+                print(f"{name:>20}: skipped ({result['error']})")
+            else:
+                rate = result.get("minutes_per_sec") or result["lookups_per_sec"]
+                unit = "min/s" if "minutes_per_sec" in result else "lookups/s"
+                print(f"{name:>20}: {rate:12.1f} {unit:9} peak RSS {result['peak_rss_mb']:.1f} MB")
+    finally:
+        shutil.rmtree(store_path, ignore_errors=True)
+
+    report = {
+        "created": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "minutes": args.minutes,
+        "results": results,
+    }
+    output = args.output or os.path.join("data", "benchmarks", f"{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
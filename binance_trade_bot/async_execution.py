@@ -0,0 +1,239 @@
+import asyncio
+import threading
+import traceback
+from typing import TYPE_CHECKING, NamedTuple, Optional, Tuple
+
+from binance.exceptions import BinanceAPIException
+
+from .binance_api_manager import order_error
+from .binance_stream_manager import BinanceOrder, OrderGuard
+from .logger import Logger
+from .models import Coin
+from .rate_limited_client import RateLimitedAsyncClient, RateLimitedClient, backoff, retry_after
+
+if TYPE_CHECKING:
+    from .binance_api_manager import BinanceAPIManager
+    from .database import TradeLog
+
+
+class BuyLeg(NamedTuple):
+    trade_log: "TradeLog"
+    pair_info: dict
+    # Trade fee of the sell, what it brings in is known before its account update arrives
+    sell_fee: float
+
+
+class AsyncJumpExecutor:
+    """
+    Executes both legs of a jump through the bridge on an asyncio loop, with the async client of python-binance.
+
+    While the sell order is in flight, everything the buy needs but the price is prepared: its trade log,
+    the symbol info and filters of the coin, the trade fees. The buy is placed as soon as the execution
+    report of the sell fill arrives, for the bridge the sell brought in after fees, instead of waiting for the
+    account update. Anything that may block, REST requests of the manager and waits on the stream cache, runs
+    in the default executor, so the loop keeps preparing the buy while the sell waits. A prepared buy that isn't
+    placed after all has its trade marked failed.
+    """
+
+    def __init__(self, manager: "BinanceAPIManager", logger: Logger):
+        self.manager = manager
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.client: Optional[RateLimitedAsyncClient] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.loop.run_forever, name="jump-executor", daemon=True)
+            self._thread.start()
+            config = self.manager.config
+            self.client = self._run(
+                RateLimitedAsyncClient.create(
+                    config.BINANCE_API_KEY, config.BINANCE_API_SECRET_KEY, tld=config.BINANCE_TLD
+                )
+            )
+            # Orders placed here draw on the weight budget of the REST requests of the manager
+            if isinstance(self.manager.binance_client, RateLimitedClient):
+                self.client.limiter = self.manager.binance_client
+
+    def close(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            if self.client is not None:
+                self._run(self.client.close_connection())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def jump(
+        self, from_coin: Coin, to_coin: Coin, bridge: Coin
+    ) -> Tuple[Optional[BinanceOrder], Optional[BinanceOrder]]:  # pylint: disable=unsubscriptable-object
+        """
+        Sell the from coin for the bridge and buy the to coin with it
+
+        :return: The filled sell and buy orders, None for a leg that didn't go through
+        """
+        self.start()
+        return self._run(self._jump(from_coin, to_coin, bridge))
+
+    async def _in_thread(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def _jump(self, from_coin: Coin, to_coin: Coin, bridge: Coin):
+        buy_leg = asyncio.ensure_future(self._prepare_buy(from_coin, to_coin, bridge))
+        try:
+            bridge_balance = await self._in_thread(self.manager.get_currency_balance, bridge.symbol)
+            sell = await self._sell(from_coin, bridge)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.warning(f"Failed to sell {from_coin.symbol}\n{traceback.format_exc()}")
+            sell = None
+        if sell is None:
+            try:
+                leg = await buy_leg
+                await self._in_thread(leg.trade_log.set_failed)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.warning(f"Failed to prepare the buy of {to_coin.symbol}\n{traceback.format_exc()}")
+            # In case the failure came from a balance that is off
+            await self._in_thread(self.manager.cache.invalidate_balances)
+            return None, None
+
+        leg = None
+        try:
+            leg = await buy_leg
+            # At worst the sell fee was taken in the bridge
+            bridge_balance += sell.cumulative_quote_qty * (1 - leg.sell_fee)
+            buy = await self._buy(to_coin, bridge, bridge_balance, leg)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.warning(f"Failed to buy {to_coin.symbol}\n{traceback.format_exc()}")
+            buy = None
+        if buy is None and leg is not None:
+            # The buy is placed again with a trade of its own
+            await self._in_thread(leg.trade_log.set_failed)
+        return sell, buy
+
+    async def _prepare_buy(self, from_coin: Coin, to_coin: Coin, bridge: Coin) -> BuyLeg:
+        manager = self.manager
+        trade_log = await self._in_thread(manager.db.start_trade_log, to_coin, bridge, False)
+        try:
+            pair_info = await self._in_thread(manager.get_symbol_info, to_coin.symbol, bridge.symbol)
+            # Caches the lot size filter the quantity is rounded with
+            await self._in_thread(manager.get_alt_tick, to_coin.symbol, bridge.symbol)
+            fees = await self._in_thread(manager.get_trade_fees)
+        except Exception:
+            await self._in_thread(trade_log.set_failed)
+            raise
+        return BuyLeg(trade_log, pair_info, fees[from_coin + bridge])
+
+    async def _sell(self, from_coin: Coin, bridge: Coin) -> Optional[BinanceOrder]:
+        manager = self.manager
+        origin_symbol, target_symbol = from_coin.symbol, bridge.symbol
+        trade_log = await self._in_thread(manager.db.start_trade_log, from_coin, bridge, True)
+
+        origin_balance = await self._in_thread(manager.get_currency_balance, origin_symbol)
+        target_balance = await self._in_thread(manager.get_currency_balance, target_symbol)
+        pair_info = await self._in_thread(manager.get_symbol_info, origin_symbol, target_symbol)
+        from_coin_price = await self._in_thread(manager.get_book_price, origin_symbol + target_symbol, True)
+        order_quantity = await self._in_thread(
+            manager._sell_quantity, origin_symbol, target_symbol, origin_balance  # pylint: disable=protected-access
+        )
+        self.logger.info(f"Selling {order_quantity} of {origin_symbol}")
+
+        order_id, order_guard = await self._submit(
+            self.client.order_limit_sell,
+            origin_symbol,
+            target_symbol,
+            manager.client_order_id(trade_log, "SELL"),
+            quantity="{:0.0{}f}".format(order_quantity, pair_info["baseAssetPrecision"]),
+            price="{:0.0{}f}".format(from_coin_price, pair_info["quotePrecision"]),
+        )
+        await self._in_thread(trade_log.set_ordered, origin_balance, target_balance, order_quantity)
+        # Returns as soon as the stream processor stores the fill
+        order = await self._in_thread(manager.wait_for_order, order_id, origin_symbol, target_symbol, order_guard)
+        if order is None:
+            return None
+        self.logger.info(f"Sold {origin_symbol}")
+        await self._in_thread(trade_log.set_complete, order.cumulative_quote_qty)
+        return order
+
+    async def _buy(
+        self, to_coin: Coin, bridge: Coin, bridge_balance: float, leg: BuyLeg
+    ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
+        manager = self.manager
+        origin_symbol, target_symbol = to_coin.symbol, bridge.symbol
+
+        # Unless the account update of the sell is already there, the bridge it brought in is estimated
+        target_balance = max(await self._in_thread(manager.get_currency_balance, target_symbol), bridge_balance)
+        origin_balance = await self._in_thread(manager.get_currency_balance, origin_symbol)
+        from_coin_price = await self._in_thread(manager.get_book_price, origin_symbol + target_symbol, False)
+        order_quantity = await self._in_thread(
+            manager._buy_quantity,  # pylint: disable=protected-access
+            origin_symbol,
+            target_symbol,
+            target_balance,
+            from_coin_price,
+        )
+        self.logger.info(f"BUY QTY {order_quantity}")
+
+        order_id, order_guard = await self._submit(
+            self.client.order_limit_buy,
+            origin_symbol,
+            target_symbol,
+            manager.client_order_id(leg.trade_log, "BUY"),
+            quantity="{:0.0{}f}".format(order_quantity, leg.pair_info["baseAssetPrecision"]),
+            price="{:0.0{}f}".format(from_coin_price, leg.pair_info["quotePrecision"]),
+        )
+        await self._in_thread(leg.trade_log.set_ordered, origin_balance, target_balance, order_quantity)
+        order = await self._in_thread(manager.wait_for_order, order_id, origin_symbol, target_symbol, order_guard)
+        if order is None:
+            return None
+        self.logger.info(f"Bought {origin_symbol}")
+        await self._in_thread(leg.trade_log.set_complete, order.cumulative_quote_qty)
+        return order
+
+    async def _submit(
+        self, place, origin_symbol: str, target_symbol: str, client_order_id: str, **params
+    ) -> Tuple[int, OrderGuard]:
+        order_guard = self.manager.stream_manager.acquire_order_guard()
+        try:
+            order_id = await self._place_order(place, origin_symbol + target_symbol, client_order_id, **params)
+        except Exception:
+            order_guard.release()
+            raise
+        order_guard.set_order(origin_symbol, target_symbol, order_id)
+        return order_id, order_guard
+
+    async def _place_order(self, place, symbol: str, client_order_id: str, **params) -> int:
+        """
+        Same as `BinanceAPIManager._place_order`, on the loop
+        """
+        attempt = 0
+        while True:
+            try:
+                order = await place(symbol=symbol, newClientOrderId=client_order_id, **params)
+                self.logger.info(order)
+                return int(order["orderId"])
+            except BinanceAPIException as e:
+                self.logger.info(e)
+                error = order_error(e)
+                if error == "rate_limited":
+                    await asyncio.sleep(max(backoff(attempt), retry_after(e)))
+                    attempt += 1
+                    continue
+                if error == "rejected":
+                    raise
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.warning(f"Unexpected Error: {e}")
+
+            existing = await self._in_thread(self.manager.find_order, symbol, client_order_id)
+            if existing is not None:
+                self.logger.info(f"Order {client_order_id} was placed after all: {existing}")
+                return int(existing.id)
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
@@ -1,48 +1,15 @@
 from datetime import datetime
 from typing import Dict, List
 
-from sqlalchemy.orm import Session
+import numpy as np
 
 from .binance_api_manager import BinanceAPIManager
 from .config import Config
 from .database import Database
 from .logger import Logger
 from .models import Coin, CoinValue, Pair
-from dataclasses import dataclass
-from sortedcontainers import SortedDict
-import sys
-
-
-@dataclass
-class TradeStats:
-    trade_idx: int
-    dt: datetime
-    from_coin: str = ""
-    to_coin: str = ""
-    from_coin_price: float = 0
-    to_coin_price: float = 0
-    prev_trade: str = ""
-    trades_str: str = ""
-    diff_usdt: float = 0
-    diff_perc: float = 0
-    quantity: float = 0
-    balance: str = ""
-    perc_from_init_balance: float = 0
-    manager: BinanceAPIManager = None
-    multiplier: float = 0
-
-    def __str__(self):
-        # m = f"x{self.multiplier}, {self.dt.strftime('%d/%m/%Y, %H:%M:%S')}, {self.from_coin}->{self.to_coin} " \
-        #     f"[{self.from_coin_price}*{self.quantity} -> {self.to_coin_price}], " \
-        #     f"prev_trade: {self.prev_trade}, " \
-        #     f"profit: ${self.diff_usdt} ({self.diff_perc}%), " \
-        #     f"balance: {self.balance}, result: {self.perc_from_init_balance}% from init balance: " \
-        #     f"{self.manager.init_balance}\n"
-        m = f"{self.trade_idx}. x{self.multiplier}, {self.dt.strftime('%d/%m/%Y, %H:%M:%S')}, {self.trades_str}, " \
-            f"PNL: ${self.diff_usdt} ({self.diff_perc}%), " \
-            f"result: {self.perc_from_init_balance}% from init balance - " \
-            f"{self.manager.init_balance['USDT']}$"
-        return m
+from .ratio_matrix import RatioMatrix
+from .trade_ledger import TradeLedger, TradeStats
 
 
 class AutoTrader:
@@ -51,20 +18,28 @@ class AutoTrader:
         self.db = database
         self.logger = logger
         self.config = config
-        self.stats = SortedDict()
-        self.worst_profit = sys.maxsize
-        self.worst_trade = None
-        self.best_profit = -sys.maxsize
-        self.best_trade = None
-        self.average_profit = 0
-        self.last_trade_stats = None
+        self.ledger = TradeLedger()
+        self.ratio_matrix = RatioMatrix(database)
 
     def initialize(self):
         self.initialize_trade_thresholds()
+        self.ratio_matrix.load()
+
+    def watched_symbols(self) -> List[str]:
+        """
+        Symbols whose price changes can make a scout jump, they trigger scouts when scouting on ticks
+        """
+        return [coin + self.config.BRIDGE for coin in self.db.get_coins()]
+
+    def flush_ratios(self):
+        """
+        Persist the ratio thresholds changed since the last flush
+        """
+        self.ratio_matrix.flush()
 
     def print_trade_stats(self):
         msg = "\n\nTrade stats:\n"
-        for s in self.stats.values():
+        for s in self.ledger.by_profit():
             msg += f"{str(s)}\n"
         self.logger.warning(msg)
 
@@ -77,10 +52,11 @@ class AutoTrader:
         from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
         to_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
 
-        s = TradeStats(len(self.stats), self.manager.datetime, pair.from_coin.symbol, pair.to_coin.symbol,
-                       from_coin_price, to_coin_price, manager=self.manager,
+        # Only simulated managers know the balance they started with
+        init_balance = getattr(self.manager, "init_balance", {}).get("USDT", 0)
+        s = TradeStats(len(self.ledger), self.manager.datetime, pair.from_coin.symbol, pair.to_coin.symbol,
+                       from_coin_price, to_coin_price, init_balance,
                        multiplier=round(self.manager.config.SCOUT_MULTIPLIER, 2))
-        diff_usdt = 0
         if balance and balance * from_coin_price > self.manager.get_min_notional(
             pair.from_coin.symbol, self.config.BRIDGE.symbol
         ):
@@ -88,15 +64,20 @@ class AutoTrader:
         else:
             self.logger.info("Skipping sell")
 
+        result = None
         if can_sell:
-            trade = self.manager.sell_alt(pair.from_coin, self.config.BRIDGE)
+            if self.manager.jump_executor is not None:
+                # Both legs at once, the buy is placed as soon as the sell fills
+                trade, result = self.manager.jump_executor.jump(pair.from_coin, pair.to_coin, self.config.BRIDGE)
+            else:
+                trade = self.manager.sell_alt(pair.from_coin, self.config.BRIDGE)
             # print(f"{trade}\n")
             if trade is None:
                 self.logger.info("Couldn't sell, going back to scouting mode...")
                 return None
             else:
-                if self.last_trade_stats:
-                    prev = self.last_trade_stats
+                prev = self.ledger.last_trade
+                if prev:
                     s.quantity = trade["quantity"]
                     sum1 = round(prev.from_coin_price * prev.quantity, 2)
                     sum2 = round(prev.to_coin_price * s.quantity, 2)
@@ -110,40 +91,25 @@ class AutoTrader:
                     # s.prev_trade = f"{prev.from_coin} -> {prev.to_coin} " \
                     #                f"[{prev.from_coin_price}*{prev.quantity}->" \
                     #                f"{prev.to_coin_price}*{s.quantity}]"
-                    diff_usdt = s.diff_usdt = round((trade["price"] - prev.to_coin_price) * s.quantity, 3)
-                    init_balance = self.manager.init_balance["USDT"]
-                    s.diff_perc = round(s.diff_usdt / init_balance * 100.0, 3)
+                    s.diff_usdt = round((trade["price"] - prev.to_coin_price) * s.quantity, 3)
                     s.balance = f"{round(balance, 3)} {pair.to_coin.symbol}"
-                    # bridge_value = self.manager.collate_coins(self.manager.config.BRIDGE.symbol)
-                    s.perc_from_init_balance = round((sum3 - init_balance) / init_balance * 100, 3)
-
-                    if self.worst_profit > diff_usdt:
-                        self.worst_profit = diff_usdt
-                        self.worst_trade = s
-                    if self.best_profit < diff_usdt:
-                        self.best_profit = diff_usdt
-                        self.best_trade = s
-                    stats_len = len(self.stats)
-                    if stats_len > 1:
-                        self.average_profit *= stats_len
-                        self.average_profit += diff_usdt
-                        self.average_profit /= (stats_len + 1)
-                        self.average_profit = round(self.average_profit, 3)
-
-                while self.stats.__contains__(diff_usdt):
-                    diff_usdt += 1e-12
-                self.stats[diff_usdt] = s
-                self.last_trade_stats = s
-                self.print_trade_stats()
-
-        result = self.manager.buy_alt(pair.to_coin, self.config.BRIDGE)
+                    if init_balance:
+                        s.diff_perc = round(s.diff_usdt / init_balance * 100.0, 3)
+                        # bridge_value = self.manager.collate_coins(self.manager.config.BRIDGE.symbol)
+                        s.perc_from_init_balance = round((sum3 - init_balance) / init_balance * 100, 3)
+
+                self.ledger.add(s, realized=prev is not None)
+                self.logger.warning(f"\n\nTrade stats:\n{s}\n{self.ledger.summary()}\n")
+
+        if result is None:
+            result = self.manager.buy_alt(pair.to_coin, self.config.BRIDGE)
         if result is not None:
             self.db.set_current_coin(pair.to_coin)
             self.update_trade_threshold(pair.to_coin, result.price)
             if result.price is None:
                 print(f"result.price is None ---> pair.to_coin: {pair.to_coin}, pair.from_coin: {pair.from_coin}")
-            # elif self.last_trade_stats:
-            #     last_trade = self.last_trade_stats
+            # elif self.ledger.last_trade:
+            #     last_trade = self.ledger.last_trade
             #     s.trades_str = f"{last_trade.from_coin} [{last_trade.from_coin_price}*{last_trade.quantity}] -> " \
             #                    f"{last_trade.to_coin} [{last_trade.to_coin_price}*{s.quantity}] -> " \
             #                    f"{s.from_coin} [{s.from_coin_price}*{s.quantity}] -> " \
@@ -162,51 +128,48 @@ class AutoTrader:
             self.logger.info("Skipping update... current coin {} not found".format(coin + self.config.BRIDGE))
             return
 
-        session: Session
-        with self.db.db_session() as session:
-            for pair in session.query(Pair).filter(Pair.to_coin == coin):
-                from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
+        ratios: Dict[Pair, float] = {}
+        for pair in self.ratio_matrix.pairs_to(coin):
+            from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
 
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
+            if from_coin_price is None:
+                self.logger.info("Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE))
+                continue
 
-                pair.ratio = from_coin_price / coin_price
+            ratios[pair] = from_coin_price / coin_price
+        for pair, ratio in ratios.items():
+            self.ratio_matrix.set(pair, ratio)
 
     def initialize_trade_thresholds(self):
         """
         Initialize the buying threshold of all the coins for trading between them
         """
-        session: Session
-        with self.db.db_session() as session:
-            for pair in session.query(Pair).filter(Pair.ratio.is_(None)).all():
-                if not pair.from_coin.enabled or not pair.to_coin.enabled:
-                    continue
-
-                # self.logger.info(f"Initializing {pair.from_coin} vs {pair.to_coin}")
-
-                from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
-
-                to_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
-                if to_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE)
-                    )
-                    continue
-
-                pair.ratio = from_coin_price / to_coin_price
-                # self.logger.info(f"\nInitialized pair threshold:"
-                #                  f"\n{pair}"
-                #                  f"\nfrom_coin_price:\t{from_coin_price}"
-                #                  f"\nto_coin_price:\t{to_coin_price}"
-                #                  f"\n")
+        ratios: Dict[Pair, float] = {}
+        for pair in self.db.get_pairs(only_enabled=False):
+            if pair.ratio is not None or not pair.from_coin.enabled or not pair.to_coin.enabled:
+                continue
+
+            # self.logger.info(f"Initializing {pair.from_coin} vs {pair.to_coin}")
+
+            from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
+            if from_coin_price is None:
+                self.logger.info(
+                    "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
+                )
+                continue
+
+            to_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
+            if to_coin_price is None:
+                self.logger.info("Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE))
+                continue
+
+            ratios[pair] = from_coin_price / to_coin_price
+            # self.logger.info(f"\nInitialized pair threshold:"
+            #                  f"\n{pair}"
+            #                  f"\nfrom_coin_price:\t{from_coin_price}"
+            #                  f"\nto_coin_price:\t{to_coin_price}"
+            #                  f"\n")
+        self.db.set_pair_ratios(ratios)
 
     def scout(self):
         """
@@ -224,8 +187,19 @@ class AutoTrader:
             print(f"\n\tWARNING:       ------>>> SKIP COIN: {coin} <<<------ \n\t!!!!!!!!!!! NO PRICE !!!!!!!!!!!!\n\n")
             return ratio_dict
 
-        for pair in self.db.get_pairs_from(coin):
-            optional_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
+        # What a jump fills at instead of the last prices: the best bid of the coin sold, the best ask of the one bought
+        book = self.config.PRICE_SOURCE == "book"
+        if book:
+            coin_price = self.manager.get_book_price(coin + self.config.BRIDGE, selling=True)
+
+        pairs, columns = self.ratio_matrix.pairs_from(coin)
+        scouted: List[int] = []
+        optional_coin_prices: List[float] = []
+        for k, pair in enumerate(pairs):
+            if book:
+                optional_coin_price = self.manager.get_book_price(pair.to_coin + self.config.BRIDGE, selling=False)
+            else:
+                optional_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
 
             if optional_coin_price is None:
                 self.logger.info(
@@ -233,6 +207,10 @@ class AutoTrader:
                 )
                 continue
 
+            if self.manager.is_ticker_stale(pair.to_coin + self.config.BRIDGE):
+                self.logger.debug(f"Skipping scouting... price of {pair.to_coin + self.config.BRIDGE} is stale")
+                continue
+
             self.db.log_scout(pair, pair.ratio, coin_price, optional_coin_price)
 
             if isinstance(coin_price, str) or isinstance(optional_coin_price, str):
@@ -241,34 +219,41 @@ class AutoTrader:
                                     f"\n\t\t\t/\\/\\/\\!!!!!!!!!<<<------- WRONG PRICE TYPES --------->>>!!!!!!!!!\n\n")
                 continue
 
-            # Obtain (current coin)/(optional coin)
-            optional_coin_ratio = coin_price / optional_coin_price
+            scouted.append(k)
+            optional_coin_prices.append(optional_coin_price)
 
-            # Fees
-            from_fee = self.manager.get_fee(pair.from_coin, self.config.BRIDGE, True)
-            to_fee = self.manager.get_fee(pair.to_coin, self.config.BRIDGE, False)
-            transaction_fee = from_fee + to_fee - from_fee * to_fee
+        if not scouted:
+            return ratio_dict
 
-            if self.config.USE_MARGIN == "yes":
-                mult = self.config.SCOUT_MARGIN
-                result = optional_coin_ratio / pair.ratio * (1 - transaction_fee) - 1 - mult / 100
-            else:
-                mult = self.config.SCOUT_MULTIPLIER
-                result = optional_coin_ratio * (1 - transaction_fee * mult) - pair.ratio
-
-            ratio_dict[pair] = result
-            # self.logger.info(f"\nCalculated ratio for pair: {pair}\n"
-            #                  f"coin_price:\t\t\t{coin_price}\n"
-            #                  f"optional_coin_price:\t{optional_coin_price}\n"
-            #                  f"optional_coin_ratio:\t{optional_coin_ratio}\n"
-            #                  f"calc_coin_ratio:\t\t{result}\n"
-            #                  )
+        # Obtain (current coin)/(optional coin) of every scouted pair at once
+        optional_coin_ratio = coin_price / np.array(optional_coin_prices)
+        ratios = self.ratio_matrix.row(coin)[columns[scouted]]
+
+        # Fees
+        from_fee = self.manager.get_fee(coin, self.config.BRIDGE, True)
+        to_fees = self.manager.get_fees([pairs[k].to_coin for k in scouted], self.config.BRIDGE, False)
+        transaction_fee = from_fee + to_fees - from_fee * to_fees
+
+        if self.config.USE_MARGIN == "yes":
+            mult = self.config.SCOUT_MARGIN
+            result = optional_coin_ratio / ratios * (1 - transaction_fee) - 1 - mult / 100
+        else:
+            mult = self.config.SCOUT_MULTIPLIER
+            result = optional_coin_ratio * (1 - transaction_fee * mult) - ratios
+
+        # Pairs without a ratio yet score NaN, which is never a jump
+        ratio_dict = dict(zip((pairs[k] for k in scouted), result.tolist()))
         return ratio_dict
 
     def _jump_to_best_coin(self, coin: Coin, coin_price: float):
         """
         Given a coin, search for a coin to jump to
         """
+        if self.manager.is_ticker_stale(coin + self.config.BRIDGE):
+            # Deferred until the price stream is back, jumping on an outdated price may lose money
+            self.logger.debug(f"Skipping scouting... price of {coin + self.config.BRIDGE} is stale")
+            return
+
         ratio_dict = self._get_ratios(coin, coin_price)
 
         # self.logger.info(f"\nratio_dict: {ratio_dict}\n")
@@ -312,15 +297,12 @@ class AutoTrader:
         """
         now = datetime.now()
 
-        session: Session
-        with self.db.db_session() as session:
-            coins: List[Coin] = session.query(Coin).all()
-            for coin in coins:
-                balance = self.manager.get_currency_balance(coin.symbol)
-                if balance == 0:
-                    continue
-                usd_value = self.manager.get_ticker_price(coin + "USDT")
-                btc_value = self.manager.get_ticker_price(coin + "BTC")
-                cv = CoinValue(coin, balance, usd_value, btc_value, datetime=now)
-                session.add(cv)
-                self.db.send_update(cv)
+        coin_values: List[CoinValue] = []
+        for coin in self.db.get_coins(only_enabled=False):
+            balance = self.manager.get_currency_balance(coin.symbol)
+            if balance == 0:
+                continue
+            usd_value = self.manager.get_ticker_price(coin + "USDT")
+            btc_value = self.manager.get_ticker_price(coin + "BTC")
+            coin_values.append(CoinValue(coin, balance, usd_value, btc_value, datetime=now))
+        self.db.log_coin_values(coin_values)
@@ -1,15 +1,22 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
+from copy import copy
+from datetime import datetime
 from traceback import format_exc
-from typing import Dict
+from typing import Dict, List
 
-from sqlitedict import SqliteDict
+import numpy as np
+from binance.client import Client
 
 from .binance_api_manager import BinanceAPIManager
 from .binance_stream_manager import BinanceOrder
 from .config import Config
 from .database import Database
+from .exchange_info import ExchangeInfoCache
+from .fast_backtest import FastScoutEngine, ForkingScoutEngine
+from .kline_prefetch import KlinePrefetcher, backtest_symbols
+from .kline_store import TIMEFRAME_MINUTES, KlineStore, from_minute, to_minute
 from .logger import Logger
+from .memory_database import InMemoryDatabase
 from .models import Coin, Pair
 from .strategies import get_strategy
 
@@ -22,66 +29,85 @@ class MockBinanceManager(BinanceAPIManager):
             logger: Logger,
             start_date: datetime = None,
             start_balances: Dict[str, float] = None,
-            cache: SqliteDict = None
+            cache: KlineStore = None,
+            client: Client = None,
     ):
-        super().__init__(config, db, logger)
+        super().__init__(config, db, logger, client)
         self.config = config
-        self.cache = cache or SqliteDict("data/backtest_cache.db")
-        self.datetime = start_date or datetime(2021, 1, 1)
+        # Simulations only need the symbols they trade, and mustn't overwrite the snapshot of the bot
+        self.exchange_info = ExchangeInfoCache(self.binance_client, logger, path=None, preload=False)
+        self.cache = cache or KlineStore()
+        # Simulated time in minutes since the epoch
+        self.minute = to_minute(start_date or datetime(2021, 1, 1))
         self.balances = start_balances or {config.BRIDGE.symbol: 100}
         print(f"\n\nself.balances: {self.balances}\n\n")
         self.init_balance = self.balances.copy()
 
+    @property
+    def datetime(self):
+        """
+        Simulated time as a naive UTC datetime, only materialized for logs and reports
+        """
+        return from_minute(self.minute)
+
+    @datetime.setter
+    def datetime(self, value):
+        self.minute = to_minute(value)
+
     def setup_websockets(self):
         pass  # No websockets are needed for backtesting
 
     def increment(self, interval=1):
-        self.datetime += timedelta(minutes=interval)
+        self.minute += interval
 
     def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):
         return 0.00075
 
+    def get_fees(self, coins: List[Coin], target_coin: Coin, selling: bool) -> np.ndarray:
+        return np.array([self.get_fee(coin, target_coin, selling) for coin in coins])
+
     def get_ticker_price(self, ticker_symbol: str, timeframe: str = "1m"):
         """
         Get ticker price of a specific coin
         """
-        target_date = self.datetime.strftime("%d %b %Y %H:%M:%S")
-        key = f"{ticker_symbol} - {target_date}"
-        val = self.cache.get(key, None)
-
-        if val == "no price":
-            return val
+        minute = self.minute
+        price = self.cache.get(ticker_symbol, minute, timeframe)
 
-        if val is None:
-            end_date = self.datetime + timedelta(minutes=1000)
-            if end_date > datetime.now():
-                end_date = datetime.now()
-            end_date = end_date.strftime("%d %b %Y %H:%M:%S")
-            # self.logger.info(f"Fetching prices for {ticker_symbol} between {self.datetime} and {end_date}")
-            self.logger.info(f"Fetching prices for {ticker_symbol}, key: {key} - between {self.datetime} and {end_date}")
-            for result in self.binance_client.get_historical_klines(
-                    ticker_symbol, timeframe, target_date, end_date, limit=1000
-            ):
-                # self.logger.log(f"KLines result: {result}")
+        if price is None:
+            self.fetch_klines(ticker_symbol, minute, timeframe)
+            price = self.cache.get(ticker_symbol, minute, timeframe)
 
-                date = datetime.utcfromtimestamp(result[0] / 1000).strftime("%d %b %Y %H:%M:%S")
+        # NaN (or a candle in the future) marks a minute without a price
+        if price is None or price != price:
+            return "no price"
 
-                price = float(result[1])
-                self.cache[f"{ticker_symbol} - {date}"] = price
+        return price
 
-                # print(f"key: {key} was successfully fetched")
-            # self.logger.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! cache.commit() !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            self.cache.commit()
-            val = self.cache.get(key, None)
-            # print(f"key: {key}, val: {val}")
+    def get_book_price(self, ticker_symbol: str, selling: bool):
+        # Klines have no order book, orders fill at the close price
+        return self.get_ticker_price(ticker_symbol)
 
-            if val is None:
-                self.cache[key] = "no price"
-                val = self.cache.get(key, None)
+    def get_ticker_age(self, ticker_symbol: str):
+        return 0.0
 
-            # print(f"key: {key}, val: {val}")
+    def is_ticker_stale(self, ticker_symbol: str):
+        return False
 
-        return val
+    def fetch_klines(self, ticker_symbol: str, minute: int, timeframe: str = "1m"):
+        """
+        Download the 1000 candles starting at the given minute into the kline cache
+        """
+        end_minute = min(minute + 1000 * TIMEFRAME_MINUTES[timeframe], to_minute(datetime.utcnow()))
+        if end_minute <= minute or self.cache.fill_from_legacy(ticker_symbol, minute, end_minute, timeframe):
+            return
+        self.logger.info(
+            f"Fetching prices for {ticker_symbol} between {from_minute(minute)} and {from_minute(end_minute)}"
+        )
+        klines = self.binance_client.get_historical_klines(
+            ticker_symbol, timeframe, minute * 60000, end_minute * 60000 - 1, limit=1000
+        )
+        self.cache.put_klines(ticker_symbol, klines, minute, end_minute, timeframe)
+        self.cache.commit()
 
     def get_exchange_info(self):
         return self.binance_client.get_exchange_info()
@@ -169,9 +195,14 @@ def backtest(
         starting_coin: str = None,
         supported_coins=None,
         logger: Logger = None,
-        cache: SqliteDict = None,
+        cache: KlineStore = None,
         scout_multiplier: float = None,
         config: Config = None,
+        prefetch=True,
+        prefetch_workers=4,
+        fast=False,
+        in_memory_db=True,
+        client: Client = None,
 ):
     """
 
@@ -183,15 +214,20 @@ def backtest(
     :param start_balances: A dictionary of initial coin values. Default: {BRIDGE: 100}
     :param starting_coin: The coin to start on. Default: first coin in coin list
     :param supported_coins: List of supported coins
-    :param cache: DB connection client
+    :param cache: Kline price store
     :param scout_multiplier: optional scout multiplier to override config data
     :param logger: Logger to use
+    :param prefetch: Download all missing prices of the backtest before it starts
+    :param prefetch_workers: Number of threads downloading prices during the prefetch
+    :param fast: Use the vectorized FastScoutEngine instead of scouting every interval (default strategy only)
+    :param in_memory_db: Keep the simulated state in an InMemoryDatabase instead of an in-memory SQLite MockDatabase
+    :param client: Binance client to download prices with, e.g. an offline stand-in. Default: a new Client
 
     :return: The final coin balances
     """
     config = config or Config()
     logger = logger or Logger("backtesting", enable_notifications=False)
-    cache = cache or SqliteDict("data/backtest_cache.db")
+    cache = cache or KlineStore()
     if scout_multiplier:
         config.SCOUT_MULTIPLIER = scout_multiplier
 
@@ -200,10 +236,15 @@ def backtest(
     end_date = end_date or datetime.today()
     supported_coins = supported_coins or config.SUPPORTED_COIN_LIST
 
-    db = MockDatabase(logger, config)
+    db = InMemoryDatabase(logger, config) if in_memory_db else MockDatabase(logger, config)
     db.create_database()
     db.set_coins(supported_coins)
-    manager = MockBinanceManager(config, db, logger, start_date, start_balances, cache=cache)
+    manager = MockBinanceManager(config, db, logger, start_date, start_balances, cache=cache, client=client)
+
+    if prefetch and not cache.readonly:
+        KlinePrefetcher(manager.binance_client, cache, logger, prefetch_workers).run(
+            backtest_symbols(supported_coins, config.BRIDGE.symbol), manager.minute, to_minute(end_date)
+        )
 
     # info = manager.get_exchange_info()
     # for s in info['symbols']:
@@ -223,23 +264,114 @@ def backtest(
 
     yield manager, trader
 
-    n = 1
-    try:
-        while manager.datetime < end_date:
-            try:
-                trader.scout()
-            except Exception:  # pylint: disable=broad-except
-                logger.warning(format_exc())
-            manager.increment(interval)
-            if n % yield_interval == 0:
-                # trader.print_trade_stats()
-                yield manager, trader
-            n += 1
-    except KeyboardInterrupt:
-        pass
+    if fast and config.STRATEGY != "default":
+        logger.warning(f"The fast engine doesn't support the {config.STRATEGY} strategy, scouting every minute")
+        fast = False
+
+    if fast:
+        yield from FastScoutEngine(manager, trader, db, logger, config, interval).run(end_date, yield_interval)
+    else:
+        n = 1
+        end_minute = to_minute(end_date)
+        try:
+            while manager.minute < end_minute:
+                try:
+                    trader.scout()
+                except Exception:  # pylint: disable=broad-except
+                    logger.warning(format_exc())
+                manager.increment(interval)
+                if n % yield_interval == 0:
+                    # trader.print_trade_stats()
+                    yield manager, trader
+                n += 1
+        except KeyboardInterrupt:
+            pass
 
     # cache.close()
 
     logger.warning(f"\n\n<<<--- STOP BACK-TESTING FOR SCOUT_MULTIPLIER: {config.SCOUT_MULTIPLIER}\n\n")
 
     return manager, trader
+
+
+def fork_backtest(
+        multipliers: List[float],
+        start_date: datetime = None,
+        end_date: datetime = None,
+        interval=1,
+        start_balances: Dict[str, float] = None,
+        starting_coin: str = None,
+        supported_coins=None,
+        logger: Logger = None,
+        cache: KlineStore = None,
+        config: Config = None,
+        prefetch=True,
+        prefetch_workers=4,
+        in_memory_db=True,
+        client: Client = None,
+) -> ForkingScoutEngine:
+    """
+    Set up a backtest of the default strategy for several scout multipliers that simulates the
+    scouts they agree on only once, see ForkingScoutEngine
+
+    :param multipliers: Scout multipliers to backtest
+    :param config: Configuration object to use
+    :param start_date: Date to  backtest from
+    :param end_date: Date up to which prices are prefetched
+    :param interval: Number of virtual minutes between each scout
+    :param start_balances: A dictionary of initial coin values. Default: {BRIDGE: 100}
+    :param starting_coin: The coin to start on. Default: first coin in coin list
+    :param supported_coins: List of supported coins
+    :param cache: Kline price store
+    :param logger: Logger to use
+    :param prefetch: Download all missing prices of the backtest before it starts
+    :param prefetch_workers: Number of threads downloading prices during the prefetch
+    :param in_memory_db: Keep the simulated states in InMemoryDatabases instead of in-memory SQLite MockDatabases
+    :param client: Binance client to download prices with, e.g. an offline stand-in. Default: a new Client
+
+    :return: The engine at the start date, `run(end_date)` simulates every multiplier
+    """
+    config = config or Config()
+    if config.STRATEGY != "default":
+        raise ValueError(f"Forking backtests don't support the {config.STRATEGY} strategy")
+    logger = logger or Logger("backtesting", enable_notifications=False)
+    cache = cache or KlineStore()
+    supported_coins = supported_coins or config.SUPPORTED_COIN_LIST
+    multipliers = list(multipliers)
+
+    def spawn(multiplier: float) -> FastScoutEngine:
+        variant_config = copy(config)
+        variant_config.SCOUT_MULTIPLIER = multiplier
+        variant_db = InMemoryDatabase(logger, variant_config) if in_memory_db else MockDatabase(logger, variant_config)
+        variant_db.create_database()
+        variant_db.set_coins(supported_coins)
+        variant_manager = MockBinanceManager(
+            variant_config,
+            variant_db,
+            logger,
+            start_date,
+            dict(start_balances) if start_balances else None,
+            cache,
+            client,
+        )
+        variant_trader = get_strategy("default")(variant_manager, variant_db, logger, variant_config)
+        return FastScoutEngine(variant_manager, variant_trader, variant_db, logger, variant_config, interval)
+
+    root = spawn(multipliers[0])
+    manager, trader, db = root.manager, root.trader, root.db
+    logger.warning(f"\n\n--->>>> STARTING BACK-TESTING FOR SCOUT_MULTIPLIERS: {multipliers}\n\n")
+
+    if prefetch and not cache.readonly:
+        KlinePrefetcher(manager.binance_client, cache, logger, prefetch_workers).run(
+            backtest_symbols(supported_coins, config.BRIDGE.symbol),
+            manager.minute,
+            to_minute(end_date or datetime.today()),
+        )
+
+    starting_coin = db.get_coin(starting_coin or supported_coins[0])
+    if manager.get_currency_balance(starting_coin.symbol) == 0:
+        manager.buy_alt(starting_coin, config.BRIDGE)
+    db.set_current_coin(starting_coin)
+    trader.initialize()
+
+    return ForkingScoutEngine(manager, trader, db, logger, root.config, multipliers, spawn, interval)
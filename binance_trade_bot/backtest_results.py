@@ -0,0 +1,37 @@
+import hashlib
+import json
+from typing import Any, Dict, Optional
+
+from sqlitedict import SqliteDict
+
+
+class BacktestResults:
+    """
+    Persistent store of finished backtest cases, keyed by a hash of the case parameters.
+
+    Every case is committed as soon as it is stored, so an interrupted sweep only loses the cases
+    that were still running, and several sweeps pointed at the same file share their results.
+    """
+
+    def __init__(self, path="data/backtest_results.db"):
+        self.db = SqliteDict(path, tablename="results", autocommit=True)
+
+    @staticmethod
+    def case_key(params: Dict[str, Any]) -> str:
+        """
+        Stable hash of the parameters that fully determine the outcome of a case
+        """
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def __contains__(self, params: Dict[str, Any]) -> bool:
+        return self.case_key(params) in self.db
+
+    def get(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        entry = self.db.get(self.case_key(params))
+        return None if entry is None else entry["result"]
+
+    def put(self, params: Dict[str, Any], result: Dict[str, Any]):
+        self.db[self.case_key(params)] = {"params": params, "result": result}
+
+    def close(self):
+        self.db.close()
@@ -1,36 +1,74 @@
 import math
 import time
 import traceback
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
+import numpy as np
 from binance.client import Client
 from binance.exceptions import BinanceAPIException
 from cachetools import TTLCache, cached
 
-from .binance_stream_manager import BinanceCache, BinanceOrder, BinanceStreamManager, OrderGuard
+from .binance_stream_manager import BinanceCache, BinanceOrder, BinanceStreamManager, OrderGuard, order_report
 from .config import Config
 from .database import Database
+from .exchange_info import ExchangeInfoCache
+from .fee_model import FeeModel
+from .ingest_process import IngestStreamManager
 from .logger import Logger
 from .models import Coin
+from .rate_limited_client import RateLimitedClient, backoff, retry_after
+
+# Seconds to wait for the stream to report a balance change before asking for the account
+BALANCE_UPDATE_TIMEOUT = 5
+# Error code of a lookup of an order the exchange doesn't know
+UNKNOWN_ORDER = -2013
+# Error code of rejected orders, with this message when one with the same client order id is open
+ORDER_REJECTED = -2010
+DUPLICATE_ORDER_MESSAGE = "Duplicate order sent."
+
+
+def order_error(e: BinanceAPIException) -> str:
+    """
+    What an error of an order request means for the order:
+    "rate_limited" when it was refused unprocessed and may be sent again once the rate limit allows,
+    "rejected" when the exchange refused it, "unknown" when it may have been placed anyway
+    """
+    if e.status_code in (418, 429):
+        return "rate_limited"
+    duplicate = e.code == ORDER_REJECTED and e.message == DUPLICATE_ORDER_MESSAGE
+    if e.status_code < 500 and not duplicate:
+        return "rejected"
+    return "unknown"
 
 
 class BinanceAPIManager:
-    def __init__(self, config: Config, db: Database, logger: Logger):
+    def __init__(self, config: Config, db: Database, logger: Logger, client: Client = None):
         # initializing the client class calls `ping` API endpoint, verifying the connection
-        self.binance_client = Client(
+        self.binance_client = client or RateLimitedClient(
             config.BINANCE_API_KEY,
             config.BINANCE_API_SECRET_KEY,
             tld=config.BINANCE_TLD,
+            weight_limit=config.REQUEST_WEIGHT_LIMIT,
+            logger=logger,
         )
         self.db = db
         self.logger = logger
         self.config = config
 
         self.cache = BinanceCache()
+        self.exchange_info = ExchangeInfoCache(self.binance_client, logger)
+        self.fee_model = FeeModel(self)
         self.stream_manager: Optional[BinanceStreamManager] = None
         self.setup_websockets()
+        # Places both legs of jumps when set, see AsyncJumpExecutor
+        self.jump_executor = None
 
     def setup_websockets(self):
+        if self.config.INGEST_PROCESS == "yes":
+            self.stream_manager = IngestStreamManager(self.config, self.binance_client, self.logger, self.exchange_info)
+            # Filled by the ingest process
+            self.cache = self.stream_manager.cache
+            return
         self.stream_manager = BinanceStreamManager(
             self.cache,
             self.config,
@@ -47,31 +85,13 @@ class BinanceAPIManager:
         return self.binance_client.get_bnb_burn_spot_margin()["spotBNBBurn"]
 
     def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):
-        base_fee = self.get_trade_fees()[origin_coin + target_coin]
-        if not self.get_using_bnb_for_fees():
-            return base_fee
-
-        # The discount is only applied if we have enough BNB to cover the fee
-        amount_trading = (
-            self._sell_quantity(origin_coin.symbol, target_coin.symbol)
-            if selling
-            else self._buy_quantity(origin_coin.symbol, target_coin.symbol)
-        )
-
-        fee_amount = amount_trading * base_fee * 0.75
-        if origin_coin.symbol == "BNB":
-            fee_amount_bnb = fee_amount
-        else:
-            origin_price = self.get_ticker_price(origin_coin + Coin("BNB"))
-            if origin_price is None:
-                return base_fee
-            fee_amount_bnb = fee_amount * origin_price
+        return self.fee_model.get(origin_coin, target_coin, selling)
 
-        bnb_balance = self.get_currency_balance("BNB")
-
-        if bnb_balance >= fee_amount_bnb:
-            return base_fee * 0.75
-        return base_fee
+    def get_fees(self, coins: List[Coin], target_coin: Coin, selling: bool) -> np.ndarray:
+        """
+        Fees of trading each of the given coins against the target coin, don't modify the returned array
+        """
+        return self.fee_model.vector(coins, target_coin, selling)
 
     def get_account(self):
         """
@@ -85,38 +105,56 @@ class BinanceAPIManager:
         """
         price = self.cache.ticker_values.get(ticker_symbol, None)
         if price is None and ticker_symbol not in self.cache.non_existent_tickers:
-            self.cache.ticker_values = {
-                ticker["symbol"]: float(ticker["price"]) for ticker in self.binance_client.get_symbol_ticker()
-            }
-            self.logger.debug(f"Fetched all ticker prices: {self.cache.ticker_values}")
-            price = self.cache.ticker_values.get(ticker_symbol, None)
-            if price is None:
+            if self.cache.needs_ticker_snapshot():
+                self.stream_manager.refresh_ticker_snapshot()
+                price = self.cache.ticker_values.get(ticker_symbol, None)
+            # A snapshot has every symbol, so once we have a recent one a miss means the symbol doesn't exist
+            if price is None and not self.cache.needs_ticker_snapshot():
                 self.logger.info(f"Ticker does not exist: {ticker_symbol} - will not be fetched from now on")
                 self.cache.non_existent_tickers.add(ticker_symbol)
 
         return price
 
+    def get_book_price(self, ticker_symbol: str, selling: bool):
+        """
+        Price an order fills at right away: the best bid when selling, the best ask when buying.
+        Unless price_source is 'book' and the book ticker of the symbol is known, the last price.
+        """
+        if self.config.PRICE_SOURCE == "book":
+            book = self.cache.book_tickers.get(ticker_symbol)
+            if book is not None:
+                return book[0] if selling else book[1]
+        return self.get_ticker_price(ticker_symbol)
+
+    def get_ticker_age(self, ticker_symbol: str) -> Optional[float]:
+        """
+        Seconds since the price of a ticker was received, None if it never was
+        """
+        return self.cache.ticker_age(ticker_symbol)
+
+    def is_ticker_stale(self, ticker_symbol: str) -> bool:
+        """
+        Whether the price of a ticker may be outdated because the price stream was down since
+        """
+        return self.cache.is_ticker_stale(ticker_symbol)
+
     def get_currency_balance(self, currency_symbol: str, force=False) -> float:
         """
-        Get balance of a specific coin
+        Get balance of a specific coin. Balances are kept up to date by the user data stream, the
+        account is only fetched when they aren't known, i.e. at startup and after a reconnect, or with force.
         """
+        if force or not self.cache.balances_loaded:
+            self.refresh_balances()
         with self.cache.open_balances() as cache_balances:
-            balance = cache_balances.get(currency_symbol, None)
-            if force or balance is None:
-                cache_balances.clear()
-                cache_balances.update(
-                    {
-                        currency_balance["asset"]: float(currency_balance["free"])
-                        for currency_balance in self.binance_client.get_account()["balances"]
-                    }
-                )
-                self.logger.debug(f"Fetched all balances: {cache_balances}")
-                if currency_symbol not in cache_balances:
-                    cache_balances[currency_symbol] = 0.0
-                    return 0.0
-                return cache_balances.get(currency_symbol, 0.0)
+            return cache_balances.get(currency_symbol, 0.0)
 
-            return balance
+    def refresh_balances(self):
+        account = self.binance_client.get_account()
+        self.cache.load_balances(
+            {currency_balance["asset"]: float(currency_balance["free"]) for currency_balance in account["balances"]},
+            account["updateTime"],
+        )
+        self.logger.debug(f"Fetched all balances, version {self.cache.balances_version}")
 
     def retry(self, func, *args, **kwargs):
         for attempt in range(20):
@@ -126,43 +164,38 @@ class BinanceAPIManager:
                 self.logger.warning(f"Failed to Buy/Sell. Trying Again (attempt {attempt}/20)")
                 if attempt == 0:
                     self.logger.warning(traceback.format_exc())
-                time.sleep(1)
+                # In case the failure came from a balance that is off, the next attempt refetches them
+                self.cache.invalidate_balances()
+                time.sleep(backoff(attempt))
         return None
 
+    def get_symbol_info(self, origin_symbol: str, target_symbol: str) -> dict:
+        return self.exchange_info.get(origin_symbol + target_symbol)
+
     def get_symbol_filter(self, origin_symbol: str, target_symbol: str, filter_type: str):
-        return next(
-            _filter
-            for _filter in self.binance_client.get_symbol_info(origin_symbol + target_symbol)["filters"]
-            if _filter["filterType"] == filter_type
-        )
+        return self.exchange_info.get_filter(origin_symbol + target_symbol, filter_type)
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_alt_tick(self, origin_symbol: str, target_symbol: str):
         step_size = self.get_symbol_filter(origin_symbol, target_symbol, "LOT_SIZE")["stepSize"]
         if step_size.find("1") == 0:
             return 1 - step_size.find(".")
         return step_size.find("1") - 1
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_min_notional(self, origin_symbol: str, target_symbol: str):
         return float(self.get_symbol_filter(origin_symbol, target_symbol, "MIN_NOTIONAL")["minNotional"])
 
     def _wait_for_order(
         self, order_id, origin_symbol: str, target_symbol: str
     ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
-        while True:
-            order_status: BinanceOrder = self.cache.orders.get(order_id, None)
-            if order_status is not None:
-                break
+        order_status = None
+        while order_status is None:
             self.logger.debug(f"Waiting for order {order_id} to be created")
-            time.sleep(1)
+            order_status = self.cache.wait_for_order(order_id)
 
         self.logger.debug(f"Order created: {order_status}")
 
         while order_status.status != "FILLED":
             try:
-                order_status = self.cache.orders.get(order_id, None)
-
                 self.logger.debug(f"Waiting for order {order_id} to be filled")
 
                 if self._should_cancel_order(order_status):
@@ -191,7 +224,8 @@ class BinanceAPIManager:
                     self.logger.info("Order is canceled, going back to scouting mode...")
                     return None
 
-                time.sleep(1)
+                # Sleeps until the next execution report of the order, or until it is time to cancel it
+                order_status = self.cache.wait_for_order(order_id, order_status, self._time_to_cancel(order_status))
             except BinanceAPIException as e:
                 self.logger.info(e)
                 time.sleep(1)
@@ -208,19 +242,40 @@ class BinanceAPIManager:
         with order_guard:
             return self._wait_for_order(order_id, origin_symbol, target_symbol)
 
-    def _should_cancel_order(self, order_status):
-        minutes = (time.time() - order_status.time / 1000) / 60
-        timeout = 0
-
+    def _cancel_deadline(self, order_status) -> Optional[float]:
+        """
+        :return: Timestamp after which an unfilled order may be cancelled, None if it never is
+        """
         if order_status.side == "SELL":
             timeout = float(self.config.SELL_TIMEOUT)
         else:
             timeout = float(self.config.BUY_TIMEOUT)
 
-        if timeout and minutes > timeout and order_status.status == "NEW":
+        if not timeout:
+            return None
+        return order_status.time / 1000 + timeout * 60
+
+    def _time_to_cancel(self, order_status) -> Optional[float]:
+        """
+        Seconds until `_should_cancel_order` may change its mind without a new execution report
+        """
+        deadline = self._cancel_deadline(order_status)
+        if deadline is None:
+            return None
+        remaining = deadline - time.time()
+        # Past the deadline, a partially filled buy is cancelled once the price moves away from it
+        return remaining if remaining > 0 else 1
+
+    def _should_cancel_order(self, order_status):
+        deadline = self._cancel_deadline(order_status)
+
+        if deadline is None or time.time() <= deadline:
+            return False
+
+        if order_status.status == "NEW":
             return True
 
-        if timeout and minutes > timeout and order_status.status == "PARTIALLY_FILLED":
+        if order_status.status == "PARTIALLY_FILLED":
             if order_status.side == "SELL":
                 return True
 
@@ -231,6 +286,74 @@ class BinanceAPIManager:
 
         return False
 
+    @staticmethod
+    def client_order_id(trade_log, side: str) -> str:
+        """
+        Id the order of a trade is placed with. Sending it again can't place a second order while the first
+        is open, and when a request fails without telling whether the order was placed, it is looked up by it.
+        """
+        return f"{trade_log.client_order_prefix}-{side}"
+
+    def find_order(self, symbol: str, client_order_id: str) -> Optional[BinanceOrder]:
+        """
+        Look up an order by its client order id, in the execution reports received so far then on the exchange
+
+        :return: The order, None if the exchange doesn't know it
+        """
+        order = self.cache.client_orders.get(client_order_id)
+        if order is not None:
+            return order
+        attempt = 0
+        while True:
+            try:
+                order = BinanceOrder(
+                    order_report(self.binance_client.get_order(symbol=symbol, origClientOrderId=client_order_id))
+                )
+                self.cache.set_order(order)
+                return order
+            except BinanceAPIException as e:
+                if e.code == UNKNOWN_ORDER:
+                    return None
+                self.logger.info(f"Couldn't look up order {client_order_id}: {e}")
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.info(f"Couldn't look up order {client_order_id}: {e}")
+            # Sending the order again before knowing whether it exists could place it twice
+            time.sleep(backoff(attempt))
+            attempt += 1
+
+    def _place_order(self, place, symbol: str, client_order_id: str, **params) -> int:
+        """
+        Place an order until the exchange has it. A request that fails without an answer of the exchange may
+        have placed it anyway, the order is then looked up by its client order id instead of being sent again.
+        Orders the exchange rejects raise, to be retried with fresh balances.
+
+        :return: The id of the order
+        """
+        attempt = 0
+        while True:
+            try:
+                order = place(symbol=symbol, newClientOrderId=client_order_id, **params)
+                self.logger.info(order)
+                return int(order["orderId"])
+            except BinanceAPIException as e:
+                self.logger.info(e)
+                error = order_error(e)
+                if error == "rate_limited":
+                    time.sleep(max(backoff(attempt), retry_after(e)))
+                    attempt += 1
+                    continue
+                if error == "rejected":
+                    raise
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.warning(f"Unexpected Error: {e}")
+
+            existing = self.find_order(symbol, client_order_id)
+            if existing is not None:
+                self.logger.info(f"Order {client_order_id} was placed after all: {existing}")
+                return int(existing.id)
+            time.sleep(backoff(attempt))
+            attempt += 1
+
     def buy_alt(self, origin_coin: Coin, target_coin: Coin) -> BinanceOrder:
         return self.retry(self._buy_alt, origin_coin, target_coin)
 
@@ -251,13 +374,10 @@ class BinanceAPIManager:
         origin_symbol = origin_coin.symbol
         target_symbol = target_coin.symbol
 
-        with self.cache.open_balances() as balances:
-            balances.clear()
-
         origin_balance = self.get_currency_balance(origin_symbol)
         target_balance = self.get_currency_balance(target_symbol)
-        pair_info = self.binance_client.get_symbol_info(origin_symbol + target_symbol)
-        from_coin_price = self.get_ticker_price(origin_symbol + target_symbol)
+        pair_info = self.get_symbol_info(origin_symbol, target_symbol)
+        from_coin_price = self.get_book_price(origin_symbol + target_symbol, selling=False)
         from_coin_price_s = "{:0.0{}f}".format(from_coin_price, pair_info["quotePrecision"])
 
         order_quantity = self._buy_quantity(origin_symbol, target_symbol, target_balance, from_coin_price)
@@ -265,27 +385,23 @@ class BinanceAPIManager:
 
         self.logger.info(f"BUY QTY {order_quantity}")
 
-        # Try to buy until successful
-        order = None
         order_guard = self.stream_manager.acquire_order_guard()
-        while order is None:
-            try:
-                order = self.binance_client.order_limit_buy(
-                    symbol=origin_symbol + target_symbol,
-                    quantity=order_quantity_s,
-                    price=from_coin_price_s,
-                )
-                self.logger.info(order)
-            except BinanceAPIException as e:
-                self.logger.info(e)
-                time.sleep(1)
-            except Exception as e:  # pylint: disable=broad-except
-                self.logger.warning(f"Unexpected Error: {e}")
+        try:
+            order_id = self._place_order(
+                self.binance_client.order_limit_buy,
+                origin_symbol + target_symbol,
+                self.client_order_id(trade_log, "BUY"),
+                quantity=order_quantity_s,
+                price=from_coin_price_s,
+            )
+        except Exception:
+            order_guard.release()
+            raise
 
         trade_log.set_ordered(origin_balance, target_balance, order_quantity)
 
-        order_guard.set_order(origin_symbol, target_symbol, int(order["orderId"]))
-        order = self.wait_for_order(order["orderId"], origin_symbol, target_symbol, order_guard)
+        order_guard.set_order(origin_symbol, target_symbol, order_id)
+        order = self.wait_for_order(order_id, origin_symbol, target_symbol, order_guard)
 
         if order is None:
             return None
@@ -313,14 +429,11 @@ class BinanceAPIManager:
         origin_symbol = origin_coin.symbol
         target_symbol = target_coin.symbol
 
-        with self.cache.open_balances() as balances:
-            balances.clear()
-
         origin_balance = self.get_currency_balance(origin_symbol)
         target_balance = self.get_currency_balance(target_symbol)
 
-        pair_info = self.binance_client.get_symbol_info(origin_symbol + target_symbol)
-        from_coin_price = self.get_ticker_price(origin_symbol + target_symbol)
+        pair_info = self.get_symbol_info(origin_symbol, target_symbol)
+        from_coin_price = self.get_book_price(origin_symbol + target_symbol, selling=True)
         from_coin_price_s = "{:0.0{}f}".format(from_coin_price, pair_info["quotePrecision"])
 
         order_quantity = self._sell_quantity(origin_symbol, target_symbol, origin_balance)
@@ -328,27 +441,36 @@ class BinanceAPIManager:
         self.logger.info(f"Selling {order_quantity} of {origin_symbol}")
 
         self.logger.info(f"Balance is {origin_balance}")
-        order = None
         order_guard = self.stream_manager.acquire_order_guard()
-        while order is None:
+        try:
             # Should sell at calculated price to avoid lost coin
-            order = self.binance_client.order_limit_sell(
-                symbol=origin_symbol + target_symbol, quantity=(order_quantity_s), price=from_coin_price_s
+            order_id = self._place_order(
+                self.binance_client.order_limit_sell,
+                origin_symbol + target_symbol,
+                self.client_order_id(trade_log, "SELL"),
+                quantity=order_quantity_s,
+                price=from_coin_price_s,
             )
-
-        self.logger.info(f"order: {order}")
+        except Exception:
+            order_guard.release()
+            raise
 
         trade_log.set_ordered(origin_balance, target_balance, order_quantity)
 
-        order_guard.set_order(origin_symbol, target_symbol, int(order["orderId"]))
-        order = self.wait_for_order(order["orderId"], origin_symbol, target_symbol, order_guard)
+        order_guard.set_order(origin_symbol, target_symbol, order_id)
+        order = self.wait_for_order(order_id, origin_symbol, target_symbol, order_guard)
 
         if order is None:
             return None
 
+        # The sold amount leaves the balance with the next account update of the stream
+        version = self.cache.balances_version
         new_balance = self.get_currency_balance(origin_symbol)
         while new_balance >= origin_balance:
-            new_balance = self.get_currency_balance(origin_symbol, True)
+            updated = self.cache.wait_for_balances(version, BALANCE_UPDATE_TIMEOUT)
+            version = self.cache.balances_version
+            # Without an update in time, fetch the account in case it got lost
+            new_balance = self.get_currency_balance(origin_symbol, force=not updated)
 
         self.logger.info(f"Sold {origin_symbol}")
 
@@ -1,15 +1,20 @@
-import sys
+import queue
 import threading
 import time
 from contextlib import contextmanager
-from typing import Dict, Set, Tuple
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 
 import binance.client
+import requests
 from binance.exceptions import BinanceAPIException, BinanceRequestException
 from unicorn_binance_websocket_api import BinanceWebSocketApiManager
 
 from .config import Config
 from .logger import Logger
+from .rate_limited_client import backoff
+
+# Most seconds between two attempts at a price snapshot that failed
+SNAPSHOT_RETRY_CAP = 60
 
 
 class BinanceOrder:  # pylint: disable=too-few-public-methods
@@ -19,6 +24,8 @@ class BinanceOrder:  # pylint: disable=too-few-public-methods
         self.side = report["side"]
         self.order_type = report["order_type"]
         self.id = report["order_id"]
+        # A cancel report carries the id of the cancel request, the one of the order is the original
+        self.client_order_id = report.get("original_client_order_id") or report.get("client_order_id")
         self.cumulative_quote_qty = float(report["cumulative_quote_asset_transacted_quantity"])
         self.status = report["current_order_status"]
         self.price = float(report["order_price"])
@@ -28,18 +35,246 @@ class BinanceOrder:  # pylint: disable=too-few-public-methods
         return f"<BinanceOrder {self.event}>"
 
 
-class BinanceCache:  # pylint: disable=too-few-public-methods
+def order_report(order: dict) -> dict:
+    """
+    Execution report equivalent of an order as returned by the REST API
+    """
+    return {
+        "symbol": order["symbol"],
+        "side": order["side"],
+        "order_type": order["type"],
+        "order_id": order["orderId"],
+        "client_order_id": order["clientOrderId"],
+        "cumulative_quote_asset_transacted_quantity": float(order["cummulativeQuoteQty"]),
+        "current_order_status": order["status"],
+        "order_price": float(order["price"]),
+        "transaction_time": order["time"],
+    }
+
+
+class BinanceCache:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
     ticker_values: Dict[str, float] = {}
+    # Event time of the latest price of each symbol, prices from before tickers_stale_before are stale
+    ticker_times: Dict[str, float] = {}
+    tickers_stale_before: float = 0.0
+    # False while the ticker stream is down, no price is fresh then whatever snapshot was taken meanwhile
+    ticker_stream_connected: bool = True
+    ticker_snapshot_time: Optional[float] = None
+    # Symbols the ticker stream sends prices for, None when it streams the whole market
+    streamed_tickers: Optional[FrozenSet[str]] = None
     _balances: Dict[str, float] = {}
-    _balances_mutex: threading.Lock = threading.Lock()
+    # Account update time (ms) of the latest value of each balance, updates older than it are dropped
+    _balance_times: Dict[str, int] = {}
+    _balances_mutex: threading.Condition = threading.Condition()
+    # Bumped and notified on every change of the balances, so values derived from them know when to recompute
+    balances_version: int = 0
+    # False until the whole account was fetched, and again once updates may have been missed
+    balances_loaded: bool = False
     non_existent_tickers: Set[str] = set()
+    # Best bid and ask prices of the symbols the book ticker stream follows, emptied while it is down
+    book_tickers: Dict[str, Tuple[float, float]] = {}
     orders: Dict[str, BinanceOrder] = {}
+    # Same orders by the client order id they were placed with
+    client_orders: Dict[str, BinanceOrder] = {}
+    # Notified on every order update, waiters check whether it is theirs
+    _orders_changed: threading.Condition = threading.Condition()
 
     @contextmanager
     def open_balances(self):
         with self._balances_mutex:
             yield self._balances
 
+    @contextmanager
+    def update_balances(self):
+        """
+        open_balances to change them
+        """
+        with self._balances_mutex:
+            yield self._balances
+            self.balances_version += 1
+            self._balances_mutex.notify_all()
+
+    def load_balances(self, balances: Dict[str, float], update_time: int):
+        """
+        Replace the balances with the ones of an account snapshot, except those updated since it was taken
+        """
+        with self.update_balances() as cached:
+            for asset, updated in self._balance_times.items():
+                if updated > update_time and asset in cached:
+                    balances[asset] = cached[asset]
+            cached.clear()
+            cached.update(balances)
+            for asset in balances:
+                self._balance_times[asset] = max(self._balance_times.get(asset, 0), update_time)
+            self.balances_loaded = True
+
+    def set_balances(self, balances: Dict[str, float], update_time: int):
+        """
+        Take the new values of the balances an account update changed
+        """
+        with self.update_balances() as cached:
+            for asset, free in balances.items():
+                if update_time >= self._balance_times.get(asset, 0):
+                    cached[asset] = free
+                    self._balance_times[asset] = update_time
+
+    def apply_balance_delta(self, asset: str, delta: float, update_time: int):
+        """
+        Add a deposit, withdrawal or transfer to a balance, unless a newer account update already has it
+        """
+        with self.update_balances() as cached:
+            if self.balances_loaded and update_time > self._balance_times.get(asset, 0):
+                cached[asset] = cached.get(asset, 0.0) + delta
+                self._balance_times[asset] = update_time
+
+    def invalidate_balances(self):
+        """
+        Have the next balance read fetch the whole account again
+        """
+        with self.update_balances():
+            self.balances_loaded = False
+
+    def wait_for_balances(self, version: int, timeout: float = None) -> bool:
+        """
+        Block until the balances change past `version`
+
+        :return: False on timeout
+        """
+        with self._balances_mutex:
+            return self._balances_mutex.wait_for(lambda: self.balances_version > version, timeout)
+
+    def set_ticker(self, symbol: str, price: float, received: float) -> bool:
+        """
+        :param received: When the exchange sent the price, or when a snapshot of it was requested
+        :return: Whether the price changed
+        """
+        self.ticker_times[symbol] = received
+        if self.ticker_values.get(symbol) == price:
+            return False
+        self.ticker_values[symbol] = price
+        return True
+
+    def set_book_ticker(self, symbol: str, bid: float, ask: float) -> bool:
+        """
+        :return: Whether the best bid or ask changed
+        """
+        book = (bid, ask)
+        if self.book_tickers.get(symbol) == book:
+            return False
+        self.book_tickers[symbol] = book
+        return True
+
+    def clear_book_tickers(self):
+        self.book_tickers.clear()
+
+    def ticker_age(self, symbol: str) -> Optional[float]:
+        """
+        Seconds since the exchange sent the price of a symbol, None if it never did
+        """
+        received = self.ticker_times.get(symbol)
+        return None if received is None else time.time() - received
+
+    def is_ticker_stale(self, symbol: str) -> bool:
+        """
+        Whether the price of a symbol may have moved without us knowing, i.e. the ticker stream
+        is down, went down or came back since it was sent, or doesn't send its prices at all
+        """
+        if not self.ticker_stream_connected:
+            return True
+        if self.streamed_tickers is not None and symbol not in self.streamed_tickers:
+            return True
+        received = self.ticker_times.get(symbol)
+        return received is None or received < self.tickers_stale_before
+
+    def set_ticker_stream_connected(self, connected: bool, since: float):
+        """
+        Record the ticker stream going down or coming back: the prices from before either may be outdated,
+        and the next snapshot is due once it is back
+        """
+        self.ticker_stream_connected = connected
+        self.tickers_stale_before = since
+
+    def needs_ticker_snapshot(self) -> bool:
+        return self.ticker_snapshot_time is None or self.ticker_snapshot_time < self.tickers_stale_before
+
+    def apply_ticker_snapshot(self, tickers: List[dict], fetched: float) -> List[str]:
+        """
+        Take the prices of a `get_symbol_ticker` snapshot for the symbols whose price is stale or
+        unknown. Fresher prices from the stream are kept.
+
+        :return: The symbols whose price changed
+        """
+        changed = []
+        for ticker in tickers:
+            symbol = ticker["symbol"]
+            if self.is_ticker_stale(symbol) and self.set_ticker(symbol, float(ticker["price"]), fetched):
+                changed.append(symbol)
+        self.ticker_snapshot_time = fetched
+        return changed
+
+    def set_order(self, order: BinanceOrder):
+        """
+        Store the latest state of an order and wake up whoever waits for it
+        """
+        with self._orders_changed:
+            self.orders[order.id] = order
+            if order.client_order_id:
+                self.client_orders[order.client_order_id] = order
+            self._orders_changed.notify_all()
+
+    def wait_for_order(
+        self, order_id, previous: BinanceOrder = None, timeout: float = None
+    ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
+        """
+        Block until the state of an order differs from `previous`, or `timeout` seconds passed
+
+        :return: The latest state of the order, None if it isn't known yet
+        """
+        with self._orders_changed:
+            self._orders_changed.wait_for(lambda: self.orders.get(order_id) is not previous, timeout)
+            return self.orders.get(order_id)
+
+
+# Quote coins of the prices read besides the bridge ones: BNB for fees, BTC and USDT for valuations
+AUXILIARY_QUOTES = ("BNB", "BTC", "USDT")
+
+
+def ticker_symbols(coins: Iterable[str], bridge: str) -> FrozenSet[str]:
+    """
+    Symbols whose prices the bot reads when trading the given coins through the bridge
+    """
+    quotes = {bridge, *AUXILIARY_QUOTES}
+    # BNB against the bridge decides whether the BNB fee discount still applies
+    return frozenset(coin + quote for coin in {*coins, "BNB"} for quote in quotes if coin != quote)
+
+
+class TickTrigger:
+    """
+    Wakes up a waiting scout when the price of a watched symbol changes.
+
+    Any number of price updates between two waits coalesce into a single wake-up, so a burst of
+    ticks never queues up scouts: the scout that runs reads the latest prices anyway.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.symbols: FrozenSet[str] = frozenset()
+
+    def watch(self, symbols: Iterable[str]):
+        self.symbols = frozenset(symbols)
+
+    def notify(self, symbols: Iterable[str]):
+        if not self.symbols.isdisjoint(symbols):
+            self._event.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        :return: True if a watched price changed since the last wait, False on timeout
+        """
+        triggered = self._event.wait(timeout)
+        self._event.clear()
+        return triggered
+
 
 class OrderGuard:
     def __init__(self, pending_orders: Set[Tuple[str, int]], mutex: threading.Lock):
@@ -53,6 +288,12 @@ class OrderGuard:
     def set_order(self, origin_symbol: str, target_symbol: str, order_id: int):
         self.tag = (origin_symbol + target_symbol, order_id)
 
+    def release(self):
+        """
+        Give up the guard when no order could be placed
+        """
+        self.mutex.release()
+
     def __enter__(self):
         try:
             if self.tag is None:
@@ -65,25 +306,145 @@ class OrderGuard:
         self.pending_orders.remove(self.tag)
 
 
-class BinanceStreamManager:
+class BinanceStreamManager:  # pylint: disable=too-many-instance-attributes
+    """
+    Keeps the BinanceCache up to date from the websocket streams.
+
+    The websocket threads only put what they receive on a queue, a single processor thread blocks
+    on it and applies everything queued up in one go. Ingest counters tell how far it lags behind.
+    A price snapshot that fails is retried by the processor with backoff until one goes through.
+    """
+
+    # Most messages applied per wake-up of the processor, so a flood can't starve the stop check
+    BATCH_SIZE = 1000
+
     def __init__(self, cache: BinanceCache, config: Config, binance_client: binance.client.Client, logger: Logger):
         self.cache = cache
         self.logger = logger
+        self.queue: "queue.SimpleQueue[Tuple[float, str, dict]]" = queue.SimpleQueue()
+        self.received = 0
+        # The websocket threads count what they receive concurrently
+        self._received_lock = threading.Lock()
+        self.processed = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # Monotonic time of the next attempt at a price snapshot that failed, None when none is due
+        self._snapshot_retry_at: Optional[float] = None
+        self._snapshot_attempt = 0
         self.bw_api_manager = BinanceWebSocketApiManager(
-            output_default="UnicornFy", enable_stream_signal_buffer=True, exchange=f"binance.{config.BINANCE_TLD}"
-        )
-        self.bw_api_manager.create_stream(
-            ["arr"], ["!miniTicker"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
+            process_stream_data=self._enqueue_data,
+            process_stream_signals=self._enqueue_signal,
+            output_default="UnicornFy",
+            exchange=f"binance.{config.BINANCE_TLD}",
         )
+        if config.SUBSCRIBE_ALL_TICKERS == "yes":
+            self.ticker_stream_id = self.bw_api_manager.create_stream(
+                ["arr"], ["!miniTicker"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
+            )
+        else:
+            # Only the tickers of the supported coins, a fraction of the whole market
+            self.cache.streamed_tickers = ticker_symbols(config.SUPPORTED_COIN_LIST, config.BRIDGE.symbol)
+            self.ticker_stream_id = self.bw_api_manager.create_stream(
+                ["miniTicker"],
+                [symbol.lower() for symbol in sorted(self.cache.streamed_tickers)],
+                api_key=config.BINANCE_API_KEY,
+                api_secret=config.BINANCE_API_SECRET_KEY,
+            )
+        self.book_stream_id = None
+        if config.PRICE_SOURCE == "book":
+            # Jumps go through the bridge, only the books against it are needed
+            self.book_stream_id = self.bw_api_manager.create_stream(
+                ["bookTicker"],
+                [(coin + config.BRIDGE.symbol).lower() for coin in config.SUPPORTED_COIN_LIST],
+                api_key=config.BINANCE_API_KEY,
+                api_secret=config.BINANCE_API_SECRET_KEY,
+            )
         self.bw_api_manager.create_stream(
             ["arr"], ["!userData"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
         )
         self.binance_client = binance_client
+        self.ticks = self._create_tick_trigger()
         self.pending_orders: Set[Tuple[str, int]] = set()
         self.pending_orders_mutex: threading.Lock = threading.Lock()
         self._processorThread = threading.Thread(target=self._stream_processor)
         self._processorThread.start()
 
+    def _create_tick_trigger(self) -> TickTrigger:
+        """
+        The trigger price changes are notified on, created before the stream processor starts
+        """
+        return TickTrigger()
+
+    def set_ticker_symbols(self, symbols: Iterable[str]):
+        """
+        Change the symbols the ticker stream sends prices for, unless it streams the whole market
+        """
+        streamed = self.cache.streamed_tickers
+        if streamed is None:
+            return
+        symbols = frozenset(symbols)
+        added, removed = symbols - streamed, streamed - symbols
+        if removed:
+            self.bw_api_manager.unsubscribe_from_stream(
+                self.ticker_stream_id, markets=[symbol.lower() for symbol in removed]
+            )
+        if added:
+            self.bw_api_manager.subscribe_to_stream(
+                self.ticker_stream_id, channels=["miniTicker"], markets=[symbol.lower() for symbol in added]
+            )
+        self.cache.streamed_tickers = symbols
+        if added:
+            self.logger.info(f"Subscribed to the tickers of {len(added)} more symbols")
+            # Their prices weren't followed until now, take them from a snapshot until they tick
+            for symbol in added:
+                self.cache.ticker_times.pop(symbol, None)
+            self._refresh_stale_tickers(force=True)
+
+    def refresh_ticker_snapshot(self):
+        """
+        Take a snapshot of all prices now, for a price that isn't known yet
+        """
+        self._refresh_stale_tickers(force=True)
+
+    def _enqueue_data(self, stream_data, stream_buffer_name=False):  # pylint: disable=unused-argument
+        # Called from the websocket threads, anything slower than a put delays the sockets
+        with self._received_lock:
+            self.received += 1
+        self.queue.put((time.monotonic(), "data", stream_data))
+
+    def _enqueue_signal(self, signal_type=False, stream_id=False, data_record=False):  # pylint: disable=unused-argument
+        with self._received_lock:
+            self.received += 1
+        self.queue.put((time.monotonic(), "signal", {"type": signal_type, "stream_id": stream_id}))
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Ingest counters: messages received and processed, batches, queue depth and lag in seconds
+        """
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "batches": self.batches,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        self.logger.debug(
+            f"Stream ingest: {stats['processed']}/{stats['received']} messages in {stats['batches']} batches, "
+            f"queue depth {stats['queue_depth']} (max {stats['max_queue_depth']}), "
+            f"lag {stats['last_lag']:.3f}s (max {stats['max_lag']:.3f}s)"
+        )
+
     def acquire_order_guard(self):
         return OrderGuard(self.pending_orders, self.pending_orders_mutex)
 
@@ -101,65 +462,108 @@ class BinanceStreamManager:
                 if order is not None:
                     break
                 time.sleep(1)
-            fake_report = {
-                "symbol": order["symbol"],
-                "side": order["side"],
-                "order_type": order["type"],
-                "order_id": order["orderId"],
-                "cumulative_quote_asset_transacted_quantity": float(order["cummulativeQuoteQty"]),
-                "current_order_status": order["status"],
-                "order_price": float(order["price"]),
-                "transaction_time": order["time"],
-            }
+            fake_report = order_report(order)
             self.logger.info(f"Pending order {order_id} for symbol {symbol} fetched:\n{fake_report}", False)
-            self.cache.orders[fake_report["order_id"]] = BinanceOrder(fake_report)
-
-    def _invalidate_balances(self):
-        with self.cache.open_balances() as balances:
-            balances.clear()
+            self.cache.set_order(BinanceOrder(fake_report))
 
     def _stream_processor(self):
-        while True:
-            if self.bw_api_manager.is_manager_stopping():
-                sys.exit()
-
-            stream_signal = self.bw_api_manager.pop_stream_signal_from_stream_signal_buffer()
-            stream_data = self.bw_api_manager.pop_stream_data_from_stream_buffer()
-
-            if stream_signal is not False:
-                signal_type = stream_signal["type"]
-                stream_id = stream_signal["stream_id"]
-                if signal_type == "CONNECT":
-                    stream_info = self.bw_api_manager.get_stream_info(stream_id)
-                    if "!userData" in stream_info["markets"]:
-                        self.logger.debug("Connect for userdata arrived", False)
-                        self._fetch_pending_orders()
-                        self._invalidate_balances()
-            if stream_data is not False:
-                self._process_stream_data(stream_data)
-            if stream_data is False and stream_signal is False:
-                time.sleep(0.01)
-
-    def _process_stream_data(self, stream_data):
+        while not self.bw_api_manager.is_manager_stopping():
+            if self._snapshot_retry_at is not None and time.monotonic() >= self._snapshot_retry_at:
+                self._refresh_stale_tickers(force=True)
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.max_queue_depth = max(self.max_queue_depth, len(batch) + self.queue.qsize())
+
+            # Price changes of the whole batch wake up the scout once
+            changed: List[str] = []
+            for _, kind, item in batch:
+                if kind == "signal":
+                    self._process_stream_signal(item)
+                else:
+                    self._process_stream_data(item, changed)
+            self.ticks.notify(changed)
+
+            self.processed += len(batch)
+            self.batches += 1
+            self.last_lag = time.monotonic() - batch[0][0]
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def _process_stream_signal(self, stream_signal):
+        if stream_signal["stream_id"] == self.ticker_stream_id:
+            if stream_signal["type"] == "DISCONNECT":
+                self.logger.debug("Ticker stream disconnected, prices are stale until it reconnects", False)
+                self.cache.set_ticker_stream_connected(False, time.time())
+            elif stream_signal["type"] == "CONNECT":
+                # Prices snapshotted during the outage went on moving until now
+                self.cache.set_ticker_stream_connected(True, time.time())
+                self._refresh_stale_tickers()
+        elif stream_signal["stream_id"] == self.book_stream_id:
+            if stream_signal["type"] == "DISCONNECT":
+                # Prices fall back to the last ones until the books tick again
+                self.cache.clear_book_tickers()
+        elif stream_signal["type"] == "CONNECT":
+            stream_info = self.bw_api_manager.get_stream_info(stream_signal["stream_id"])
+            if "!userData" in stream_info["markets"]:
+                self.logger.debug("Connect for userdata arrived", False)
+                self._fetch_pending_orders()
+                # Account updates may have been missed while disconnected
+                self.cache.invalidate_balances()
+
+    def _refresh_stale_tickers(self, force=False):
+        """
+        Fill in the prices that moved while the ticker stream was down, with a single request.
+        If it fails, the stream processor tries again later.
+        """
+        if not force and not self.cache.needs_ticker_snapshot():
+            return
+        fetched = time.time()
+        try:
+            tickers = self.binance_client.get_symbol_ticker()
+        except (BinanceRequestException, BinanceAPIException, requests.RequestException) as e:
+            delay = backoff(self._snapshot_attempt, base=1, cap=SNAPSHOT_RETRY_CAP)
+            self._snapshot_attempt += 1
+            self._snapshot_retry_at = time.monotonic() + delay
+            self.logger.error(f"Got exception during refreshing stale prices, retrying in {delay:.0f}s: {e}")
+            return
+        self._snapshot_retry_at = None
+        self._snapshot_attempt = 0
+        changed = self.cache.apply_ticker_snapshot(tickers, fetched)
+        self.logger.debug(f"Refreshed stale prices, {len(changed)} changed", False)
+        self.ticks.notify(changed)
+
+    def _process_stream_data(self, stream_data, changed: List[str]):
         event_type = stream_data["event_type"]
         if event_type == "executionReport":  # !userData
             self.logger.debug(f"execution report: {stream_data}")
-            order = BinanceOrder(stream_data)
-            self.cache.orders[order.id] = order
+            self.cache.set_order(BinanceOrder(stream_data))
         elif event_type == "balanceUpdate":  # !userData
             self.logger.debug(f"Balance update: {stream_data}")
-            with self.cache.open_balances() as balances:
-                asset = stream_data["asset"]
-                if asset in balances:
-                    del balances[stream_data["asset"]]
+            self.cache.apply_balance_delta(
+                stream_data["asset"], float(stream_data["balance_delta"]), stream_data["clear_time"]
+            )
         elif event_type in ("outboundAccountPosition", "outboundAccountInfo"):  # !userData
             self.logger.debug(f"{event_type}: {stream_data}")
-            with self.cache.open_balances() as balances:
-                for bal in stream_data["balances"]:
-                    balances[bal["asset"]] = float(bal["free"])
+            self.cache.set_balances(
+                {bal["asset"]: float(bal["free"]) for bal in stream_data["balances"]},
+                stream_data.get("last_update_time", stream_data["event_time"]),
+            )
+        elif event_type == "bookTicker":
+            symbol = stream_data["symbol"]
+            if self.cache.set_book_ticker(
+                symbol, float(stream_data["best_bid_price"]), float(stream_data["best_ask_price"])
+            ):
+                changed.append(symbol)
         elif event_type == "24hrMiniTicker":
             for event in stream_data["data"]:
-                self.cache.ticker_values[event["symbol"]] = float(event["close_price"])
+                if self.cache.set_ticker(event["symbol"], float(event["close_price"]), event["event_time"] / 1000):
+                    changed.append(event["symbol"])
         else:
             self.logger.error(f"Unknown event type found: {event_type}\n{stream_data}")
 
@@ -18,8 +18,19 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
             "scout_multiplier": "5",
             "scout_margin": "0.8",
             "scout_sleep_time": "5",
+            "scout_on_tick": "no",
+            "subscribe_all_tickers": "no",
+            "async_execution": "no",
+            "price_source": "last",
+            "ingest_process": "no",
             "hourToKeepScoutHistory": "1",
+            "scout_history_policy": "all",
+            "scout_history_interval": "60",
+            "scout_history_batch_size": "500",
+            "scout_history_flush_interval": "5",
+            "scout_history_max_pending": "10000",
             "tld": "com",
+            "request_weight_limit": "6000",
             "strategy": "default",
             "sell_timeout": "0",
             "buy_timeout": "0",
@@ -39,6 +50,24 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
             os.environ.get("HOURS_TO_KEEP_SCOUTING_HISTORY") or config.get(USER_CFG_SECTION, "hourToKeepScoutHistory")
         )
 
+        # Scout history writer: which scouts are kept, and how they are batched
+        self.SCOUT_HISTORY_POLICY = os.environ.get("SCOUT_HISTORY_POLICY") or config.get(
+            USER_CFG_SECTION, "scout_history_policy"
+        )
+        self.SCOUT_HISTORY_INTERVAL = float(
+            os.environ.get("SCOUT_HISTORY_INTERVAL") or config.get(USER_CFG_SECTION, "scout_history_interval")
+        )
+        self.SCOUT_HISTORY_BATCH_SIZE = int(
+            os.environ.get("SCOUT_HISTORY_BATCH_SIZE") or config.get(USER_CFG_SECTION, "scout_history_batch_size")
+        )
+        self.SCOUT_HISTORY_FLUSH_INTERVAL = float(
+            os.environ.get("SCOUT_HISTORY_FLUSH_INTERVAL")
+            or config.get(USER_CFG_SECTION, "scout_history_flush_interval")
+        )
+        self.SCOUT_HISTORY_MAX_PENDING = int(
+            os.environ.get("SCOUT_HISTORY_MAX_PENDING") or config.get(USER_CFG_SECTION, "scout_history_max_pending")
+        )
+
         # Get config for scout
         self.SCOUT_MULTIPLIER = float(
             os.environ.get("SCOUT_MULTIPLIER") or config.get(USER_CFG_SECTION, "scout_multiplier")
@@ -51,6 +80,10 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.BINANCE_API_KEY = os.environ.get("API_KEY") or config.get(USER_CFG_SECTION, "api_key")
         self.BINANCE_API_SECRET_KEY = os.environ.get("API_SECRET_KEY") or config.get(USER_CFG_SECTION, "api_secret_key")
         self.BINANCE_TLD = os.environ.get("TLD") or config.get(USER_CFG_SECTION, "tld")
+        # Request weight per minute the bot may use, lower it when other programs share the IP
+        self.REQUEST_WEIGHT_LIMIT = int(
+            os.environ.get("REQUEST_WEIGHT_LIMIT") or config.get(USER_CFG_SECTION, "request_weight_limit")
+        )
 
         # Get supported coin list from the environment
         supported_coin_list = [
@@ -75,3 +108,20 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
 
         self.USE_MARGIN = os.environ.get("USE_MARGIN") or config.get(USER_CFG_SECTION, "use_margin")
         self.SCOUT_MARGIN = float(os.environ.get("SCOUT_MARGIN") or config.get(USER_CFG_SECTION, "scout_margin"))
+
+        # 'yes' to scout as soon as a price the strategy depends on changes, instead of every scout_sleep_time
+        self.SCOUT_ON_TICK = os.environ.get("SCOUT_ON_TICK") or config.get(USER_CFG_SECTION, "scout_on_tick")
+
+        # 'yes' to stream the prices of every symbol on the exchange instead of only the ones of the supported coins
+        self.SUBSCRIBE_ALL_TICKERS = os.environ.get("SUBSCRIBE_ALL_TICKERS") or config.get(
+            USER_CFG_SECTION, "subscribe_all_tickers"
+        )
+
+        # 'yes' to place the buy of a jump as soon as its sell fills, from an asyncio loop
+        self.ASYNC_EXECUTION = os.environ.get("ASYNC_EXECUTION") or config.get(USER_CFG_SECTION, "async_execution")
+
+        # 'book' to score jumps and price their orders with the best bid and ask, 'last' for the last prices
+        self.PRICE_SOURCE = os.environ.get("PRICE_SOURCE") or config.get(USER_CFG_SECTION, "price_source")
+
+        # 'yes' to handle the websocket streams in a separate process, sharing prices and balances through shared memory
+        self.INGEST_PROCESS = os.environ.get("INGEST_PROCESS") or config.get(USER_CFG_SECTION, "ingest_process")
@@ -1,7 +1,11 @@
 #!python3
 import time
+from traceback import format_exc
 
+from .async_execution import AsyncJumpExecutor
+from .auto_trader import AutoTrader
 from .binance_api_manager import BinanceAPIManager
+from .binance_stream_manager import ticker_symbols
 from .config import Config
 from .database import Database
 from .logger import Logger
@@ -9,6 +13,28 @@ from .scheduler import SafeScheduler
 from .strategies import get_strategy
 
 
+def scout_on_ticks(
+    trader: AutoTrader, manager: BinanceAPIManager, schedule: SafeScheduler, logger: Logger, config: Config
+):
+    """
+    Scout as soon as a price the trader depends on changes, and at least every scout_sleep_time seconds.
+    The scheduler only runs the housekeeping jobs in between.
+    """
+    ticks = manager.stream_manager.ticks
+    ticks.watch(trader.watched_symbols())
+    logger.info(f"Scouting on price changes of {len(ticks.symbols)} symbols")
+    last_scout = 0.0
+    while True:
+        triggered = ticks.wait(timeout=1)
+        if triggered or time.monotonic() - last_scout >= config.SCOUT_SLEEP_TIME:
+            last_scout = time.monotonic()
+            try:
+                trader.scout()
+            except Exception:  # pylint: disable=broad-except
+                logger.error(f"Error while scouting...\n{format_exc()}")
+        schedule.run_pending()
+
+
 def main():
     logger = Logger()
     logger.info("Starting")
@@ -23,6 +49,11 @@ def main():
         logger.error("Couldn't access Binance API - API keys may be wrong or lack sufficient permissions")
         logger.error(e)
         return
+
+    manager.exchange_info.start()
+    if config.ASYNC_EXECUTION == "yes":
+        manager.jump_executor = AsyncJumpExecutor(manager, logger)
+
     strategy = get_strategy(config.STRATEGY)
     if strategy is None:
         logger.error("Invalid strategy name")
@@ -34,18 +65,34 @@ def main():
     db.create_database()
 
     db.set_coins(config.SUPPORTED_COIN_LIST)
+    # Coins no longer supported keep their price streamed as long as they are valued
+    manager.stream_manager.set_ticker_symbols(
+        ticker_symbols([coin.symbol for coin in db.get_coins(only_enabled=False)], config.BRIDGE.symbol)
+    )
     db.migrate_old_state()
 
     trader.initialize()
 
     schedule = SafeScheduler(logger)
-    schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(trader.scout).tag("scouting")
+    if config.SCOUT_ON_TICK != "yes":
+        schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(trader.scout).tag("scouting")
     schedule.every(1).minutes.do(trader.update_values).tag("updating value history")
     schedule.every(1).minutes.do(db.prune_scout_history).tag("pruning scout history")
     schedule.every(1).hours.do(db.prune_value_history).tag("pruning value history")
+    schedule.every(1).minutes.do(trader.flush_ratios).tag("persisting ratios")
+    schedule.every(10).minutes.do(manager.stream_manager.log_stats).tag("logging stream stats")
+    schedule.every(10).minutes.do(manager.binance_client.log_stats).tag("logging request stats")
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        if config.SCOUT_ON_TICK == "yes":
+            scout_on_ticks(trader, manager, schedule, logger, config)
+        else:
+            while True:
+                schedule.run_pending()
+                time.sleep(1)
     finally:
+        trader.flush_ratios()
+        db.close()
+        manager.exchange_info.close()
+        if manager.jump_executor is not None:
+            manager.jump_executor.close()
         manager.stream_manager.close()
@@ -3,7 +3,7 @@ import os
 import time
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from socketio import Client
 from socketio.exceptions import ConnectionError as SocketIOConnectionError
@@ -13,6 +13,7 @@ from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from .config import Config
 from .logger import Logger
 from .models import *  # pylint: disable=wildcard-import
+from .scout_history_writer import ScoutHistoryWriter, ScoutRecord, ScoutSampler
 
 
 class Database:
@@ -22,6 +23,14 @@ class Database:
         self.engine = create_engine(uri)
         self.SessionMaker = sessionmaker(bind=self.engine)
         self.socketio_client = Client()
+        self.scout_writer = ScoutHistoryWriter(
+            self,
+            logger,
+            ScoutSampler(config.SCOUT_HISTORY_POLICY, config.SCOUT_HISTORY_INTERVAL),
+            batch_size=config.SCOUT_HISTORY_BATCH_SIZE,
+            flush_interval=config.SCOUT_HISTORY_FLUSH_INTERVAL,
+            max_pending=config.SCOUT_HISTORY_MAX_PENDING,
+        )
 
     def socketio_connect(self):
         if self.socketio_client.connected and self.socketio_client.namespaces:
@@ -137,6 +146,26 @@ class Database:
             session.expunge_all()
             return pairs
 
+    def get_pairs_to(self, to_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
+        to_coin = self.get_coin(to_coin)
+        session: Session
+        with self.db_session() as session:
+            pairs = session.query(Pair).filter(Pair.to_coin == to_coin)
+            if only_enabled:
+                pairs = pairs.filter(Pair.enabled.is_(True))
+            pairs = pairs.all()
+            session.expunge_all()
+            return pairs
+
+    def set_pair_ratios(self, ratios: Dict[Pair, Optional[float]]):
+        """
+        Store new ratios for the given pairs in a single transaction
+        """
+        session: Session
+        with self.db_session() as session:
+            for pair, ratio in ratios.items():
+                session.query(Pair).filter(Pair.id == pair.id).update({Pair.ratio: ratio})
+
     def get_pairs(self, only_enabled=True) -> List[Pair]:
         session: Session
         with self.db_session() as session:
@@ -154,12 +183,47 @@ class Database:
         current_coin_price: float,
         other_coin_price: float,
     ):
+        """
+        Queue a scout for the scout history, it is written in the background along with other scouts
+        """
+        self.scout_writer.submit(pair, target_ratio, current_coin_price, other_coin_price)
+
+    def insert_scouts(self, scouts: List[ScoutRecord]):
+        """
+        Insert scout history rows in a single transaction
+        """
+        session: Session
+        with self.db_session() as session:
+            session.bulk_insert_mappings(
+                ScoutHistory,
+                [
+                    {
+                        "pair_id": scout.pair.id,
+                        "target_ratio": scout.target_ratio,
+                        "current_coin_price": scout.current_coin_price,
+                        "other_coin_price": scout.other_coin_price,
+                        "datetime": scout.datetime,
+                    }
+                    for scout in scouts
+                ],
+            )
+
+    def log_coin_values(self, coin_values: List[CoinValue]):
+        """
+        Insert coin value history rows in a single transaction
+        """
         session: Session
         with self.db_session() as session:
-            pair = session.merge(pair)
-            sh = ScoutHistory(pair, target_ratio, current_coin_price, other_coin_price)
-            session.add(sh)
-            self.send_update(sh)
+            for coin_value in coin_values:
+                coin_value.coin = session.merge(coin_value.coin)
+                session.add(coin_value)
+                self.send_update(coin_value)
+
+    def close(self):
+        """
+        Write out what is still buffered
+        """
+        self.scout_writer.close()
 
     def prune_scout_history(self):
         time_diff = datetime.now() - timedelta(hours=self.config.SCOUT_HISTORY_PRUNE_TIME)
@@ -271,6 +335,8 @@ class TradeLog:
             session.add(self.trade)
             # Flush so that SQLAlchemy fills in the id column
             session.flush()
+            # The trade is expired once the session commits and detached once it closes
+            self.client_order_prefix = f"btb-{self.trade.id}-{int(self.trade.datetime.timestamp())}"
             self.db.send_update(self.trade)
 
     def set_ordered(self, alt_starting_balance, crypto_starting_balance, alt_trade_amount):
@@ -291,6 +357,13 @@ class TradeLog:
             trade.state = TradeState.COMPLETE
             self.db.send_update(trade)
 
+    def set_failed(self):
+        session: Session
+        with self.db.db_session() as session:
+            trade: Trade = session.merge(self.trade)
+            trade.state = TradeState.FAILED
+            self.db.send_update(trade)
+
 
 if __name__ == "__main__":
     database = Database(Logger(), Config())
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from binance.client import Client
+
+from .logger import Logger
+
+# Snapshots older than this are refetched instead of being used on startup
+MAX_AGE = 43200
+REFRESH_INTERVAL = 3600
+
+
+class ExchangeInfoCache:
+    """
+    Snapshot of the exchange info of every symbol, indexed by symbol and filter type.
+
+    Order placement reads symbol precisions and filters (LOT_SIZE, MIN_NOTIONAL, PRICE_FILTER...)
+    from here instead of asking the exchange for them. The snapshot is fetched with a single
+    `get_exchange_info` call, refreshed by a background thread and saved to `path` (unless it is
+    None), so a restart within MAX_AGE seconds doesn't fetch it at all. Symbols missing from the
+    snapshot, e.g. listed since, are fetched on their own. Without `preload` only those are fetched,
+    for simulations that touch a handful of symbols.
+    """
+
+    def __init__(
+        self, client: Client, logger: Logger, path: Optional[str] = "data/exchange_info.json", preload=True
+    ):
+        self.client = client
+        self.logger = logger
+        self.path = path
+        self.fetched = 0.0
+        self.symbols: Optional[Dict[str, dict]] = None if preload else {}
+        self.filters: Dict[str, Dict[str, dict]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _index(self, symbols: Dict[str, dict], fetched: float):
+        # Built aside and swapped in whole, so readers never see a half updated snapshot
+        filters = {symbol: {f["filterType"]: f for f in info["filters"]} for symbol, info in symbols.items()}
+        self.symbols, self.filters, self.fetched = symbols, filters, fetched
+
+    def load(self):
+        """
+        Use the snapshot on disk if it is recent enough, fetch a new one otherwise
+        """
+        snapshot = None
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Ignoring unreadable exchange info snapshot {self.path}: {e}")
+        if snapshot is not None and time.time() - snapshot["fetched"] < MAX_AGE:
+            self._index(snapshot["symbols"], snapshot["fetched"])
+            return
+        try:
+            self.refresh()
+        except Exception:  # pylint: disable=broad-except
+            if snapshot is None:
+                raise
+            self.logger.warning("Couldn't fetch the exchange info, using an outdated snapshot")
+            self._index(snapshot["symbols"], snapshot["fetched"])
+
+    def refresh(self):
+        """
+        Fetch a new snapshot of every symbol and save it
+        """
+        with self._lock:
+            fetched = time.time()
+            symbols = {info["symbol"]: info for info in self.client.get_exchange_info()["symbols"]}
+            self._index(symbols, fetched)
+            self.logger.debug(f"Fetched exchange info of {len(symbols)} symbols")
+            if self.path is None:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"fetched": fetched, "symbols": symbols}, f)
+            os.replace(tmp_path, self.path)
+
+    def get(self, symbol: str) -> dict:
+        """
+        :return: The exchange info of a symbol, as returned by `Client.get_symbol_info`
+        """
+        if self.symbols is None:
+            self.load()
+        info = self.symbols.get(symbol)
+        if info is None:
+            info = self.client.get_symbol_info(symbol)
+            if info is None:
+                raise KeyError(f"Unknown symbol {symbol}")
+            self.symbols[symbol] = info
+            self.filters[symbol] = {f["filterType"]: f for f in info["filters"]}
+        return info
+
+    def get_filter(self, symbol: str, filter_type: str) -> dict:
+        filters = self.filters.get(symbol)
+        if filters is None:
+            self.get(symbol)
+            filters = self.filters[symbol]
+        return filters[filter_type]
+
+    def start(self, interval: float = REFRESH_INTERVAL):
+        """
+        Load the snapshot, unless it already is, and keep it up to date from a background thread
+        """
+        if self.symbols is None:
+            self.load()
+        self._thread = threading.Thread(target=self._refresh_periodically, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _refresh_periodically(self, interval: float):
+        while not self._stop.wait(max(self.fetched + interval - time.time(), 0)):
+            try:
+                self.refresh()
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.warning(f"Couldn't refresh the exchange info: {e}")
+                self._stop.wait(60)
+
+    def close(self):
+        self._stop.set()
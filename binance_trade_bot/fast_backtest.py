@@ -0,0 +1,252 @@
+import math
+from datetime import datetime
+from traceback import format_exc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .auto_trader import AutoTrader
+from .config import Config
+from .database import Database
+from .kline_store import NOT_CACHED, to_minute
+from .logger import Logger
+from .models import Coin, Pair
+
+# Upper bound of simulated scouts whose prices are held in memory at once
+MAX_BLOCK = 10080
+
+
+class FastScoutEngine:
+    """
+    Vectorized stand-in for calling `trader.scout()` every simulated interval with the default strategy.
+
+    As long as the current coin doesn't change, neither do the pair ratios it is compared against, so
+    the `AutoTrader._get_ratios` scores of a whole block of minutes are computed at once on a NumPy
+    price matrix. Only the first minute where a score turns positive is handed back to the trader,
+    which performs the jump exactly like a regular scout would.
+    """
+
+    def __init__(self, manager, trader: AutoTrader, db: Database, logger: Logger, config: Config, interval=1):
+        self.manager = manager
+        self.trader = trader
+        self.db = db
+        self.logger = logger
+        self.config = config
+        self.interval = interval
+        self.coins = db.get_coins()
+        self.columns = {coin.symbol: j for j, coin in enumerate(self.coins)}
+
+    def load_prices(self, minutes: np.ndarray) -> np.ndarray:
+        """
+        Price matrix of every coin against the bridge, one row per minute, NaN where there is no price
+        """
+        prices = np.empty((len(minutes), len(self.coins)))
+        for j, coin in enumerate(self.coins):
+            symbol = coin + self.config.BRIDGE
+            series = self.manager.cache.series(symbol)
+            missing = series.missing_ranges(int(minutes[0]), int(minutes[-1]) + 1)
+            while missing:
+                start = missing[0][0]
+                self.manager.fetch_klines(symbol, start)
+                missing = series.missing_ranges(start, int(minutes[-1]) + 1)
+                if missing and missing[0][0] == start:
+                    # Prices from the future, which are "no price" for the regular engine too
+                    break
+            column = series.take(minutes)
+            column[column == NOT_CACHED] = np.nan
+            prices[:, j] = column
+        return prices
+
+    def candidates(self, coin: Coin) -> Tuple[List[Pair], np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Pairs the given coin can jump through, with their price columns, ratios and transaction fees
+        """
+        pairs, matrix_columns = self.trader.ratio_matrix.pairs_from(coin)
+        columns = np.array([self.columns[pair.to_coin.symbol] for pair in pairs], dtype=int)
+        ratios = self.trader.ratio_matrix.row(coin)[matrix_columns] if pairs else np.empty(0)
+        from_fee = self.manager.get_fee(coin, self.config.BRIDGE, True)
+        to_fees = self.manager.get_fees([pair.to_coin for pair in pairs], self.config.BRIDGE, False)
+        return pairs, columns, ratios, from_fee + to_fees - from_fee * to_fees
+
+    def scores(
+        self, prices: np.ndarray, coin: Coin, columns: np.ndarray, ratios: np.ndarray, fees: np.ndarray, multiplier=None
+    ):
+        """
+        `AutoTrader._get_ratios` for every row of the price matrix, evaluated in the same order of
+        operations so the results are bit-for-bit identical. An array of multipliers shaped (n, 1, 1)
+        scores n multipliers at once.
+        """
+        optional_coin_ratio = prices[:, self.columns[coin.symbol], None] / prices[:, columns]
+        if self.config.USE_MARGIN == "yes":
+            return optional_coin_ratio / ratios * (1 - fees) - 1 - self.config.SCOUT_MARGIN / 100
+        if multiplier is None:
+            multiplier = self.config.SCOUT_MULTIPLIER
+        return optional_coin_ratio * (1 - fees * multiplier) - ratios
+
+    def steps(self, end_date: datetime) -> int:
+        """
+        Number of scouts the regular engine would run between the current simulated time and end_date
+        """
+        return max(math.ceil((to_minute(end_date) - self.manager.minute) / self.interval), 0)
+
+    def jump(self, start_minute: int, n: int, coin: Coin, pair: Pair):
+        """
+        Let the trader jump through the given pair at the n-th scout
+        """
+        self.manager.minute = start_minute + n * self.interval
+        self.logger.info(f"best_pair: {pair}")
+        self.logger.info(f"Will be jumping from {coin} to {pair.to_coin_id}")
+        try:
+            self.trader.transaction_through_bridge(pair)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.warning(format_exc())
+
+    def run(self, end_date: datetime, yield_interval: int):
+        """
+        Simulate up to end_date, yielding the manager and trader every yield_interval scouts
+        """
+        start_minute = self.manager.minute
+        steps = self.steps(end_date)
+
+        coin = self.db.get_current_coin()
+        pairs, columns, ratios, fees = self.candidates(coin)
+        n = 0
+        try:
+            while n < steps:
+                end = min(steps, (n // yield_interval + 1) * yield_interval, n + MAX_BLOCK)
+                prices = self.load_prices(start_minute + np.arange(n, end) * self.interval)
+                scores = self.scores(prices, coin, columns, ratios, fees)
+                positive = scores > 0
+                jumps = np.flatnonzero(positive.any(axis=1))
+                if len(jumps) == 0:
+                    n = end
+                else:
+                    row = int(jumps[0])
+                    n += row
+                    self.jump(start_minute, n, coin, pairs[best_pair(positive[row], scores[row])])
+                    coin = self.db.get_current_coin()
+                    pairs, columns, ratios, fees = self.candidates(coin)
+                    n += 1
+                if n % yield_interval == 0:
+                    self.manager.minute = start_minute + n * self.interval
+                    yield self.manager, self.trader
+        except KeyboardInterrupt:
+            pass
+        self.manager.minute = start_minute + n * self.interval
+
+
+def best_pair(positive: np.ndarray, scores: np.ndarray) -> int:
+    """
+    Index of the best positive score, ties going to the first pair like max() over the ratio dict
+    """
+    return int(np.argmax(np.where(positive, scores, -np.inf)))
+
+
+class BacktestState:
+    """
+    Snapshot of everything the future of a simulated trader depends on: balances, current coin,
+    pair ratios and the trade ledger so far
+    """
+
+    def __init__(self, manager, trader: AutoTrader, db: Database):
+        self.balances = dict(manager.balances)
+        self.current_coin = db.get_current_coin().symbol
+        self.ratios = trader.ratio_matrix.snapshot()
+        self.ledger = trader.ledger.copy()
+
+    def restore(self, manager, trader: AutoTrader, db: Database):
+        manager.balances = dict(self.balances)
+        # The trader of a fresh context hasn't been initialized, its matrix still has to be built
+        trader.ratio_matrix.load()
+        trader.ratio_matrix.restore(self.ratios)
+        db.set_current_coin(self.current_coin)
+        trader.ledger = self.ledger.copy()
+
+
+class ForkingScoutEngine(FastScoutEngine):
+    """
+    Simulates the default strategy for several scout multipliers at once.
+
+    Variants that took the same jumps so far are in the same state, so they share one simulation and
+    the scores of all their multipliers are evaluated on the same price blocks. At the first scout
+    where the multipliers disagree, the state is snapshotted and every other group of agreeing
+    multipliers continues from it in a fresh context created by `spawn`.
+    """
+
+    def __init__(
+        self,
+        manager,
+        trader: AutoTrader,
+        db: Database,
+        logger: Logger,
+        config: Config,
+        multipliers: List[float],
+        spawn: Callable[[float], FastScoutEngine],
+        interval=1,
+    ):
+        super().__init__(manager, trader, db, logger, config, interval)
+        self.multipliers = list(multipliers)
+        self.spawn = spawn
+
+    def run(self, end_date: datetime) -> Dict[float, FastScoutEngine]:  # pylint: disable=arguments-differ
+        """
+        Simulate every multiplier up to end_date
+
+        :return: The engine holding the final manager and trader of each multiplier
+        """
+        start_minute = self.manager.minute
+        steps = self.steps(end_date)
+        results: Dict[float, FastScoutEngine] = {}
+        branches = [(self, self.multipliers, 0)]
+        while branches:
+            engine, multipliers, n = branches.pop()
+            for multiplier in self._run_branch(engine, multipliers, n, start_minute, steps, branches):
+                results[multiplier] = engine
+        return results
+
+    def _run_branch(self, engine: FastScoutEngine, multipliers: List[float], n: int, start_minute, steps, branches):
+        """
+        Simulate the multipliers sharing the given engine's state from the n-th scout on, pushing
+        the groups that split off onto branches
+
+        :return: The multipliers still sharing the engine at the end
+        """
+        block = max(MAX_BLOCK // len(multipliers), 1440)
+        coin = engine.db.get_current_coin()
+        pairs, columns, ratios, fees = engine.candidates(coin)
+        while n < steps:
+            end = min(steps, n + block)
+            prices = self.load_prices(start_minute + np.arange(n, end) * self.interval)
+            scores = engine.scores(prices, coin, columns, ratios, fees, np.array(multipliers)[:, None, None])
+            scores = np.broadcast_to(scores, (len(multipliers),) + scores.shape[-2:])
+            positive = scores > 0
+            hits = positive.any(axis=2)
+            if not hits.any():
+                n = end
+                continue
+
+            # First scout where any multiplier jumps, and where each multiplier goes at that scout
+            rows = np.where(hits.any(axis=1), hits.argmax(axis=1), end - n)
+            row = int(rows.min())
+            groups: Dict[Optional[int], List[float]] = {}
+            for i, multiplier in enumerate(multipliers):
+                choice = best_pair(positive[i, row], scores[i, row]) if rows[i] == row else None
+                groups.setdefault(choice, []).append(multiplier)
+            n += row
+
+            choice, multipliers = next(iter(groups.items()))
+            if len(groups) > 1:
+                state = BacktestState(engine.manager, engine.trader, engine.db)
+                for fork_choice, fork_multipliers in list(groups.items())[1:]:
+                    fork = self.spawn(fork_multipliers[0])
+                    state.restore(fork.manager, fork.trader, fork.db)
+                    if fork_choice is not None:
+                        fork.jump(start_minute, n, coin, pairs[fork_choice])
+                    branches.append((fork, fork_multipliers, n + 1))
+            if choice is not None:
+                engine.jump(start_minute, n, coin, pairs[choice])
+                coin = engine.db.get_current_coin()
+                pairs, columns, ratios, fees = engine.candidates(coin)
+            n += 1
+        engine.manager.minute = start_minute + steps * self.interval
+        return multipliers
@@ -0,0 +1,141 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .models import Coin
+
+if TYPE_CHECKING:
+    from .binance_api_manager import BinanceAPIManager
+
+BNB_DISCOUNT = 0.75
+# How far prices may move before a fee computed with the BNB discount (or without it) is recomputed
+PRICE_BAND = 0.01
+
+
+class FeeModel:
+    """
+    Effective taker fees of a BinanceAPIManager, computed once and kept until their inputs change.
+
+    A fee only changes with the trade fees, the BNB burn setting, the balances, and the prices the
+    BNB discount check depends on. Fees are dropped when the trade fees are refetched, the burn
+    setting flips, the balances version of the manager cache moves or the price of BNB leaves a
+    band around the one they were computed at. Sell fees also keep the price of the coin in BNB they
+    were computed at, and fees whose BNB balance is too close to the discount threshold are
+    recomputed on every read. Everything else is a dict lookup, and fee vectors over a fixed list
+    of coins are returned as they are.
+    """
+
+    def __init__(self, manager: "BinanceAPIManager", price_band: float = PRICE_BAND):
+        self.manager = manager
+        self.price_band = price_band
+        self._trade_fees: Optional[Dict[str, float]] = None
+        self._using_bnb: Optional[bool] = None
+        self._balances_version: Optional[int] = None
+        self._bnb_prices: Dict[str, float] = {}
+        self._fees: Dict[Tuple[str, str, bool], float] = {}
+        self._sell_prices: Dict[Tuple[str, str, bool], float] = {}
+        self._marginal: Set[Tuple[str, str, bool]] = set()
+        self._vectors: Dict[Tuple[Tuple[str, ...], str, bool], np.ndarray] = {}
+
+    def invalidate(self):
+        self._fees.clear()
+        self._sell_prices.clear()
+        self._marginal.clear()
+        self._vectors.clear()
+        self._bnb_prices.clear()
+
+    def _in_band(self, reference: float, price) -> bool:
+        return isinstance(price, float) and abs(price / reference - 1) <= self.price_band
+
+    def _validate(self, target_coin: Coin):
+        trade_fees = self.manager.get_trade_fees()
+        using_bnb = self.manager.get_using_bnb_for_fees()
+        balances_version = self.manager.cache.balances_version
+        if (
+            trade_fees is not self._trade_fees
+            or using_bnb != self._using_bnb
+            or balances_version != self._balances_version
+        ):
+            self.invalidate()
+            self._trade_fees = trade_fees
+            self._using_bnb = using_bnb
+            self._balances_version = balances_version
+        if not using_bnb:
+            return
+
+        bnb_price = self.manager.get_ticker_price(Coin("BNB") + target_coin)
+        reference = self._bnb_prices.get(target_coin.symbol)
+        if reference is not None and not self._in_band(reference, bnb_price):
+            self.invalidate()
+            reference = None
+        if reference is None and isinstance(bnb_price, float):
+            self._bnb_prices[target_coin.symbol] = bnb_price
+
+    def _compute(self, origin_coin: Coin, target_coin: Coin, selling: bool) -> Tuple[float, float, Optional[float]]:
+        """
+        :return: The fee, how many times over the BNB balance covers the discounted fee, and the price
+        of the origin coin in BNB the check used
+        """
+        base_fee = self._trade_fees[origin_coin + target_coin]
+        if not self._using_bnb:
+            return base_fee, float("inf"), None
+
+        # The discount is only applied if we have enough BNB to cover the fee
+        amount_trading = (
+            self.manager._sell_quantity(origin_coin.symbol, target_coin.symbol)  # pylint: disable=protected-access
+            if selling
+            else self.manager._buy_quantity(origin_coin.symbol, target_coin.symbol)  # pylint: disable=protected-access
+        )
+
+        fee_amount = amount_trading * base_fee * BNB_DISCOUNT
+        origin_price = None
+        if origin_coin.symbol == "BNB":
+            fee_amount_bnb = fee_amount
+        else:
+            origin_price = self.manager.get_ticker_price(origin_coin + Coin("BNB"))
+            if origin_price is None:
+                return base_fee, float("inf"), None
+            fee_amount_bnb = fee_amount * origin_price
+
+        bnb_balance = self.manager.get_currency_balance("BNB")
+        coverage = bnb_balance / fee_amount_bnb if fee_amount_bnb else float("inf")
+
+        if bnb_balance >= fee_amount_bnb:
+            return base_fee * BNB_DISCOUNT, coverage, origin_price
+        return base_fee, coverage, origin_price
+
+    def get(self, origin_coin: Coin, target_coin: Coin, selling: bool) -> float:
+        self._validate(target_coin)
+        key = (origin_coin.symbol, target_coin.symbol, selling)
+        fee = self._fees.get(key)
+        if fee is not None and key not in self._marginal:
+            # What is sold is valued in BNB at the price of the coin, which the BNB band doesn't cover
+            reference = self._sell_prices.get(key)
+            if reference is None or self._in_band(reference, self.manager.get_ticker_price(origin_coin + Coin("BNB"))):
+                return fee
+
+        fee, coverage, origin_price = self._compute(origin_coin, target_coin, selling)
+        self._fees[key] = fee
+        if 1 - self.price_band < coverage < 1 + self.price_band:
+            self._marginal.add(key)
+        else:
+            self._marginal.discard(key)
+        if selling and origin_price is not None:
+            self._sell_prices[key] = origin_price
+        return fee
+
+    def vector(self, coins: List[Coin], target_coin: Coin, selling: bool) -> np.ndarray:
+        """
+        Fees of trading each of the given coins against the target coin
+        """
+        self._validate(target_coin)
+        key = (tuple(coin.symbol for coin in coins), target_coin.symbol, selling)
+        fees = self._vectors.get(key)
+        if fees is not None:
+            return fees
+
+        fees = np.array([self.get(coin, target_coin, selling) for coin in coins])
+        # Only fees that stay valid until the next invalidation can be served from a stored vector
+        if not selling and self._marginal.isdisjoint((coin.symbol, target_coin.symbol, selling) for coin in coins):
+            self._vectors[key] = fees
+        return fees
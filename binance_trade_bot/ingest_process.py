@@ -0,0 +1,175 @@
+import multiprocessing
+import queue
+import threading
+from typing import Iterable, List, Sequence, Tuple
+
+import binance.client
+
+from .binance_stream_manager import BinanceOrder, BinanceStreamManager, TickTrigger
+from .config import Config
+from .exchange_info import ExchangeInfoCache
+from .logger import Logger
+from .rate_limited_client import RateLimitedClient
+from .shared_cache import SharedCacheReader, SharedCacheWriter, SharedTables
+
+# Seconds the ingest process gets to connect and take its first price snapshot
+READY_TIMEOUT = 60
+# Seconds to wait for a price snapshot asked for by the trading process
+SNAPSHOT_TIMEOUT = 10
+
+
+class ForwardingTickTrigger(TickTrigger):
+    """
+    Sends the price changes of the ingest process to the trading process, which knows which symbols are watched
+    """
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def notify(self, symbols: Iterable[str]):
+        symbols = list(symbols)
+        if symbols:
+            self.events.put(("ticks", symbols))
+
+
+class IngestingStreamManager(BinanceStreamManager):
+    """
+    BinanceStreamManager of the ingest process. Pending orders are known to the trading process,
+    which fetches them itself when the user data stream reconnects.
+    """
+
+    def _create_tick_trigger(self) -> TickTrigger:
+        return ForwardingTickTrigger(self.cache.events)
+
+    def _fetch_pending_orders(self):
+        self.cache.events.put(("fetch_pending_orders",))
+
+
+def run_ingest(
+    names: Tuple[str, str, str], symbols: List[str], assets: List[str], commands, events, ready
+):  # pylint: disable=too-many-arguments
+    """
+    Entry point of the ingest process: own the websocket streams and publish what they bring to the shared
+    tables, until the trading process asks to stop
+    """
+    logger = Logger("ingest_process")
+    config = Config()
+    # Both processes correct their weight estimate with the weight the exchange reports for the IP
+    client = RateLimitedClient(
+        config.BINANCE_API_KEY,
+        config.BINANCE_API_SECRET_KEY,
+        tld=config.BINANCE_TLD,
+        weight_limit=config.REQUEST_WEIGHT_LIMIT,
+        logger=logger,
+    )
+    tables = SharedTables.attach(names, symbols, assets)
+    cache = SharedCacheWriter(tables, events)
+    stream_manager = IngestingStreamManager(cache, config, client, logger)
+    # Retried by the stream processor if it fails
+    stream_manager.refresh_ticker_snapshot()
+    ready.set()
+    logger.info("Ingest process started")
+
+    try:
+        while True:
+            command, *args = commands.get()
+            if command == "stop":
+                break
+            if command == "ticker_symbols":
+                stream_manager.set_ticker_symbols(args[0])
+            elif command == "refresh_tickers":
+                stream_manager.refresh_ticker_snapshot()
+            elif command == "load_balances":
+                cache.load_balances(*args)
+            elif command == "invalidate_balances":
+                cache.invalidate_balances()
+            elif command == "log_stats":
+                stream_manager.log_stats()
+    finally:
+        stream_manager.close()
+        tables.close()
+
+
+class IngestStreamManager(BinanceStreamManager):
+    """
+    Stands in for BinanceStreamManager in the trading process when the streams are ingested by another process.
+
+    The ingest process owns the websockets and the stream processor and writes prices, book tickers, balances
+    and the cache state to shared memory tables, which the cache of this process reads without locking.
+    Order updates, balance changes and price ticks come back on an events queue, applied by a thread here,
+    so ingestion keeps its pace whatever the trading process is busy with.
+    """
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self, config: Config, binance_client: binance.client.Client, logger: Logger, exchange_info: ExchangeInfoCache
+    ):
+        self.logger = logger
+        self.binance_client = binance_client
+        if exchange_info.symbols is None:
+            exchange_info.load()
+        symbols: Sequence[str] = sorted(exchange_info.symbols)
+        assets = sorted(
+            {info["baseAsset"] for info in exchange_info.symbols.values()}
+            | {info["quoteAsset"] for info in exchange_info.symbols.values()}
+        )
+
+        context = multiprocessing.get_context("spawn")
+        self.tables = SharedTables.create(symbols, assets)
+        self.commands = context.Queue()
+        self.events = context.Queue()
+        ready = context.Event()
+        self.cache = SharedCacheReader(self.tables, self.commands)
+        self.ticks = TickTrigger()
+        self.pending_orders = set()
+        self.pending_orders_mutex = threading.Lock()
+        self.process = context.Process(
+            target=run_ingest,
+            args=(self.tables.names(), symbols, assets, self.commands, self.events, ready),
+            name="ingest",
+            daemon=True,
+        )
+        self.process.start()
+        self._events_thread = threading.Thread(target=self._process_events, name="ingest-events", daemon=True)
+        self._events_thread.start()
+        if not ready.wait(READY_TIMEOUT):
+            self.logger.warning("Ingest process isn't ready yet, prices may be missing until it is")
+
+    def set_ticker_symbols(self, symbols: Iterable[str]):
+        self.commands.put(("ticker_symbols", frozenset(symbols)))
+
+    def log_stats(self):
+        self.commands.put(("log_stats",))
+
+    def refresh_ticker_snapshot(self):
+        self.commands.put(("refresh_tickers",))
+        self.cache.wait_for_ticker_snapshot(SNAPSHOT_TIMEOUT)
+
+    def _process_events(self):
+        while True:
+            try:
+                event, *args = self.events.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    self.logger.error("Ingest process died, prices and balances aren't updated anymore")
+                    return
+                continue
+            if event == "stop":
+                return
+            if event == "order":
+                self.cache.set_order(BinanceOrder(args[0]))
+            elif event == "balances":
+                self.cache.notify_balances()
+            elif event == "ticker_snapshot":
+                self.cache.notify_ticker_snapshot()
+            elif event == "ticks":
+                self.ticks.notify(args[0])
+            elif event == "fetch_pending_orders":
+                self._fetch_pending_orders()
+
+    def close(self):
+        self.commands.put(("stop",))
+        self.process.join(10)
+        self.events.put(("stop",))
+        self._events_thread.join()
+        self.tables.close()
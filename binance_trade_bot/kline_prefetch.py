@@ -0,0 +1,128 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Iterable, List, Optional, Set, Tuple
+
+from binance.exceptions import BinanceAPIException
+
+from .kline_store import TIMEFRAME_MINUTES, KlineStore, to_minute
+from .logger import Logger
+
+# Binance error code for an unknown symbol
+INVALID_SYMBOL = -1121
+
+
+def backtest_symbols(coins: Iterable[str], bridge: str, valuation=True) -> List[str]:
+    """
+    Symbols a backtest over the given coins reads prices of: every coin against the bridge and,
+    for valuing the balances in BTC, every coin against BTC
+    """
+    symbols = [coin + bridge for coin in coins]
+    if valuation:
+        symbols += [coin + "BTC" for coin in coins if coin != "BTC"]
+        symbols.append("BTC" + bridge)
+    return list(dict.fromkeys(symbols))
+
+
+class KlinePrefetcher:
+    """
+    Fills the gaps of a KlineStore for a whole backtest before it starts.
+
+    Missing [start, end) ranges are split into windows of 1000 candles which are downloaded on a
+    bounded thread pool, while all writes to the store happen on the calling thread and are
+    committed in batches. Windows an old SqliteDict cache of the store can fill aren't downloaded
+    at all. The store itself tracks what was fetched, so an interrupted prefetch
+    resumes where it stopped. The client only needs a python-binance compatible
+    `get_historical_klines`, so a local fake can stand in for Binance.
+    """
+
+    def __init__(
+        self,
+        client,
+        store: KlineStore,
+        logger: Logger,
+        workers=4,
+        timeframe="1m",
+        commit_every=50,
+        progress_interval=10,
+    ):
+        self.client = client
+        self.store = store
+        self.logger = logger
+        self.workers = workers
+        self.timeframe = timeframe
+        self.commit_every = commit_every
+        self.progress_interval = progress_interval
+        self.invalid_symbols: Set[str] = set()
+
+    def plan(self, symbols: Iterable[str], start_minute: int, end_minute: int) -> List[Tuple[str, int, int]]:
+        """
+        :return: (symbol, start, end) windows of at most 1000 candles that aren't cached yet
+        """
+        end_minute = min(end_minute, to_minute(datetime.utcnow()))
+        window = 1000 * TIMEFRAME_MINUTES[self.timeframe]
+        windows = []
+        for symbol in symbols:
+            for start, end in self.store.series(symbol, self.timeframe).missing_ranges(start_minute, end_minute):
+                windows.extend((symbol, w, min(w + window, end)) for w in range(start, end, window))
+        return windows
+
+    def _fetch(self, symbol: str, start_minute: int, end_minute: int) -> Optional[list]:
+        if symbol in self.invalid_symbols:
+            return None
+        try:
+            return self.client.get_historical_klines(
+                symbol, self.timeframe, start_minute * 60000, end_minute * 60000 - 1, limit=1000
+            )
+        except BinanceAPIException as e:
+            if e.code != INVALID_SYMBOL:
+                raise
+            if symbol not in self.invalid_symbols:
+                self.invalid_symbols.add(symbol)
+                self.logger.warning(f"Symbol {symbol} does not exist, its prices won't be prefetched")
+            return None
+
+    def run(self, symbols: Iterable[str], start_minute: int, end_minute: int) -> int:
+        """
+        Download every window of the given symbols and range which isn't cached yet
+
+        :return: The number of windows stored
+        """
+        symbols = list(symbols)
+        windows = [
+            window
+            for window in self.plan(symbols, start_minute, end_minute)
+            if not self.store.fill_from_legacy(*window, self.timeframe)
+        ]
+        if not windows:
+            self.logger.info(f"Prices of {len(symbols)} symbols are already cached")
+            return 0
+
+        self.logger.info(f"Prefetching {len(windows)} kline windows for {len(symbols)} symbols")
+        stored = 0
+        last_report = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self._fetch, *window): window for window in windows}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                symbol, start, end = futures[future]
+                try:
+                    klines = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    self.logger.warning(f"Failed to fetch {symbol} klines, they will be fetched lazily: {e}")
+                    continue
+                if klines is None:
+                    continue
+                self.store.put_klines(symbol, klines, start, end, self.timeframe)
+                stored += 1
+                if stored % self.commit_every == 0:
+                    self.store.commit()
+                if time.monotonic() - last_report >= self.progress_interval or done == len(windows):
+                    last_report = time.monotonic()
+                    self.logger.info(f"Prefetched {done}/{len(windows)} kline windows ({done * 100 // len(windows)}%)")
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.store.commit()
+        return stored
@@ -0,0 +1,304 @@
+import calendar
+import math
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# 2017-01-01 00:00 UTC in minutes since the epoch, earlier than any kline Binance can return
+BASE_MINUTE = 24720480
+# Files are grown sparsely, so a slot nobody has written to yet reads as 0.0
+NOT_CACHED = 0.0
+# Grow files by at least 30 days of 1m klines at a time to keep remapping rare
+GROW_CHUNK = 43200
+TIMEFRAME_MINUTES = {
+    "1m": 1,
+    "3m": 3,
+    "5m": 5,
+    "15m": 15,
+    "30m": 30,
+    "1h": 60,
+    "2h": 120,
+    "4h": 240,
+    "6h": 360,
+    "8h": 480,
+    "12h": 720,
+    "1d": 1440,
+}
+LEGACY_DATE_FORMAT = "%d %b %Y %H:%M:%S"
+
+
+def to_minute(dt: datetime) -> int:
+    """
+    Convert a naive UTC datetime to minutes since the epoch
+    """
+    return calendar.timegm(dt.utctimetuple()) // 60
+
+
+def from_minute(minute: int) -> datetime:
+    """
+    Convert minutes since the epoch back to a naive UTC datetime
+    """
+    return datetime.utcfromtimestamp(minute * 60)
+
+
+def legacy_price(key: str, value) -> Tuple[str, int, float]:
+    """
+    Parse an entry of an old SqliteDict backtest cache
+
+    :return: Its symbol, minute and price, NaN for "no price"
+    """
+    symbol, _, date = key.partition(" - ")
+    minute = to_minute(datetime.strptime(date, LEGACY_DATE_FORMAT))
+    return symbol, minute, math.nan if value == "no price" else float(value)
+
+
+class KlineSeries:
+    """
+    A single symbol/timeframe price column backed by a memory-mapped float64 file.
+
+    The price of the candle opened at ``minute`` lives at ``(minute - BASE_MINUTE) // step``.
+    Unfetched slots hold NOT_CACHED and candles Binance has no data for hold NaN, which is how
+    the old "no price" sentinel is stored.
+    """
+
+    def __init__(self, path: str, step: int, readonly=False):
+        self.path = path
+        self.step = step
+        self.readonly = readonly
+        self._mmap: Optional[np.memmap] = None
+        self.prices = self._map()
+
+    def _map(self) -> np.ndarray:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            self._mmap = None
+            return np.zeros(0)
+        # Read-only series are mapped copy-on-write: lazily fetched prices stay private to the process
+        self._mmap = np.memmap(self.path, dtype=np.float64, mode="c" if self.readonly else "r+")
+        # Index through a plain ndarray view, np.memmap.__getitem__ is implemented in Python
+        return self._mmap.view(np.ndarray)
+
+    def index(self, minute: int) -> int:
+        return (minute - BASE_MINUTE) // self.step
+
+    def get(self, minute: int) -> Optional[float]:
+        """
+        :return: the cached price, NaN if the candle has no price, or None if it was never fetched
+        """
+        idx = (minute - BASE_MINUTE) // self.step
+        if 0 <= idx < len(self.prices):
+            price = self.prices.item(idx)
+            if price != NOT_CACHED:
+                return price
+        return None
+
+    def take(self, minutes: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `get`: unfetched candles come back as NOT_CACHED instead of None
+        """
+        idx = (minutes - BASE_MINUTE) // self.step
+        valid = (idx >= 0) & (idx < len(self.prices))
+        prices = np.full(len(idx), NOT_CACHED)
+        prices[valid] = self.prices[idx[valid]]
+        return prices
+
+    def _ensure(self, size: int):
+        if size <= len(self.prices):
+            return
+        size = max(size, len(self.prices) + GROW_CHUNK)
+        if self.readonly:
+            grown = np.zeros(size)
+            grown[: len(self.prices)] = self.prices
+            self.prices = grown
+            return
+        self.flush()
+        self._mmap = None
+        self.prices = np.zeros(0)
+        with open(self.path, "ab") as f:
+            f.truncate(size * 8)
+        self.prices = self._map()
+
+    def write(self, minutes: Iterable[int], prices: Iterable[float]):
+        """
+        Store prices for the given candle open times
+        """
+        idx = (np.fromiter(minutes, dtype=np.int64) - BASE_MINUTE) // self.step
+        values = np.fromiter(prices, dtype=np.float64)
+        keep = idx >= 0
+        idx, values = idx[keep], values[keep]
+        if len(idx) == 0:
+            return
+        self._ensure(int(idx.max()) + 1)
+        self.prices[idx] = values
+
+    def mark_no_price(self, start_minute: int, end_minute: int):
+        """
+        Mark every still unfetched candle in [start_minute, end_minute) as having no price
+        """
+        start = max(self.index(start_minute), 0)
+        end = self.index(end_minute)
+        if end <= start:
+            return
+        self._ensure(end)
+        segment = self.prices[start:end]
+        segment[segment == NOT_CACHED] = np.nan
+
+    def missing_ranges(self, start_minute: int, end_minute: int) -> List[Tuple[int, int]]:
+        """
+        :return: [start, end) minute ranges inside [start_minute, end_minute) that were never fetched
+        """
+        start = max(self.index(start_minute), 0)
+        end = self.index(end_minute)
+        if end <= start:
+            return []
+        missing = np.ones(end - start, dtype=bool)
+        cached = self.prices[start : min(end, len(self.prices))]
+        missing[: len(cached)] = cached == NOT_CACHED
+        # Edges of the runs of missing slots
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], missing, [False])).astype(np.int8)))
+        return [
+            (BASE_MINUTE + (start + int(a)) * self.step, BASE_MINUTE + (start + int(b)) * self.step)
+            for a, b in zip(edges[::2], edges[1::2])
+        ]
+
+    def flush(self):
+        if self._mmap is not None and not self.readonly:
+            self._mmap.flush()
+
+
+class LegacyKlineCache:
+    """
+    Read-only view of an old SqliteDict backtest cache, whose prices are keyed by
+    "SYMBOL - %d %b %Y %H:%M:%S" strings of 1m candle open times.
+    """
+
+    def __init__(self, path="data/backtest_cache.db"):
+        from sqlitedict import SqliteDict  # pylint: disable=import-outside-toplevel
+
+        self.db = SqliteDict(path, flag="r")
+
+    def symbols(self) -> List[str]:
+        """
+        :return: The symbols the cache has prices of
+        """
+        query = f'SELECT DISTINCT substr(key, 1, instr(key, \' - \') - 1) FROM "{self.db.tablename}"'
+        return [symbol for (symbol,) in self.db.conn.select(query)]
+
+    def read_symbol(self, symbol: str) -> Tuple[List[int], List[float]]:
+        """
+        :return: Every minute the cache has a price of the symbol for and the prices, NaN for the ones
+        stored as "no price", read with a single scan of the key range of the symbol
+        """
+        prefix = f"{symbol} - "
+        # The keys of the symbol sort from its prefix up to the prefix with the last character bumped
+        query = f'SELECT key, value FROM "{self.db.tablename}" WHERE key >= ? AND key < ?'
+        minutes, prices = [], []
+        for key, value in self.db.conn.select(query, (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))):
+            _, minute, price = legacy_price(key, self.db.decode(value))
+            minutes.append(minute)
+            prices.append(price)
+        return minutes, prices
+
+    def close(self):
+        self.db.close()
+
+
+class KlineStore:
+    """
+    Directory of memory-mapped KlineSeries, one file per symbol/timeframe.
+
+    When given the path of an old SqliteDict cache, the 1m prices it has of a symbol are copied
+    over in one go the first time one of its candles is missing, before anyone has to ask Binance.
+    """
+
+    def __init__(self, path="data/klines", readonly=False, legacy_path: Optional[str] = None):
+        self.path = path
+        self.readonly = readonly
+        self._series: Dict[Tuple[str, str], KlineSeries] = {}
+        self.legacy = LegacyKlineCache(legacy_path) if legacy_path and os.path.exists(legacy_path) else None
+        # Symbols whose prices were already copied from the legacy cache
+        self._legacy_symbols: Set[str] = set()
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+
+    def series(self, symbol: str, timeframe="1m") -> KlineSeries:
+        key = (symbol, timeframe)
+        series = self._series.get(key)
+        if series is None:
+            series = KlineSeries(
+                os.path.join(self.path, f"{symbol}-{timeframe}.f64"), TIMEFRAME_MINUTES[timeframe], self.readonly
+            )
+            self._series[key] = series
+        return series
+
+    def get(self, symbol: str, minute: int, timeframe="1m") -> Optional[float]:
+        return self.series(symbol, timeframe).get(minute)
+
+    def put_klines(self, symbol: str, klines: List[list], start_minute: int, end_minute: int, timeframe="1m"):
+        """
+        Store the open prices of raw Binance klines fetched for [start_minute, end_minute) and
+        mark the candles Binance didn't return as having no price
+        """
+        series = self.series(symbol, timeframe)
+        series.mark_no_price(start_minute, end_minute)
+        series.write((kline[0] // 60000 for kline in klines), (float(kline[1]) for kline in klines))
+
+    def fill_from_legacy(self, symbol: str, start_minute: int, end_minute: int, timeframe="1m") -> bool:
+        """
+        Copy the prices the legacy cache has of the symbol into the store, unless that was done already
+
+        :return: True if [start_minute, end_minute) no longer needs to be fetched
+        """
+        if self.legacy is None or timeframe != "1m":
+            return False
+        series = self.series(symbol, timeframe)
+        if symbol not in self._legacy_symbols:
+            self._legacy_symbols.add(symbol)
+            minutes, prices = self.legacy.read_symbol(symbol)
+            minutes, prices = np.array(minutes, dtype=np.int64), np.array(prices)
+            # Prices fetched since the legacy cache was written are kept
+            missing = series.take(minutes) == NOT_CACHED
+            series.write(minutes[missing], prices[missing])
+        return not series.missing_ranges(start_minute, end_minute)
+
+    def commit(self):
+        for series in self._series.values():
+            series.flush()
+
+    def close(self):
+        self.commit()
+        self._series.clear()
+        if self.legacy is not None:
+            self.legacy.close()
+            self.legacy = None
+
+
+def migrate_sqlitedict(cache_path="data/backtest_cache.db", store: KlineStore = None) -> int:
+    """
+    Copy the prices of an old string-keyed SqliteDict backtest cache into a KlineStore
+
+    :return: The number of migrated prices
+    """
+    store = store or KlineStore()
+    count = 0
+    legacy = LegacyKlineCache(cache_path)
+    try:
+        for symbol in legacy.symbols():
+            minutes, prices = legacy.read_symbol(symbol)
+            store.series(symbol).write(minutes, prices)
+            count += len(minutes)
+    finally:
+        legacy.close()
+    store.commit()
+    return count
+
+
+if __name__ == "__main__":
+    # python -m binance_trade_bot.kline_store [cache_path] [store_path]
+    args = sys.argv[1:]
+    migrated = migrate_sqlitedict(
+        args[0] if args else "data/backtest_cache.db", KlineStore(args[1] if len(args) > 1 else "data/klines")
+    )
+    print(f"Migrated {migrated} prices")
@@ -0,0 +1,144 @@
+from typing import Dict, List, Optional, Tuple, Union
+
+from .config import Config
+from .database import Database
+from .logger import Logger
+from .models import Coin, CoinValue, Pair
+from .scout_history_writer import ScoutRecord
+
+
+class InMemoryDatabase(Database):
+    """
+    Database without SQL behind it, for simulations.
+
+    Coins, pairs with their ratios and the current coin live in plain dicts, so the per-scout
+    calls of a strategy cost a dict lookup instead of an ORM query and a commit. The returned
+    Coin and Pair objects are transient and shared with the store, ratios are only changed
+    through `set_pair_ratios`. Nothing is logged: scout history, trades and coin values are
+    dropped, like MockDatabase does for scouts.
+    """
+
+    def __init__(self, logger: Logger, config: Config):  # pylint: disable=super-init-not-called
+        self.logger = logger
+        self.config = config
+        self.coins: Dict[str, Coin] = {}
+        self.pairs: Dict[Tuple[str, str], Pair] = {}
+        self._pairs_from: Dict[str, List[Pair]] = {}
+        self._pairs_to: Dict[str, List[Pair]] = {}
+        self.current_coin_symbol: Optional[str] = None
+
+    def socketio_connect(self):
+        return False
+
+    def db_session(self):
+        # Every method of Database that needs a session is implemented without one here
+        raise RuntimeError(
+            "InMemoryDatabase keeps its state in dicts and has no SQL session: "
+            "the Database method asking for one needs an InMemoryDatabase override"
+        )
+
+    def create_database(self):
+        pass
+
+    def send_update(self, model):
+        pass
+
+    def set_coins(self, symbols: List[str]):
+        for symbol, coin in self.coins.items():
+            coin.enabled = symbol in symbols
+        for symbol in symbols:
+            if symbol not in self.coins:
+                self.coins[symbol] = Coin(symbol)
+
+        coins = self.get_coins()
+        for from_coin in coins:
+            for to_coin in coins:
+                if from_coin is not to_coin and (from_coin.symbol, to_coin.symbol) not in self.pairs:
+                    pair = Pair(from_coin, to_coin)
+                    # Foreign keys are only filled in by a session flush
+                    pair.from_coin_id = from_coin.symbol
+                    pair.to_coin_id = to_coin.symbol
+                    self.pairs[(from_coin.symbol, to_coin.symbol)] = pair
+                    self._pairs_from.setdefault(from_coin.symbol, []).append(pair)
+                    self._pairs_to.setdefault(to_coin.symbol, []).append(pair)
+
+    @staticmethod
+    def _enabled(pairs: List[Pair], only_enabled: bool) -> List[Pair]:
+        if not only_enabled:
+            return list(pairs)
+        return [pair for pair in pairs if pair.from_coin.enabled and pair.to_coin.enabled]
+
+    def get_coins(self, only_enabled=True) -> List[Coin]:
+        return [coin for coin in self.coins.values() if coin.enabled or not only_enabled]
+
+    def get_coin(self, coin: Union[Coin, str]) -> Coin:
+        if isinstance(coin, Coin):
+            return coin
+        return self.coins.get(coin)
+
+    def set_current_coin(self, coin: Union[Coin, str]):
+        self.current_coin_symbol = coin.symbol if isinstance(coin, Coin) else coin
+
+    def get_current_coin(self) -> Optional[Coin]:
+        if self.current_coin_symbol is None:
+            return None
+        return self.coins.get(self.current_coin_symbol)
+
+    def get_pair(self, from_coin: Union[Coin, str], to_coin: Union[Coin, str]):
+        from_coin = self.get_coin(from_coin)
+        to_coin = self.get_coin(to_coin)
+        return self.pairs.get((from_coin.symbol, to_coin.symbol))
+
+    def get_pairs_from(self, from_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
+        from_coin = self.get_coin(from_coin)
+        return self._enabled(self._pairs_from.get(from_coin.symbol, []), only_enabled)
+
+    def get_pairs_to(self, to_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
+        to_coin = self.get_coin(to_coin)
+        return self._enabled(self._pairs_to.get(to_coin.symbol, []), only_enabled)
+
+    def get_pairs(self, only_enabled=True) -> List[Pair]:
+        return self._enabled(list(self.pairs.values()), only_enabled)
+
+    def set_pair_ratios(self, ratios: Dict[Pair, Optional[float]]):
+        for pair, ratio in ratios.items():
+            self.pairs[(pair.from_coin_id, pair.to_coin_id)].ratio = ratio
+
+    def log_scout(self, pair: Pair, target_ratio: float, current_coin_price: float, other_coin_price: float):
+        pass
+
+    def log_coin_values(self, coin_values: List[CoinValue]):
+        pass
+
+    def insert_scouts(self, scouts: List[ScoutRecord]):
+        pass
+
+    def prune_scout_history(self):
+        pass
+
+    def close(self):
+        pass
+
+    def prune_value_history(self):
+        pass
+
+    def start_trade_log(self, from_coin: Coin, to_coin: Coin, selling: bool):
+        return NullTradeLog()
+
+    def migrate_old_state(self):
+        pass
+
+
+class NullTradeLog:
+    """
+    TradeLog of an InMemoryDatabase, trades aren't recorded
+    """
+
+    def set_ordered(self, alt_starting_balance, crypto_starting_balance, alt_trade_amount):
+        pass
+
+    def set_complete(self, crypto_trade_amount):
+        pass
+
+    def set_failed(self):
+        pass
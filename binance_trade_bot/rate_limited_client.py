@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from binance import AsyncClient
+from binance.client import Client
+from binance.exceptions import BinanceAPIException
+from requests.adapters import HTTPAdapter
+
+from .logger import Logger
+
+# Request weight allowed per minute and IP by the spot API
+WEIGHT_LIMIT = 6000
+# Part of the weight limit only order requests may use, so informational bursts never starve them
+ORDER_RESERVE = 600
+POOL_SIZE = 10
+# Waiting requests are spread over this many seconds once the weight window resets
+RESET_JITTER = 1.0
+# Weight of the heavier endpoints, anything else is assumed to cost 1 until the response says otherwise
+ESTIMATED_WEIGHTS = {
+    "account": 20,
+    "exchangeInfo": 20,
+    "ticker/price": 4,
+    "order": 4,
+    "openOrders": 6,
+    "allOrders": 20,
+    "myTrades": 20,
+}
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 10) -> float:
+    """
+    Seconds to wait before retrying after `attempt` failures: doubles with every attempt up to `cap`,
+    with half of it random so callers failing together don't retry together
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_order_request(method: str, uri: str) -> bool:
+    path = urlparse(uri).path
+    return method.lower() != "get" or path.endswith(("/order", "/openOrders"))
+
+
+def request_weight(method: str, uri: str) -> Tuple[int, bool]:
+    """
+    :return: The estimated weight of a request and whether it may use the reserve of order requests
+    """
+    return ESTIMATED_WEIGHTS.get(urlparse(uri).path.split("/", 3)[-1], 1), is_order_request(method, uri)
+
+
+def retry_after(e: BinanceAPIException) -> float:
+    """
+    Seconds the exchange asked to wait with a rate limit error, 0 if it didn't say
+    """
+    headers = getattr(e.response, "headers", None) or {}
+    return float(headers.get("Retry-After") or 0)
+
+
+class RateLimitedClient(Client):
+    """
+    python-binance Client that keeps the request weight of the bot below the limit of the exchange.
+
+    The weight used in the current minute is estimated before every request and corrected with the
+    X-MBX-USED-WEIGHT-1M header of its response. A request that would go over the limit waits for the
+    next minute instead of being sent, informational ones already when only the reserve of order
+    requests is left. A 429 or 418 response holds every request until its Retry-After, as sending
+    more only extends the ban. Requests share a pool of kept alive connections.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *args,
+        weight_limit: int = WEIGHT_LIMIT,
+        order_reserve: int = ORDER_RESERVE,
+        pool_size: int = POOL_SIZE,
+        logger: Optional[Logger] = None,
+        **kwargs,
+    ):
+        # The parent constructor already sends a ping through _request
+        self.weight_limit = weight_limit
+        self.order_reserve = order_reserve
+        self.pool_size = pool_size
+        self.rate_logger = logger
+        self.used_weight = 0
+        self.banned_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+        self._window = 0
+        self._weight_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _init_session(self) -> requests.Session:
+        session = super()._init_session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # Hooks run in the thread that sent the request, unlike `self.response` which threads share
+        session.hooks["response"].append(self._record)
+        return session
+
+    def _reserve(self, weight: int, priority: bool) -> float:
+        """
+        :return: Seconds to wait before the request may be sent, 0 once its weight is accounted for
+        """
+        with self._weight_lock:
+            now = time.time()
+            if now < self.banned_until:
+                return self.banned_until - now
+            window = int(now // 60)
+            if window != self._window:
+                self._window, self.used_weight = window, 0
+            limit = self.weight_limit if priority else self.weight_limit - self.order_reserve
+            if self.used_weight and self.used_weight + weight > limit:
+                return (window + 1) * 60 - now
+            self.used_weight += weight
+            return 0
+
+    def _record(self, response: requests.Response, *args, **kwargs):  # pylint: disable=unused-argument
+        self._record_response(response.status_code, response.headers)
+
+    def _record_response(self, status_code: int, headers: Mapping[str, str]):
+        used_weight = headers.get("x-mbx-used-weight-1m")
+        with self._weight_lock:
+            # The reservations of requests still in flight may not be counted by the exchange yet
+            if used_weight is not None and int(time.time() // 60) == self._window:
+                self.used_weight = max(self.used_weight, int(used_weight))
+        if status_code not in (418, 429):
+            return
+
+        wait = float(headers.get("Retry-After") or 60)
+        with self._weight_lock:
+            self.rejected += 1
+            self.banned_until = max(self.banned_until, time.time() + wait)
+        if self.rate_logger is not None:
+            self.rate_logger.warning(
+                f"Binance rejected a request for going over the rate limit ({status_code}), "
+                f"holding requests for {wait:.0f}s"
+            )
+
+    def _request(self, method, uri: str, signed: bool, force_params: bool = False, **kwargs):
+        weight, priority = request_weight(method, uri)
+        delay = self._reserve(weight, priority)
+        if delay:
+            self.throttled += 1
+            if self.rate_logger is not None:
+                self.rate_logger.debug(f"Request weight {self.used_weight}/{self.weight_limit}, waiting {delay:.1f}s")
+            while delay:
+                time.sleep(delay + random.uniform(0, RESET_JITTER))
+                delay = self._reserve(weight, priority)
+        return super()._request(method, uri, signed, force_params, **kwargs)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Weight used in the current minute, requests that had to wait for it and requests rejected by the exchange
+        """
+        return {
+            "used_weight": self.used_weight,
+            "weight_limit": self.weight_limit,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+
+    def log_stats(self):
+        if self.rate_logger is None:
+            return
+        stats = self.stats()
+        self.rate_logger.debug(
+            f"REST requests: weight {stats['used_weight']}/{stats['weight_limit']} this minute, "
+            f"{stats['throttled']} throttled, {stats['rejected']} rejected by the exchange"
+        )
+
+
+class RateLimitedAsyncClient(AsyncClient):
+    """
+    python-binance AsyncClient drawing on the weight budget of a RateLimitedClient, so the requests sent
+    from an asyncio loop count toward the same limit, and wait out the same bans, as the synchronous ones.
+    The limiter is set once `create` returned, its ping and server time requests aren't accounted for.
+    """
+
+    limiter: Optional[RateLimitedClient] = None
+
+    async def _request(self, method, uri: str, signed: bool, force_params: bool = False, **kwargs):
+        limiter = self.limiter
+        if limiter is not None:
+            weight, priority = request_weight(method, uri)
+            delay = limiter._reserve(weight, priority)  # pylint: disable=protected-access
+            if delay:
+                limiter.throttled += 1
+            while delay:
+                await asyncio.sleep(delay + random.uniform(0, RESET_JITTER))
+                delay = limiter._reserve(weight, priority)  # pylint: disable=protected-access
+        return await super()._request(method, uri, signed, force_params, **kwargs)
+
+    async def _handle_response(self, response):
+        if self.limiter is not None:
+            self.limiter._record_response(response.status, response.headers)  # pylint: disable=protected-access
+        return await super()._handle_response(response)
@@ -0,0 +1,111 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .database import Database
+from .models import Coin, Pair
+
+
+class RatioMatrix:
+    """
+    In-memory copy of the ratio thresholds of every pair, as an N x N matrix indexed by coin.
+
+    The trader reads and updates ratios here, so scouting never has to query the database.
+    Changes are persisted write-behind: they are only written to the pairs table by `flush`,
+    which the trader schedules, so a crash loses at most the updates since the last flush.
+    Missing ratios are NaN.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.coins: List[Coin] = []
+        self.index: Dict[str, int] = {}
+        self.ratios = np.empty((0, 0))
+        self.pairs: Dict[Tuple[int, int], Pair] = {}
+        self._pairs_from: Dict[int, List[Pair]] = {}
+        self._pairs_to: Dict[int, List[Pair]] = {}
+        self._columns_from: Dict[int, np.ndarray] = {}
+        self.dirty: Set[Tuple[int, int]] = set()
+
+    def load(self):
+        """
+        (Re)build the matrix from the pairs table, dropping unflushed changes
+        """
+        pairs = self.db.get_pairs(only_enabled=False)
+        coins: Dict[str, Coin] = {}
+        for pair in pairs:
+            coins.setdefault(pair.from_coin.symbol, pair.from_coin)
+            coins.setdefault(pair.to_coin.symbol, pair.to_coin)
+        self.coins = list(coins.values())
+        self.index = {symbol: i for i, symbol in enumerate(coins)}
+        self.ratios = np.full((len(self.coins), len(self.coins)), np.nan)
+        self.pairs = {}
+        self._pairs_from = {}
+        self._pairs_to = {}
+        self.dirty = set()
+        # Pairs keep the database order, which decides between pairs with the same score
+        for pair in pairs:
+            i, j = self.index[pair.from_coin.symbol], self.index[pair.to_coin.symbol]
+            self.pairs[(i, j)] = pair
+            self._pairs_to.setdefault(j, []).append(pair)
+            if pair.ratio is not None:
+                self.ratios[i, j] = pair.ratio
+            if pair.from_coin.enabled and pair.to_coin.enabled:
+                self._pairs_from.setdefault(i, []).append(pair)
+        self._columns_from = {
+            i: np.array([self.index[pair.to_coin.symbol] for pair in pairs_from], dtype=int)
+            for i, pairs_from in self._pairs_from.items()
+        }
+
+    def pairs_from(self, coin: Coin) -> Tuple[List[Pair], np.ndarray]:
+        """
+        Enabled pairs from the given coin and the column of their target coin
+        """
+        i = self.index.get(coin.symbol)
+        if i not in self._pairs_from:
+            return [], np.empty(0, dtype=int)
+        return self._pairs_from[i], self._columns_from[i]
+
+    def pairs_to(self, coin: Coin) -> List[Pair]:
+        """
+        Every pair to the given coin, enabled or not
+        """
+        return self._pairs_to.get(self.index.get(coin.symbol), [])
+
+    def row(self, coin: Coin) -> np.ndarray:
+        return self.ratios[self.index[coin.symbol]]
+
+    def get(self, pair: Pair) -> Optional[float]:
+        ratio = self.ratios[self.index[pair.from_coin.symbol], self.index[pair.to_coin.symbol]]
+        return None if np.isnan(ratio) else float(ratio)
+
+    def set(self, pair: Pair, ratio: Optional[float]):
+        i, j = self.index[pair.from_coin.symbol], self.index[pair.to_coin.symbol]
+        self.ratios[i, j] = np.nan if ratio is None else ratio
+        # Keep the shared Pair objects in line, scout logs and callers read their ratio
+        self.pairs[(i, j)].ratio = ratio
+        self.dirty.add((i, j))
+
+    def snapshot(self) -> np.ndarray:
+        return self.ratios.copy()
+
+    def restore(self, ratios: np.ndarray):
+        """
+        Replace every ratio with the ones of a snapshot of a matrix over the same pairs
+        """
+        for (i, j), pair in self.pairs.items():
+            ratio = ratios[i, j]
+            self.set(pair, None if np.isnan(ratio) else float(ratio))
+
+    def flush(self):
+        """
+        Write the ratios changed since the last flush to the database
+        """
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        try:
+            self.db.set_pair_ratios({self.pairs[key]: self.pairs[key].ratio for key in dirty})
+        except Exception:
+            self.dirty |= dirty
+            raise
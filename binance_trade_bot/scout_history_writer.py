@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from .logger import Logger
+from .models import Pair, ScoutHistory
+
+SAMPLING_POLICIES = ("all", "crossings", "interval")
+
+
+class ScoutRecord(NamedTuple):
+    pair: Pair
+    target_ratio: Optional[float]
+    current_coin_price: float
+    other_coin_price: float
+    datetime: datetime
+
+
+class ScoutSampler:
+    """
+    Decides which scouts are worth a row in the scout history.
+
+    all: every scout
+    crossings: only scouts where the current ratio of a pair went above or below its target ratio
+    interval: at most one scout per pair every `interval` seconds
+    The first scout of every pair is always kept.
+    """
+
+    def __init__(self, policy: str = "all", interval: float = 60):
+        if policy not in SAMPLING_POLICIES:
+            raise ValueError(f"Unknown scout history policy '{policy}', expected one of {SAMPLING_POLICIES}")
+        self.policy = policy
+        self.interval = interval
+        self._last: Dict[int, object] = {}
+
+    def accept(self, pair: Pair, target_ratio: Optional[float], current_coin_price, other_coin_price) -> bool:
+        if self.policy == "all":
+            return True
+
+        if self.policy == "interval":
+            now = time.monotonic()
+            last = self._last.get(pair.id)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[pair.id] = now
+            return True
+
+        try:
+            above = None if target_ratio is None else current_coin_price / other_coin_price > target_ratio
+        except (TypeError, ZeroDivisionError):
+            above = None
+        if pair.id in self._last and self._last[pair.id] == above:
+            return False
+        self._last[pair.id] = above
+        return True
+
+
+class ScoutHistoryWriter:
+    """
+    Writes scout history rows from a background thread, in bulk.
+
+    Scouts are queued and inserted in a single transaction once `batch_size` of them are pending
+    or the oldest one waited `flush_interval` seconds. The queue holds at most `max_pending` scouts:
+    when the database falls that far behind, `submit` blocks for up to `put_timeout` seconds and
+    then drops the scout, so the scouting loop slows down instead of the bot running out of memory.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        db,
+        logger: Logger,
+        sampler: ScoutSampler,
+        batch_size: int = 500,
+        flush_interval: float = 5,
+        max_pending: int = 10000,
+        put_timeout: float = 1,
+    ):
+        self.db = db
+        self.logger = logger
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue: "queue.Queue[Optional[ScoutRecord]]" = queue.Queue(max_pending)
+        self.dropped = 0
+        self.written = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, pair: Pair, target_ratio: Optional[float], current_coin_price, other_coin_price):
+        if not self.sampler.accept(pair, target_ratio, current_coin_price, other_coin_price):
+            return
+        self._start()
+        record = ScoutRecord(pair, target_ratio, current_coin_price, other_coin_price, datetime.utcnow())
+        try:
+            self.queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.logger.warning(f"Scout history writer is falling behind, {self.dropped} scouts dropped")
+
+    def close(self):
+        """
+        Write the pending scouts and stop the background thread
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="scout-history-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        batch: List[ScoutRecord] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = False
+
+            if record:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(record)
+            if batch and (record is None or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+                deadline = None
+            if record is None:
+                return
+
+    def _write(self, batch: List[ScoutRecord]):
+        try:
+            self.db.insert_scouts(batch)
+            self.written += len(batch)
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.error(f"Failed to write {len(batch)} scouts to the scout history: {e}")
+            return
+
+        if not self.db.socketio_connect():
+            return
+        for record in batch:
+            sh = ScoutHistory(record.pair, record.target_ratio, record.current_coin_price, record.other_coin_price)
+            sh.datetime = record.datetime
+            self.db.send_update(sh)
@@ -0,0 +1,309 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .binance_stream_manager import BinanceCache, BinanceOrder
+
+PRICE_FIELDS = ("price", "received", "bid", "ask", "streamed")
+BALANCE_FIELDS = ("free",)
+STATE_FIELDS = (
+    "balances_version",
+    "balances_loaded",
+    "tickers_stale_before",
+    "ticker_snapshot_time",
+    "ticker_stream_connected",
+)
+
+
+class SeqlockTable:
+    """
+    Rows of float fields in shared memory, written by a single process and read lock-free by others.
+
+    Every row starts with a sequence number the writer makes odd while it changes the row and even
+    again once it is done. Readers copy the row and retry if the sequence number was odd or moved
+    meanwhile, so they never see half a write and never hold up the writer. Fields nobody wrote are NaN.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, keys: Sequence[str], fields: Sequence[str], owner: bool):
+        self.shm = shm
+        self.keys = list(keys)
+        self.fields = {field: i + 1 for i, field in enumerate(fields)}
+        self.index: Dict[str, int] = {key: i for i, key in enumerate(self.keys)}
+        self.array = np.ndarray((len(self.keys), len(fields) + 1), dtype=np.float64, buffer=shm.buf)
+        self.owner = owner
+        # Writes of different threads of the writer process must not interleave on a row
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, keys: Sequence[str], fields: Sequence[str]) -> "SeqlockTable":
+        shm = shared_memory.SharedMemory(create=True, size=max(len(keys), 1) * (len(fields) + 1) * 8)
+        table = cls(shm, keys, fields, owner=True)
+        table.array[:, 0] = 0
+        table.array[:, 1:] = np.nan
+        return table
+
+    @classmethod
+    def attach(cls, name: str, keys: Sequence[str], fields: Sequence[str]) -> "SeqlockTable":
+        # Processes spawned by the creator share its resource tracker, which forgets the memory once it is unlinked
+        return cls(shared_memory.SharedMemory(name=name), keys, fields, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, key: str, **values: float):
+        row = self.index.get(key)
+        if row is None:
+            return
+        columns = [self.fields[field] for field in values]
+        with self._write_lock:
+            self.array[row, 0] += 1
+            self.array[row, columns] = list(values.values())
+            self.array[row, 0] += 1
+
+    def read(self, key: str) -> Optional[np.ndarray]:
+        """
+        :return: A consistent copy of the fields of a row, None for unknown keys
+        """
+        row = self.index.get(key)
+        if row is None:
+            return None
+        array = self.array
+        while True:
+            sequence = array[row, 0]
+            if sequence % 2:
+                continue
+            values = array[row, 1:].copy()
+            if array[row, 0] == sequence:
+                return values
+
+    def get(self, key: str, field: str) -> Optional[float]:
+        values = self.read(key)
+        if values is None:
+            return None
+        value = values[self.fields[field] - 1]
+        return None if math.isnan(value) else float(value)
+
+    def close(self):
+        # Views on the buffer have to go before it can be closed
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedTables:  # pylint: disable=too-few-public-methods
+    """
+    The tables an ingest process shares with the trading process: prices by symbol, balances by asset,
+    and a single row of cache state
+    """
+
+    def __init__(self, prices: SeqlockTable, balances: SeqlockTable, state: SeqlockTable):
+        self.prices = prices
+        self.balances = balances
+        self.state = state
+
+    @classmethod
+    def create(cls, symbols: Sequence[str], assets: Sequence[str]) -> "SharedTables":
+        return cls(
+            SeqlockTable.create(symbols, PRICE_FIELDS),
+            SeqlockTable.create(assets, BALANCE_FIELDS),
+            SeqlockTable.create(["state"], STATE_FIELDS),
+        )
+
+    def names(self) -> Tuple[str, str, str]:
+        return self.prices.name, self.balances.name, self.state.name
+
+    @classmethod
+    def attach(cls, names: Tuple[str, str, str], symbols: Sequence[str], assets: Sequence[str]) -> "SharedTables":
+        prices, balances, state = names
+        return cls(
+            SeqlockTable.attach(prices, symbols, PRICE_FIELDS),
+            SeqlockTable.attach(balances, assets, BALANCE_FIELDS),
+            SeqlockTable.attach(state, ["state"], STATE_FIELDS),
+        )
+
+    def close(self):
+        self.prices.close()
+        self.balances.close()
+        self.state.close()
+
+
+class SharedCacheWriter(BinanceCache):
+    """
+    BinanceCache of the ingest process: keeps itself up to date as usual and publishes prices, balances
+    and its state to the shared tables. Order updates and balance changes are also announced on the events
+    queue, for the trading process to wake up whoever waits for them.
+    """
+
+    def __init__(self, tables: SharedTables, events):
+        self.tables = tables
+        self.events = events
+        self._streamed_tickers: Optional[FrozenSet[str]] = None
+        self._published_balances: Dict[str, float] = {}
+        for symbol in tables.prices.keys:
+            tables.prices.write(symbol, streamed=1)
+
+    @property
+    def streamed_tickers(self) -> Optional[FrozenSet[str]]:  # pylint: disable=unsubscriptable-object
+        return self._streamed_tickers
+
+    @streamed_tickers.setter
+    def streamed_tickers(self, symbols: Optional[FrozenSet[str]]):  # pylint: disable=unsubscriptable-object
+        self._streamed_tickers = symbols
+        for symbol in self.tables.prices.keys:
+            self.tables.prices.write(symbol, streamed=float(symbols is None or symbol in symbols))
+
+    def set_ticker(self, symbol: str, price: float, received: float) -> bool:
+        changed = super().set_ticker(symbol, price, received)
+        self.tables.prices.write(symbol, price=price, received=received)
+        return changed
+
+    def set_book_ticker(self, symbol: str, bid: float, ask: float) -> bool:
+        changed = super().set_book_ticker(symbol, bid, ask)
+        if changed:
+            self.tables.prices.write(symbol, bid=bid, ask=ask)
+        return changed
+
+    def clear_book_tickers(self):
+        for symbol in self.book_tickers:
+            self.tables.prices.write(symbol, bid=np.nan, ask=np.nan)
+        super().clear_book_tickers()
+
+    def set_ticker_stream_connected(self, connected: bool, since: float):
+        super().set_ticker_stream_connected(connected, since)
+        self.tables.state.write("state", tickers_stale_before=since, ticker_stream_connected=float(connected))
+
+    def apply_ticker_snapshot(self, tickers: List[dict], fetched: float) -> List[str]:
+        changed = super().apply_ticker_snapshot(tickers, fetched)
+        self.tables.state.write("state", ticker_snapshot_time=fetched)
+        self.events.put(("ticker_snapshot",))
+        return changed
+
+    @contextmanager
+    def update_balances(self):
+        # The mutex is reentrant, holding it on until published keeps the tables in the order of the updates
+        with self._balances_mutex:
+            with super().update_balances() as balances:
+                yield balances
+            for asset in self._published_balances.keys() - balances.keys():
+                self.tables.balances.write(asset, free=np.nan)
+            for asset, free in balances.items():
+                if self._published_balances.get(asset) != free:
+                    self.tables.balances.write(asset, free=free)
+            self._published_balances = dict(balances)
+            self.tables.state.write(
+                "state", balances_version=self.balances_version, balances_loaded=float(self.balances_loaded)
+            )
+        self.events.put(("balances",))
+
+    def set_order(self, order: BinanceOrder):
+        super().set_order(order)
+        self.events.put(("order", order.event))
+
+
+class _SharedView:
+    def __init__(self, get):
+        self._get = get
+
+    def get(self, key: str, default=None):
+        value = self._get(key)
+        return default if value is None else value
+
+
+class SharedCacheReader(BinanceCache):
+    """
+    BinanceCache of the trading process when an ingest process owns the streams.
+
+    Prices, balances and the cache state are read from the shared tables without taking any lock.
+    Changes to the balances are sent to the ingest process, the only writer, and waited for, like
+    price snapshots. Orders are kept here as usual, from the updates the ingest process announces.
+    """
+
+    def __init__(self, tables: SharedTables, commands):
+        self.tables = tables
+        self.commands = commands
+        self._snapshot_changed = threading.Condition()
+        self.ticker_values = _SharedView(lambda symbol: tables.prices.get(symbol, "price"))
+        self.book_tickers = _SharedView(self._book_ticker)
+        self._balances_view = _SharedView(lambda asset: tables.balances.get(asset, "free"))
+
+    def _book_ticker(self, symbol: str) -> Optional[Tuple[float, float]]:  # pylint: disable=unsubscriptable-object
+        bid, ask = self.tables.prices.get(symbol, "bid"), self.tables.prices.get(symbol, "ask")
+        return None if bid is None or ask is None else (bid, ask)
+
+    @property
+    def balances_version(self) -> int:
+        return int(self.tables.state.get("state", "balances_version") or 0)
+
+    @property
+    def balances_loaded(self) -> bool:
+        return bool(self.tables.state.get("state", "balances_loaded"))
+
+    @property
+    def tickers_stale_before(self) -> float:
+        return self.tables.state.get("state", "tickers_stale_before") or 0.0
+
+    @property
+    def ticker_stream_connected(self) -> bool:
+        # Unknown until the stream first connects or goes down
+        return self.tables.state.get("state", "ticker_stream_connected") != 0.0
+
+    @contextmanager
+    def open_balances(self):
+        yield self._balances_view
+
+    def _change_balances(self, *command, timeout: float = 10):
+        version = self.balances_version
+        self.commands.put(command)
+        self.wait_for_balances(version, timeout)
+
+    def load_balances(self, balances: Dict[str, float], update_time: int):
+        self._change_balances("load_balances", balances, update_time)
+
+    def invalidate_balances(self):
+        self._change_balances("invalidate_balances")
+
+    def notify_balances(self):
+        """
+        Wake up balance waiters, the ingest process changed them
+        """
+        with self._balances_mutex:
+            self._balances_mutex.notify_all()
+
+    def ticker_age(self, symbol: str) -> Optional[float]:
+        received = self.tables.prices.get(symbol, "received")
+        return None if received is None else time.time() - received
+
+    def is_ticker_stale(self, symbol: str) -> bool:
+        values = self.tables.prices.read(symbol)
+        if values is None or not self.ticker_stream_connected:
+            return True
+        _, received, _, _, streamed = values
+        return not streamed or math.isnan(received) or received < self.tickers_stale_before
+
+    def needs_ticker_snapshot(self) -> bool:
+        # The ingest process takes one when it starts and whenever the stream reconnects, until one goes through
+        _, _, stale_before, snapshot_time, _ = self.tables.state.read("state")
+        return math.isnan(snapshot_time) or snapshot_time < (0.0 if math.isnan(stale_before) else stale_before)
+
+    def notify_ticker_snapshot(self):
+        """
+        Wake up snapshot waiters, the ingest process took one
+        """
+        with self._snapshot_changed:
+            self._snapshot_changed.notify_all()
+
+    def wait_for_ticker_snapshot(self, timeout: float = None) -> bool:
+        """
+        Block until the prices of a snapshot taken since they went stale are in
+
+        :return: False on timeout
+        """
+        with self._snapshot_changed:
+            return self._snapshot_changed.wait_for(lambda: not self.needs_ticker_snapshot(), timeout)
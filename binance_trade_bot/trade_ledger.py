@@ -0,0 +1,154 @@
+import sys
+from array import array
+from copy import copy
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+
+class TradeStats:  # pylint: disable=too-many-instance-attributes
+    """
+    Record of a single jump made by the trader
+    """
+
+    __slots__ = (
+        "trade_idx",
+        "dt",
+        "from_coin",
+        "to_coin",
+        "from_coin_price",
+        "to_coin_price",
+        "trades_str",
+        "diff_usdt",
+        "diff_perc",
+        "quantity",
+        "balance",
+        "perc_from_init_balance",
+        "init_balance",
+        "multiplier",
+    )
+
+    def __init__(
+        self,
+        trade_idx: int,
+        dt: datetime,
+        from_coin: str = "",
+        to_coin: str = "",
+        from_coin_price: float = 0,
+        to_coin_price: float = 0,
+        init_balance: float = 0,
+        multiplier: float = 0,
+    ):
+        self.trade_idx = trade_idx
+        self.dt = dt
+        self.from_coin = from_coin
+        self.to_coin = to_coin
+        self.from_coin_price = from_coin_price
+        self.to_coin_price = to_coin_price
+        self.trades_str = ""
+        self.diff_usdt = 0
+        self.diff_perc = 0
+        self.quantity = 0
+        self.balance = ""
+        self.perc_from_init_balance = 0
+        self.init_balance = init_balance
+        self.multiplier = multiplier
+
+    def relabel(self, multiplier: float) -> "TradeStats":
+        """
+        Copy of the record attributed to another scout multiplier
+        """
+        relabeled = copy(self)
+        relabeled.multiplier = multiplier
+        return relabeled
+
+    def __str__(self):
+        m = f"{self.trade_idx}. x{self.multiplier}, {self.dt.strftime('%d/%m/%Y, %H:%M:%S')}, {self.trades_str}, " \
+            f"PNL: ${self.diff_usdt} ({self.diff_perc}%), " \
+            f"result: {self.perc_from_init_balance}% from init balance - " \
+            f"{self.init_balance}$"
+        return m
+
+
+class TradeLedger:
+    """
+    Every trade of a trader in the order they were made, with their profits in a flat array.
+
+    Best/worst/average profit, cumulative PnL and drawdown are updated as trades come in, so
+    recording a trade costs the same at the first and at the ten-thousandth one. Only trades made
+    after a previous one have a profit, the first one is recorded with 0 and left out of the
+    aggregates.
+    """
+
+    def __init__(self):
+        self.trades: List[TradeStats] = []
+        self.profits = array("d")
+        self.worst_profit = sys.maxsize
+        self.worst_trade: Optional[TradeStats] = None
+        self.best_profit = -sys.maxsize
+        self.best_trade: Optional[TradeStats] = None
+        self.average_profit = 0
+        self.realized = 0
+        self.cumulative_profit = 0.0
+        self.peak_profit = 0.0
+        self.max_drawdown = 0.0
+
+    def __len__(self):
+        return len(self.trades)
+
+    def __iter__(self) -> Iterator[TradeStats]:
+        return iter(self.trades)
+
+    @property
+    def last_trade(self) -> Optional[TradeStats]:
+        return self.trades[-1] if self.trades else None
+
+    @property
+    def drawdown(self) -> float:
+        """
+        How far the cumulative profit is below its best so far
+        """
+        return self.peak_profit - self.cumulative_profit
+
+    def add(self, trade: TradeStats, realized=True):
+        self.trades.append(trade)
+        self.profits.append(trade.diff_usdt)
+        if not realized:
+            return
+
+        profit = trade.diff_usdt
+        if self.worst_profit > profit:
+            self.worst_profit = profit
+            self.worst_trade = trade
+        if self.best_profit < profit:
+            self.best_profit = profit
+            self.best_trade = trade
+        self.realized += 1
+        self.cumulative_profit += profit
+        self.average_profit = round(self.cumulative_profit / self.realized, 3)
+        self.peak_profit = max(self.peak_profit, self.cumulative_profit)
+        self.max_drawdown = max(self.max_drawdown, self.drawdown)
+
+    def by_profit(self) -> List[TradeStats]:
+        """
+        Trades sorted by profit, trades with the same profit in the order they were made
+        """
+        order = np.argsort(np.frombuffer(self.profits, dtype=np.float64), kind="stable")
+        return [self.trades[i] for i in order]
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.trades)} trades, cumulative PNL: ${round(self.cumulative_profit, 3)}, "
+            f"average: ${self.average_profit}, best: ${self.best_profit}, worst: ${self.worst_profit}, "
+            f"drawdown: ${round(self.drawdown, 3)} (max ${round(self.max_drawdown, 3)})"
+        )
+
+    def copy(self) -> "TradeLedger":
+        """
+        Independent ledger with the same trades, which are shared as they never change once recorded
+        """
+        ledger = copy(self)
+        ledger.trades = list(self.trades)
+        ledger.profits = array("d", self.profits)
+        return ledger
@@ -0,0 +1,74 @@
+import math
+import zlib
+
+import numpy as np
+import pytest
+
+from binance_trade_bot.config import Config
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setenv("API_KEY", "key")
+    monkeypatch.setenv("API_SECRET_KEY", "secret")
+    monkeypatch.setenv("CURRENT_COIN_SYMBOL", "BTC")
+    return Config()
+
+
+class FakeKlineClient:
+    """
+    Offline stand-in for the parts of the python-binance Client that backtests and the kline prefetcher use.
+
+    Prices are a deterministic random walk per symbol with the occasional missing candle, so any window
+    of a symbol sees the same prices. Every window asked for is recorded in `calls`, and the ones listed
+    in `failing` fail once, like a dropped connection.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.failing = set()
+
+    def get_historical_klines(self, symbol, interval, start_str, end_str=None, limit=1000):
+        start_minute = int(start_str) // 60000
+        end_minute = int(end_str) // 60000 + 1 if end_str is not None else start_minute + limit
+        self.calls.append((symbol, start_minute, end_minute))
+        if (symbol, start_minute) in self.failing:
+            self.failing.remove((symbol, start_minute))
+            raise ConnectionError(f"Dropped fetching {symbol}")
+        seed = zlib.crc32(symbol.encode())
+        day = 1440
+        klines = []
+        for day_start in range(start_minute - start_minute % day, end_minute, day):
+            rng = np.random.default_rng([seed, day_start])
+            base = 1 + seed % 1000 + 5 * math.sin(day_start / day)
+            prices = base * np.exp(np.cumsum(rng.normal(0, 0.002, day)))
+            gaps = rng.random(day) < 0.001
+            for offset in range(day):
+                minute = day_start + offset
+                if start_minute <= minute < end_minute and not gaps[offset]:
+                    klines.append([minute * 60000, repr(float(prices[offset]))])
+        return klines
+
+    def get_symbol_info(self, symbol):
+        return {
+            "symbol": symbol,
+            "filters": [
+                {"filterType": "LOT_SIZE", "stepSize": "0.00100000"},
+                {"filterType": "MIN_NOTIONAL", "minNotional": "0.00010000"},
+            ],
+        }
+
+    def prices(self, symbol, start_minute, end_minute):
+        """
+        :return: The price of every minute of [start_minute, end_minute), NaN for the missing candles
+        """
+        klines = self.get_historical_klines(symbol, "1m", start_minute * 60000, end_minute * 60000 - 1)
+        # Not a fetch of whoever is tested
+        self.calls.pop()
+        prices = {kline[0] // 60000: float(kline[1]) for kline in klines}
+        return [prices.get(minute, math.nan) for minute in range(start_minute, end_minute)]
+
+
+@pytest.fixture
+def kline_client():
+    return FakeKlineClient()
@@ -0,0 +1,68 @@
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+from binance_trade_bot.backtest import backtest, fork_backtest
+from binance_trade_bot.kline_store import KlineStore
+
+START_DATE = datetime(2021, 11, 1)
+END_DATE = datetime(2021, 11, 2)
+COINS = ["AAA", "BBB", "CCC", "DDD"]
+MULTIPLIERS = [1, 3]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return KlineStore(str(tmp_path))
+
+
+def outcome(manager, trader):
+    return dict(manager.balances), [str(trade) for trade in trader.ledger]
+
+
+def run_backtest(config, store, client, scout_multiplier, fast):
+    config.SCOUT_MULTIPLIER = scout_multiplier
+    for manager, trader in backtest(
+        START_DATE,
+        END_DATE,
+        yield_interval=1000,
+        supported_coins=COINS,
+        logger=mock.MagicMock(),
+        cache=store,
+        config=config,
+        fast=fast,
+        client=client,
+    ):
+        pass
+    return outcome(manager, trader)
+
+
+@pytest.mark.parametrize("scout_multiplier", MULTIPLIERS)
+def test_fast_engine_trades_like_scouting_every_minute(config, store, kline_client, scout_multiplier):
+    balances, trades = run_backtest(config, store, kline_client, scout_multiplier, fast=False)
+
+    assert trades
+    assert run_backtest(config, store, kline_client, scout_multiplier, fast=True) == (balances, trades)
+
+
+def test_forked_backtest_trades_like_a_backtest_per_multiplier(config, store, kline_client):
+    expected = {
+        multiplier: run_backtest(config, store, kline_client, multiplier, fast=False) for multiplier in MULTIPLIERS
+    }
+
+    variants = fork_backtest(
+        MULTIPLIERS,
+        START_DATE,
+        END_DATE,
+        supported_coins=COINS,
+        logger=mock.MagicMock(),
+        cache=store,
+        config=config,
+        client=kline_client,
+    ).run(END_DATE)
+
+    assert all(trades for _, trades in expected.values())
+    assert {multiplier: outcome(variant.manager, variant.trader) for multiplier, variant in variants.items()} == (
+        expected
+    )
@@ -0,0 +1,38 @@
+from unittest import mock
+
+import pytest
+
+from binance_trade_bot.binance_api_manager import BinanceAPIManager
+from binance_trade_bot.database import Database
+from binance_trade_bot.models import Coin
+
+
+@pytest.fixture
+def db(config):
+    database = Database(mock.MagicMock(), config, "sqlite:///:memory:")
+    database.socketio_connect = lambda: False
+    database.create_database()
+    database.set_coins(["BTC", "ETH"])
+    return database
+
+
+@pytest.fixture
+def manager(db):
+    with mock.patch.object(BinanceAPIManager, "setup_websockets"):
+        return BinanceAPIManager(db.config, db, mock.MagicMock(), client=mock.MagicMock())
+
+
+def test_order_is_placed_with_the_client_order_id_of_its_trade_log(db, manager):
+    trade_log = db.start_trade_log(Coin("BTC"), Coin("USDT"), True)
+    place = mock.MagicMock(return_value={"orderId": 42})
+
+    client_order_id = manager.client_order_id(trade_log, "SELL")
+    order_id = manager._place_order(  # pylint: disable=protected-access
+        place, "BTCUSDT", client_order_id, quantity="1", price="100"
+    )
+
+    assert order_id == 42
+    place.assert_called_once_with(symbol="BTCUSDT", newClientOrderId=client_order_id, quantity="1", price="100")
+    assert client_order_id.startswith("btb-1-") and client_order_id.endswith("-SELL")
+    # The trade log keeps working with its trade detached
+    trade_log.set_ordered(1, 0, 1)
@@ -0,0 +1,81 @@
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+from binance.exceptions import BinanceAPIException
+
+from binance_trade_bot.kline_prefetch import KlinePrefetcher
+from binance_trade_bot.kline_store import KlineStore, to_minute
+
+START = to_minute(datetime(2021, 11, 1))
+
+
+def stored_prices(store, symbol, start_minute, end_minute):
+    return [store.get(symbol, minute) for minute in range(start_minute, end_minute)]
+
+
+def test_plan_only_has_the_windows_missing_from_the_store(tmp_path, kline_client):
+    store = KlineStore(str(tmp_path))
+    prefetcher = KlinePrefetcher(kline_client, store, mock.MagicMock())
+    prefetcher.run(["AAAUSDT"], START + 1000, START + 1500)
+    kline_client.calls.clear()
+
+    assert prefetcher.plan(["AAAUSDT", "BBBUSDT"], START, START + 2500) == [
+        ("AAAUSDT", START, START + 1000),
+        ("AAAUSDT", START + 1500, START + 2500),
+        ("BBBUSDT", START, START + 1000),
+        ("BBBUSDT", START + 1000, START + 2000),
+        ("BBBUSDT", START + 2000, START + 2500),
+    ]
+    assert not kline_client.calls
+
+
+def test_run_fills_a_gap_with_the_prices_of_the_client(tmp_path, kline_client):
+    store = KlineStore(str(tmp_path))
+    prefetcher = KlinePrefetcher(kline_client, store, mock.MagicMock())
+    prefetcher.run(["AAAUSDT"], START, START + 500)
+    prefetcher.run(["AAAUSDT"], START + 2000, START + 2500)
+    kline_client.calls.clear()
+
+    assert prefetcher.run(["AAAUSDT"], START, START + 2500) == 2
+    assert sorted(kline_client.calls) == [
+        ("AAAUSDT", START + 500, START + 1500),
+        ("AAAUSDT", START + 1500, START + 2000),
+    ]
+    np.testing.assert_array_equal(
+        stored_prices(store, "AAAUSDT", START, START + 2500), kline_client.prices("AAAUSDT", START, START + 2500)
+    )
+
+
+def test_a_second_run_resumes_an_interrupted_one(tmp_path, kline_client):
+    symbols = ["AAAUSDT", "BBBUSDT"]
+    kline_client.failing = {("AAAUSDT", START + 1000), ("BBBUSDT", START)}
+    store = KlineStore(str(tmp_path))
+    assert KlinePrefetcher(kline_client, store, mock.MagicMock()).run(symbols, START, START + 3000) == 4
+    store.close()
+    kline_client.calls.clear()
+
+    # A new store over the same files knows what was fetched before
+    store = KlineStore(str(tmp_path))
+    prefetcher = KlinePrefetcher(kline_client, store, mock.MagicMock())
+    assert prefetcher.run(symbols, START, START + 3000) == 2
+    assert sorted(kline_client.calls) == [("AAAUSDT", START + 1000, START + 2000), ("BBBUSDT", START, START + 1000)]
+    kline_client.calls.clear()
+
+    assert prefetcher.run(symbols, START, START + 3000) == 0
+    assert not kline_client.calls
+    for symbol in symbols:
+        np.testing.assert_array_equal(
+            stored_prices(store, symbol, START, START + 3000), kline_client.prices(symbol, START, START + 3000)
+        )
+
+
+def test_invalid_symbols_are_skipped(tmp_path, kline_client):
+    invalid = BinanceAPIException(mock.MagicMock(), 400, '{"code": -1121, "msg": "Invalid symbol."}')
+    store = KlineStore(str(tmp_path))
+    prefetcher = KlinePrefetcher(kline_client, store, mock.MagicMock())
+
+    with mock.patch.object(kline_client, "get_historical_klines", side_effect=invalid):
+        assert prefetcher.run(["NOPEUSDT"], START, START + 2000) == 0
+    assert prefetcher.invalid_symbols == {"NOPEUSDT"}
+    assert store.get("NOPEUSDT", START) is None